@@ -69,7 +69,7 @@ def hobohm_homology_reduce(entity_fp: str, threshold: float = 0.3, is_nucleotide
         json_dict = {}
 
     # get edge list -  this function expects the threshold to be in distance (after transformation)
-    full_graph, part_graph, labels = make_graphs_from_sequences(config, one_minus(threshold), json_dict, True)
+    full_graph, node_table, labels = make_graphs_from_sequences(config, one_minus(threshold), json_dict, True)
     json_dict['time_edges_complete'] = time.perf_counter()
 
     neighborlist = {}
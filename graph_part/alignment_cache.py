@@ -0,0 +1,246 @@
+'''
+Persistent cache of pairwise alignments, to reuse them across runs.
+
+Datasets often change only by a few sequences between runs. The cache
+keeps the transformed metrics of aligned pairs in an SQLite file, keyed
+by the hashes of the two sequences and by the alignment parameters, so
+that identifiers can change and the same file can serve several datasets.
+
+To save space, all-vs-all runs only store the pairs within their threshold.
+Each run also records which sequences it aligned all-vs-all, and at which
+threshold. A pair of sequences that took part in the same run, but is not
+stored, is therefore known to be above that threshold. A later run at the
+same or a stricter threshold only needs to align its new sequences against
+all others.
+'''
+import hashlib
+import json
+import sqlite3
+import networkx as nx
+import numpy as np
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from .needle_utils import new_sequence_pairs, _map_to_graph
+from .sequence_store import SequenceStore
+from .csr_graph import insert_edges
+
+
+def sequence_hash(seq: str) -> str:
+    '''Hash of a sequence, ignoring case.'''
+    return hashlib.sha256(seq.upper().encode('ascii', errors='replace')).hexdigest()[:24]
+
+
+def params_key(params: Dict[str, Any]) -> str:
+    '''Hash of a set of parameters.'''
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class AlignmentCache():
+    '''
+    SQLite store of pairwise metrics.
+
+    Tables:
+        pairs:   metric of a pair of sequence hashes, the smaller hash first.
+                 When both directions were aligned, the smaller metric is kept.
+        runs:    all-vs-all runs and their thresholds.
+        members: sequences that were aligned all-vs-all in a run.
+
+    pair_params change the metric of an alignment. run_params additionally
+    change which pairs a run aligned, such as the k-mer prefilter.
+    '''
+
+    def __init__(self, path: str, pair_params: Dict[str, Any], run_params: Dict[str, Any] = None) -> None:
+        self.path = path
+        self.key = params_key(pair_params)
+        self.run_key = params_key({'pairs': self.key, 'run': run_params or {}})
+        # runs that aligned all pairs of their members.
+        self.full_run_key = params_key({'pairs': self.key, 'run': {}})
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS pairs (key TEXT, a TEXT, b TEXT, metric REAL, PRIMARY KEY (key, a, b)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, key TEXT, threshold REAL);
+            CREATE TABLE IF NOT EXISTS members (run INTEGER, seq TEXT, PRIMARY KEY (run, seq)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS members_seq ON members (seq);
+        ''')
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def _set_query(self, hashes: Iterable[str]) -> None:
+        '''Put the hashes into a temporary table to join with.'''
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS query (seq TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM query')
+        self.db.executemany('INSERT OR IGNORE INTO query VALUES (?)', ((h,) for h in hashes))
+
+    def covered_sequences(self, hashes: Iterable[str], threshold: float) -> Set[str]:
+        '''
+        Find the earlier run at the same or a looser threshold that shares
+        the most sequences with hashes. All pairs of the shared sequences
+        are known. Returns the shared sequences.
+        Runs that aligned all pairs also serve runs with a prefilter.
+        '''
+        self._set_query(hashes)
+        best = self.db.execute('''
+            SELECT runs.run FROM runs JOIN members ON runs.run = members.run JOIN query ON members.seq = query.seq
+            WHERE runs.key IN (?, ?) AND runs.threshold >= ? GROUP BY runs.run ORDER BY COUNT(*) DESC LIMIT 1
+        ''', (self.run_key, self.full_run_key, threshold)).fetchone()
+        if best is None:
+            return set()
+        rows = self.db.execute('SELECT members.seq FROM members JOIN query ON members.seq = query.seq WHERE members.run = ?', best)
+        return {seq for seq, in rows}
+
+    def load_edges(self, hashes: Iterable[str], threshold: float) -> List[Tuple[str, str, float]]:
+        '''Get all stored pairs among hashes within the threshold.'''
+        self._set_query(hashes)
+        return self.db.execute('''
+            SELECT a, b, metric FROM pairs JOIN query qa ON pairs.a = qa.seq JOIN query qb ON pairs.b = qb.seq
+            WHERE pairs.key = ? AND pairs.metric <= ?
+        ''', (self.key, threshold)).fetchall()
+
+    def lookup_pairs(self, pairs: List[Tuple[str, str]], threshold: float) -> Dict[Tuple[str, str], float]:
+        '''
+        Get the known metrics of pairs of hashes. Pairs that are not stored,
+        but were aligned in the same all-vs-all run at the same or a looser
+        threshold, are above the threshold and get a metric of inf.
+        '''
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS query_pairs (a TEXT, b TEXT, PRIMARY KEY (a, b)) WITHOUT ROWID')
+        self.db.execute('DELETE FROM query_pairs')
+        self.db.executemany('INSERT OR IGNORE INTO query_pairs VALUES (?, ?)', (sorted(pair) for pair in pairs))
+        known = {(a, b): metric for a, b, metric in self.db.execute('''
+            SELECT pairs.a, pairs.b, pairs.metric FROM pairs JOIN query_pairs q ON pairs.a = q.a AND pairs.b = q.b WHERE pairs.key = ?
+        ''', (self.key,))}
+
+        runs = {}
+        self._set_query({h for pair in pairs for h in pair})
+        for seq, run in self.db.execute('''
+            SELECT members.seq, members.run FROM members JOIN query ON members.seq = query.seq JOIN runs ON members.run = runs.run
+            WHERE runs.key = ? AND runs.threshold >= ?
+        ''', (self.full_run_key, threshold)):
+            runs.setdefault(seq, set()).add(run)
+
+        out = {}
+        for pair in pairs:
+            a, b = sorted(pair)
+            if (a, b) in known:
+                out[pair] = known[(a, b)]
+            elif not runs.get(a, set()).isdisjoint(runs.get(b, set())):
+                out[pair] = np.inf
+        return out
+
+    def store_pairs(self, rows: Iterable[Tuple[str, str, float]]) -> None:
+        '''Store metrics of pairs of hashes, keeping the smaller one.'''
+        self.db.executemany('''
+            INSERT INTO pairs VALUES (?, ?, ?, ?) ON CONFLICT (key, a, b) DO UPDATE SET metric = MIN(metric, excluded.metric)
+        ''', ((self.key, *sorted((a, b)), float(metric)) for a, b, metric in rows))
+        self.db.commit()
+
+    def store_run(self, hashes: Iterable[str], threshold: float) -> None:
+        '''Record that all pairs of hashes within the threshold are stored.'''
+        run = self.db.execute('INSERT INTO runs (key, threshold) VALUES (?, ?)', (self.run_key, threshold)).lastrowid
+        self.db.executemany('INSERT OR IGNORE INTO members VALUES (?, ?)', ((run, h) for h in hashes))
+        self.db.commit()
+
+
+def generate_edges_cached(cache_path: str,
+                          entity_fp: str,
+                          full_graph: nx.classes.graph.Graph,
+                          transformation: str,
+                          threshold: float,
+                          denominator: str = 'full',
+                          prefilter: bool = False,
+                          kmer_length: int = None,
+                          min_shared_kmers: int = None,
+                          n_procs: int = 4,
+                          parallel_mode: str = 'multithread',
+                          delimiter: str = '|',
+                          is_nucleotide: bool = False,
+                          gapopen: float = 10,
+                          gapextend: float = 0.5,
+                          endweight: bool = False,
+                          endopen: float = 10,
+                          endextend: float = 0.5,
+                          matrix: str = 'EBLOSUM62',
+                          aligner: str = 'needleall',
+                          sequence_store: SequenceStore = None,
+                          ) -> Dict[str, int]:
+    '''
+    Replaces the alignment of the needle mode when an alignment cache is used.
+    The edges among sequences that an earlier run already aligned are read
+    from the cache. The new sequences are aligned against all others in
+    batches of pairs, and the results are added to the cache.
+    With prefilter, only the candidate pairs of the k-mer index are aligned,
+    see `kmer_utils.generate_edges_kmer_prefilter`.
+    The sequences are read from sequence_store, or from entity_fp if it is not given.
+    Returns the number of sequences found in the cache and of aligned pairs.
+    '''
+    from .kmer_utils import DEFAULT_KMER_LENGTH, DEFAULT_MIN_SHARED_KMERS
+    from .mmseqs_needle_combined_utils import generate_needle_edges_pairwise_mp
+
+    run_params = None
+    if prefilter:
+        kmer_length = DEFAULT_KMER_LENGTH[is_nucleotide] if kmer_length is None else kmer_length
+        min_shared_kmers = DEFAULT_MIN_SHARED_KMERS if min_shared_kmers is None else min_shared_kmers
+        run_params = {'kmer_length': kmer_length, 'min_shared_kmers': min_shared_kmers}
+    pair_params = dict(aligner=aligner, transformation=transformation, denominator=denominator, nucleotide=is_nucleotide,
+                       gapopen=gapopen, gapextend=gapextend, endweight=endweight, endopen=endopen, endextend=endextend, matrix=matrix)
+    cache = AlignmentCache(cache_path, pair_params, run_params)
+
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp, delimiter)
+    ids, seqs = sequence_store.ids, sequence_store.sequences()
+    hashes = [sequence_hash(seq) for seq in seqs]
+
+    covered = cache.covered_sequences(hashes, threshold)
+    is_old = np.array([h in covered for h in hashes], dtype=bool)
+    print(f'Found {is_old.sum()} of {len(ids)} sequences in the alignment cache.')
+
+    # insert the cached edges. Identical sequences share a hash.
+    by_hash = {}
+    for i, h in enumerate(hashes):
+        by_hash.setdefault(h, []).append(i)
+    qry, lib, metrics = [], [], []
+    for a, b, metric in cache.load_edges(covered, threshold):
+        for i in by_hash[a]:
+            for j in by_hash[b]:
+                if i != j:
+                    qry.append(i)
+                    lib.append(j)
+                    metrics.append(metric)
+    if len(qry) > 0:
+        nodes, remap = _map_to_graph(full_graph, ids)
+        insert_edges(full_graph, nodes, remap[np.array(qry)], remap[np.array(lib)], np.array(metrics))
+
+    queries, libs = new_sequence_pairs(seqs, ~is_old, denominator, transformation, threshold, prefilter, kmer_length, min_shared_kmers)
+    pairs = [(ids[q], ids[l]) for q, l in zip(queries.tolist(), libs.tolist())]
+    results = {}
+    if len(pairs) > 0:
+        print(f'Aligning {len(pairs)} pairs of new sequences.')
+        generate_needle_edges_pairwise_mp(
+            sequence_store = sequence_store,
+            pairs = pairs,
+            full_graph = full_graph,
+            transformation = transformation,
+            threshold = threshold,
+            denominator = denominator,
+            n_procs = n_procs,
+            parallel_mode = parallel_mode,
+            triangular = True,
+            delimiter = delimiter,
+            is_nucleotide = is_nucleotide,
+            gapopen = gapopen,
+            gapextend = gapextend,
+            endweight = endweight,
+            endopen = endopen,
+            endextend = endextend,
+            matrix = matrix,
+            aligner = aligner,
+            results = results,
+        )
+
+    id_hashes = dict(zip(ids, hashes))
+    cache.store_pairs((id_hashes[u], id_hashes[v], metric) for (u, v), metric in results.items() if metric <= threshold)
+    cache.store_run(hashes, threshold)
+    cache.close()
+
+    return {'cached_sequences': int(is_old.sum()), 'aligned_pairs': len(pairs)}
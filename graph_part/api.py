@@ -79,14 +79,20 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
                      transformation: str = 'one-minus',
                      alignment_mode: str = 'mmseqs2',
                      initialization_mode: str = 'slow-nn',
+                     largest_first: bool = False,
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
+                     checkpoint_format: str = 'csv',
                      denominator: str = 'full',
                      nucleotide: bool = False,
                      prefilter: bool = False,
+                     kmer_length: int = None,
+                     min_shared_kmers: int = None,
+                     split_memory_limit: str = None,
+                     cache_dir: str = None,
                      triangular: bool = False,
-                     threads: int = 4,
+                     threads: int = None,
                      chunks: int = 10,
                      parallel_mode: str = 'multithread',
                      gapopen: float = 10,
@@ -95,8 +101,14 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
                      endopen: float =10,
                      endextend: float = 0.5,
                      matrix: str = 'EBLOSUM62',
+                     aligner: str = 'needleall',
+                     alignment_cache: str = None,
+                     previous_checkpoint: str = None,
+                     previous_output: str = None,
                      edge_file: str = None,
                      metric_column: str = None,
+                     graph_backend: str = 'networkx',
+                     metric_resolution: float = None,
                      ) -> List[Iterable]:
     '''
     Split an array or dictionary of sequences into balanced k folds.
@@ -127,6 +139,10 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
     if alignment_mode not in ['mmseqs2', 'needle', 'precomputed']:
         raise NotImplementedError(f'Alignment mode {alignment_mode} is not implemented. Choose either `needle` or `mmseqs2`.')
 
+    # MMseqs2 uses all available cores unless threads is given, as on the command line.
+    if threads is None and alignment_mode != 'mmseqs2':
+        threads = 4
+
     # Sort out the input formats.
     original_type = type(sequences)
     sequences, labels, priority = _convert_to_dict(sequences, labels, priority)
@@ -144,14 +160,20 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
         "priority_name": "priority" if priority is not None else None,
         "labels_name": "label" if labels is not None else None,
         "initialization_mode": initialization_mode,
+        "largest_first": largest_first,
         "no_moving": no_moving,
         "remove_same": remove_same,
         "test_ratio": 0,
         "val_ratio": 0,
         "save_checkpoint_path": save_checkpoint_path,
+        "checkpoint_format": checkpoint_format,
         "denominator": denominator,
         "nucleotide": nucleotide,
         "prefilter": prefilter,
+        "kmer_length": kmer_length,
+        "min_shared_kmers": min_shared_kmers,
+        "split_memory_limit": split_memory_limit,
+        "cache_dir": cache_dir,
         "triangular": triangular,
         "threads": threads,
         "chunks": chunks,
@@ -162,8 +184,14 @@ def stratified_k_fold(sequences: Union[List[str], np.ndarray, Dict[str,str]],
         "endopen": endopen,
         "endextend": endextend,
         "matrix": matrix,
+        "aligner": aligner,
+        "alignment_cache": alignment_cache,
+        "previous_checkpoint": previous_checkpoint,
+        "previous_output": previous_output,
         "edge_file": edge_file,
         "metric_column": metric_column,
+        "graph_backend": graph_backend,
+        "metric_resolution": metric_resolution,
         "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
         "removal_type": not remove_same,
     }
@@ -207,14 +235,20 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
                      transformation: str = 'one-minus',
                      alignment_mode: str = 'mmseqs2',
                      initialization_mode: str = 'slow-nn',
+                     largest_first: bool = False,
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
+                     checkpoint_format: str = 'csv',
                      denominator: str = 'full',
                      nucleotide: bool = False,
                      prefilter: bool = False,
+                     kmer_length: int = None,
+                     min_shared_kmers: int = None,
+                     split_memory_limit: str = None,
+                     cache_dir: str = None,
                      triangular: bool = False,
-                     threads: int = 4,
+                     threads: int = None,
                      chunks: int = 10,
                      parallel_mode: str = 'multithread',
                      gapopen: float = 10,
@@ -223,8 +257,14 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
                      endopen: float =10,
                      endextend: float = 0.5,
                      matrix: str = 'EBLOSUM62',
+                     aligner: str = 'needleall',
+                     alignment_cache: str = None,
+                     previous_checkpoint: str = None,
+                     previous_output: str = None,
                      edge_file: str = None,
                      metric_column: str = None,
+                     graph_backend: str = 'networkx',
+                     metric_resolution: float = None,
                      ) -> List[Iterable]:
     '''
     Split an array or dictionary of sequences into train-validation-test subsets.
@@ -271,6 +311,10 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
 
 
 
+    # MMseqs2 uses all available cores unless threads is given, as on the command line.
+    if threads is None and alignment_mode != 'mmseqs2':
+        threads = 4
+
     # Sort out the input formats.
     original_type = type(sequences)
     sequences, labels, priority = _convert_to_dict(sequences, labels, priority)
@@ -288,14 +332,20 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
         "priority_name": "priority" if priority is not None else None,
         "labels_name": "label" if labels is not None else None,
         "initialization_mode": initialization_mode,
+        "largest_first": largest_first,
         "no_moving": no_moving,
         "remove_same": remove_same,
         "test_ratio": test_size,
         "val_ratio": valid_size,
         "save_checkpoint_path": save_checkpoint_path,
+        "checkpoint_format": checkpoint_format,
         "denominator": denominator,
         "nucleotide": nucleotide,
         "prefilter": prefilter,
+        "kmer_length": kmer_length,
+        "min_shared_kmers": min_shared_kmers,
+        "split_memory_limit": split_memory_limit,
+        "cache_dir": cache_dir,
         "triangular": triangular,
         "threads": threads,
         "chunks": chunks,
@@ -306,8 +356,14 @@ def train_test_validation_split(sequences: Union[List[str], np.ndarray, Dict[str
         "endopen": endopen,
         "endextend": endextend,
         "matrix": matrix,
+        "aligner": aligner,
+        "alignment_cache": alignment_cache,
+        "previous_checkpoint": previous_checkpoint,
+        "previous_output": previous_output,
         "edge_file": edge_file,
         "metric_column": metric_column,
+        "graph_backend": graph_backend,
+        "metric_resolution": metric_resolution,
         "allow_moving": not no_moving, # silly conversions because in the CLI we want to have those default-false.
         "removal_type": not remove_same,
     }
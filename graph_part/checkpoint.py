@@ -0,0 +1,118 @@
+'''
+Binary checkpoint of the full graph.
+
+The text checkpoint needs to be parsed line by line when it is loaded
+again. The binary checkpoint stores the edges as raw arrays instead, so
+that they can be memory-mapped without any parsing.
+
+Layout of the file, all sections start at multiples of 64 bytes:
+    MAGIC
+    uint64 length of the header, little endian
+    header: json with the transformation, threshold and alignment parameters
+            and the offsets of the sections below
+    ids: utf-8 entity identifiers, separated by newlines
+    qry: int32 array, index into ids
+    lib: int32 array, index into ids
+    metric: float32 array, the transformed metric of each edge
+'''
+import json
+import struct
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+
+MAGIC = b'GRAPHPART-CKPT-1'
+ALIGNMENT = 64
+
+## config values that are recorded in the header.
+HEADER_CONFIG_KEYS = [
+    'alignment_mode', 'transformation', 'threshold', 'threshold_transformed',
+    'denominator', 'denominator_needle', 'denominator_mmseqs', 'recompute_threshold',
+    'nucleotide', 'triangular', 'prefilter', 'gapopen', 'gapextend', 'endweight',
+    'endopen', 'endextend', 'matrix', 'edge_file', 'metric_column',
+    'kmer_length', 'min_shared_kmers', 'miss_rate',
+]
+
+
+def _padding(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def is_checkpoint(file_path: str) -> bool:
+    '''Check whether a file is a binary checkpoint.'''
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_checkpoint(file_path: str,
+                    ids: List[str],
+                    queries: np.ndarray,
+                    libs: np.ndarray,
+                    metrics: np.ndarray,
+                    config: Dict[str, Any]) -> None:
+    '''
+    Write the edges (queries[i], libs[i], metrics[i]) to a binary checkpoint.
+    queries and libs are integer ids into ids. metrics are the transformed
+    metrics, as they are stored in the graph.
+    '''
+    id_bytes = '\n'.join(ids).encode('utf-8')
+    arrays = [np.ascontiguousarray(queries, dtype='<i4'),
+              np.ascontiguousarray(libs, dtype='<i4'),
+              np.ascontiguousarray(metrics, dtype='<f4')]
+
+    header = {k: config[k] for k in HEADER_CONFIG_KEYS if k in config}
+    header['n_ids'] = len(ids)
+    header['n_edges'] = len(arrays[0])
+
+    # the offsets depend on the header length, so reserve room for them first.
+    header.update(ids_offset=0, qry_offset=0, lib_offset=0, metric_offset=0)
+    header_bytes = json.dumps(header).encode('utf-8') + b' ' * 256
+    offset = len(MAGIC) + 8 + len(header_bytes)
+    offset += _padding(offset)
+    header['ids_offset'] = offset
+    offset += len(id_bytes)
+    for name, arr in zip(['qry', 'lib', 'metric'], arrays):
+        offset += _padding(offset)
+        header[name + '_offset'] = offset
+        offset += arr.nbytes
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (header['ids_offset'] - len(MAGIC) - 8 - len(header_bytes))
+
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(id_bytes)
+        for name, arr in zip(['qry', 'lib', 'metric'], arrays):
+            f.write(b'\0' * (header[name + '_offset'] - f.tell()))
+            f.write(arr.tobytes())
+
+
+def load_checkpoint(file_path: str) -> Tuple[Dict[str, Any], List[str], np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Open a binary checkpoint. The edge arrays are memory-mapped,
+    so they are only read from disk when they are accessed.
+
+    Returns (header, ids, queries, libs, metrics).
+    '''
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{file_path} is not a Graph-Part binary checkpoint.')
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        f.seek(header['ids_offset'])
+        id_bytes = f.read(header['qry_offset'] - header['ids_offset'])
+
+    n_ids, n_edges = header['n_ids'], header['n_edges']
+    ids = id_bytes.rstrip(b'\0').decode('utf-8').split('\n') if n_ids > 0 else []
+
+    def _map(dtype, offset):
+        if n_edges == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=(n_edges,))
+
+    queries = _map('<i4', header['qry_offset'])
+    libs = _map('<i4', header['lib_offset'])
+    metrics = _map('<f4', header['metric_offset'])
+    return header, ids, queries, libs, metrics
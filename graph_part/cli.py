@@ -29,7 +29,11 @@ def get_args() -> argparse.Namespace:
                         )
     core_parser.add_argument("-th","--threshold",type=float, help='''The desired threshold, should be within the
                                                               bounds defined by the metric''',
-                        required=True,
+                        default=None,
+                        )
+    core_parser.add_argument("-ths","--thresholds",type=float, nargs='+', help='''Partition at multiple thresholds. The alignments are only
+                                                              computed once, at the loosest threshold. Replaces --threshold.''',
+                        default=None,
                         )
     core_parser.add_argument("-pa","--partitions",type=int, help='Number of partitions to generate.', 
                         default=5,
@@ -52,11 +56,26 @@ def get_args() -> argparse.Namespace:
                         default='slow-nn', 
                         choices=['slow-nn', 'fast-nn', 'simple'],
                         )
+    core_parser.add_argument("-lf","--largest-first",action='store_true', help='''Assign the mini-clusters to partitions from the largest
+                                                                            to the smallest instead of in the order they were formed.
+                                                                            Usually gives better balanced partitions.'''
+                        )
     core_parser.add_argument("-nm","--no-moving",action='store_true', help='''Disallows the removing procedure to relocate
                                                                             entities if it finds more within threshold 
                                                                             neighbours in another partition.'''
                         )
     
+    core_parser.add_argument("-gb","--graph-backend",type=str, help='''Data structure to hold the pairwise distances. `csr` uses compact
+                                                                    arrays and needs much less memory on large datasets.''',
+                        default='networkx',
+                        choices=['networkx', 'csr'],
+                        )
+    core_parser.add_argument("-rs","--metric-resolution",type=float, help='''Store the metrics of the `csr` backend as 16-bit fixed point numbers
+                                                                    at this resolution, e.g. 0.001. Halves the memory of the metrics and sorts
+                                                                    the edges for the linkage in linear time. Metrics are rounded to the resolution.''',
+                        default=None,
+                        )
+
     # train-val-test splits.
     core_parser.add_argument("-te","--test-ratio",type=float, default=0.0, help='The fraction of the data to use for testing. Incompatible with `partitions`.')
     core_parser.add_argument("-va","--val-ratio",type=float, default=0.0,help='The fraction of the data to use for validation. Incompatible with `partitions`.')
@@ -65,6 +84,10 @@ def get_args() -> argparse.Namespace:
     core_parser.add_argument('--save-checkpoint-path', '-sc', type=str, default=None, help='''Path to save the computed similarities above the threshold. 
                                                                                             Can be used later in the precomputed mode.'''
                         )
+    core_parser.add_argument('--checkpoint-format', '-cf', type=str, default='csv', help='''Format of the checkpoint. `binary` is much faster to save and load,
+                                                                                            but can only be read by Graph-Part.''',
+                        choices=['csv', 'binary'],
+                        )
 
 
     # Parsers for the different run modes.
@@ -97,6 +120,9 @@ def get_args() -> argparse.Namespace:
     # Flags
     parser_needle.add_argument("-nu","--nucleotide", action='store_true', help= 'Input contains nucleotide sequences (Default is proteins).')
     parser_needle.add_argument("-tr","--triangular", action='store_true', help='Only compute triangular part of full distance matrix.')
+    parser_needle.add_argument("-pr","--prefilter", action='store_true', help= 'Only align pairs of sequences that share k-mers instead of forcing all-vs-all alignments.')
+    parser_needle.add_argument("-kl","--kmer-length",type=int, help='Length of the k-mers for --prefilter. Defaults to 4 for proteins and 11 for nucleotides.', default=None)
+    parser_needle.add_argument("-ks","--min-shared-kmers",type=int, help='Number of distinct k-mers two sequences need to share to be aligned with --prefilter. Lower values are more sensitive. Defaults to 3.', default=None)
 
     # optimize runtime
     parser_needle.add_argument("-nt","--threads",type=int, help='Number of threads to run in parallel.', default=1)
@@ -113,11 +139,21 @@ def get_args() -> argparse.Namespace:
     parser_needle.add_argument('--endopen','-endopen', type=float, default=10, help='Passed to needle. See EMBOSS documentation.')
     parser_needle.add_argument('--endextend','-endextend', type=float, default=0.5, help='Passed to needle. See EMBOSS documentation.')
     parser_needle.add_argument('--matrix', '--datafile','-datafile', type=str, default='EBLOSUM62', help='Passed to needle. See EMBOSS documentation.')
+    parser_needle.add_argument('--aligner', '-al', type=str, default='needleall', choices=['needleall', 'builtin'],
+                                help='Use EMBOSS needleall or the builtin aligner for Needleman-Wunsch alignments.')
+    parser_needle.add_argument("-pc","--previous-checkpoint",type=str, help='Binary checkpoint of an earlier run on part of the sequences. Its alignments are reused, only sequences that are not in it are aligned.', default=None)
+    parser_needle.add_argument("-po","--previous-output",type=str, help='Output file of the earlier run of --previous-checkpoint. Its partitions are kept, and only the new sequences are assigned to them.', default=None)
+    parser_needle.add_argument("-ac","--alignment-cache",type=str, help='SQLite file that keeps the pairwise alignments across runs. Pairs that were aligned before are read from it, new pairs are added.', default=None)
 
 
     # 4. Arguments that are only required with mmseqs2.
     parser_mmseqs2.add_argument("-nu","--nucleotide", action='store_true', help= 'Input contains nucleotide sequences (Default is proteins).')
     parser_mmseqs2.add_argument("-pr","--prefilter", action='store_true', help= 'Use the mmseqs2 prefiltering procedure instead of forcing all-vs-all alignments.')
+    parser_mmseqs2.add_argument("-nt","--threads",type=int, help='Number of threads for MMseqs2. Defaults to all available cores.', default=None)
+    parser_mmseqs2.add_argument("-sm","--split-memory-limit",type=str, help='Memory limit for the MMseqs2 prefilter, e.g. 10G. Defaults to all available memory.', default=None)
+    parser_mmseqs2.add_argument("-cd","--cache-dir",type=str, help='Directory in which to keep the MMseqs2 databases and alignments for later runs on the same fasta file. By default, they are deleted after the run.', default=None)
+    parser_mmseqs2.add_argument("-kl","--kmer-length",type=int, help='Length of the k-mers for --min-shared-kmers. Defaults to 4.', default=None)
+    parser_mmseqs2.add_argument("-ks","--min-shared-kmers",type=int, help='Without --prefilter, only align pairs of sequences that share this many distinct k-mers. By default, all pairs are aligned.', default=None)
     parser_mmseqs2.add_argument("-dn","--denominator",type=str, help='Denominator to use for sequence identity computation.', 
                         choices=['shortest', 'longest', 'n_aligned'], 
                         default='shortest',
@@ -130,6 +166,7 @@ def get_args() -> argparse.Namespace:
                         default='full',
                         )
     parser_mmseqs2needle.add_argument("-re","--recompute-threshold",type=float, help='Threshold under which to recompute alignments using needle.')
+    parser_mmseqs2needle.add_argument("-mr","--miss-rate",type=float, help='Calibrate the recompute threshold on a sample of pairs, so that at most this fraction of edges is expected to be missed. --recompute-threshold is then the lowest threshold considered.', default=None)
     # Flags
     parser_mmseqs2needle.add_argument("-nu","--nucleotide", action='store_true', help= 'Input contains nucleotide sequences (Default is proteins).')
     parser_mmseqs2needle.add_argument("-tr","--triangular", action='store_true', help='Only compute triangular part of full distance matrix.')
@@ -149,10 +186,17 @@ def get_args() -> argparse.Namespace:
     parser_mmseqs2needle.add_argument('--endopen','-endopen', type=float, default=10, help='Passed to needle. See EMBOSS documentation.')
     parser_mmseqs2needle.add_argument('--endextend','-endextend', type=float, default=0.5, help='Passed to needle. See EMBOSS documentation.')
     parser_mmseqs2needle.add_argument('--matrix', '--datafile','-datafile', type=str, default='EBLOSUM62', help='Passed to needle. See EMBOSS documentation.')
+    parser_mmseqs2needle.add_argument('--aligner', '-al', type=str, default='needleall', choices=['needleall', 'builtin'],
+                                help='Use EMBOSS needleall or the builtin aligner for Needleman-Wunsch alignments.')
+    parser_mmseqs2needle.add_argument("-ac","--alignment-cache",type=str, help='SQLite file that keeps the pairwise alignments across runs. Pairs that were aligned before are read from it, new pairs are added.', default=None)
 
 
     # mmseqs2.
     parser_mmseqs2needle.add_argument("-pr","--prefilter", action='store_true', help= 'Use the mmseqs2 prefiltering procedure instead of forcing all-vs-all alignments.')
+    parser_mmseqs2needle.add_argument("-sm","--split-memory-limit",type=str, help='Memory limit for the MMseqs2 prefilter, e.g. 10G. Defaults to all available memory.', default=None)
+    parser_mmseqs2needle.add_argument("-cd","--cache-dir",type=str, help='Directory in which to keep the MMseqs2 databases and alignments for later runs on the same fasta file. By default, they are deleted after the run.', default=None)
+    parser_mmseqs2needle.add_argument("-kl","--kmer-length",type=int, help='Length of the k-mers for --min-shared-kmers. Defaults to 4.', default=None)
+    parser_mmseqs2needle.add_argument("-ks","--min-shared-kmers",type=int, help='Without --prefilter, only align pairs of sequences that share this many distinct k-mers. By default, all pairs are aligned.', default=None)
     parser_mmseqs2needle.add_argument("-dnm","--denominator-mmseqs",type=str, help='Denominator to use for sequence identity computation.', 
                         choices=['shortest', 'longest', 'n_aligned'], 
                         default='shortest',
@@ -160,6 +204,9 @@ def get_args() -> argparse.Namespace:
 
     args =  parser.parse_args()
 
+    if args.threshold is None and args.thresholds is None:
+        parser.error('One of the arguments -th/--threshold or -ths/--thresholds is required.')
+
 
     # Perform checks
     def create_dir_or_fail(file_path: str) -> None:
@@ -0,0 +1,252 @@
+'''
+Component-wise parallel execution of the linkage and removal steps.
+
+Connected components of the graph do not interact in the restricted
+linkage, and moving an entity or updating its between-partition
+connectivity only touches its own component. The components are
+therefore packed into groups of about equal size, one per process.
+
+The linkage runs on each group in a process pool, and the mini-clusters
+of the groups are merged before the global `partition_assignment`.
+The removal keeps one RemovalEngine per group in a worker process for
+all rounds. Each round, the workers move entities and update their
+counts, and the parent only selects the most problematic entities
+across all groups. Both give the same results as the serial versions.
+'''
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .linkage import restricted_linkage, number_clusters
+from .removal import RemovalEngine
+
+
+# graphs with fewer edges are processed serially.
+MIN_PARALLEL_EDGES = 1000000
+
+
+def connected_components(queries: np.ndarray, libs: np.ndarray, n: int) -> np.ndarray:
+    '''
+    Component of each of n nodes, as the smallest node id in it.
+    Hooks the roots of the edge ends onto each other and shortens the
+    pointers until all edges are within a component.
+    '''
+    comp = np.arange(n)
+    while True:
+        lo = np.minimum(comp[queries], comp[libs])
+        hi = np.maximum(comp[queries], comp[libs])
+        crossing = lo != hi
+        if not crossing.any():
+            return comp
+        np.minimum.at(comp, hi[crossing], lo[crossing])
+        while True:
+            jumped = comp[comp]
+            if np.array_equal(jumped, comp):
+                break
+            comp = jumped
+
+
+def component_groups(queries: np.ndarray, libs: np.ndarray, n: int, n_groups: int,
+                     min_edges: int = MIN_PARALLEL_EDGES) -> Optional[List[np.ndarray]]:
+    '''
+    Pack the connected components of a graph with n nodes into up to n_groups
+    groups with about the same number of nodes and edges, largest first.
+    Returns the sorted node ids of each group, or None if the graph is too
+    small or has too few components to gain from processing them in parallel.
+    '''
+    if n_groups < 2 or len(queries) < min_edges:
+        return None
+    comp = connected_components(queries, libs, n)
+    roots, comp = np.unique(comp, return_inverse=True)
+    if len(roots) < 2:
+        return None
+    weights = np.bincount(comp, minlength=len(roots)) + np.bincount(comp[queries], minlength=len(roots))
+
+    # greedy packing onto the lightest group.
+    loads = [(0, g) for g in range(min(n_groups, len(roots)))]
+    group_of_comp = np.zeros(len(roots), dtype=np.int64)
+    for c in np.argsort(-weights, kind='stable').tolist():
+        load, g = heapq.heappop(loads)
+        group_of_comp[c] = g
+        heapq.heappush(loads, (load + int(weights[c]), g))
+
+    group_of_node = group_of_comp[comp]
+    return [np.flatnonzero(group_of_node == g) for g in range(len(loads))]
+
+
+def _split_edges(queries: np.ndarray, libs: np.ndarray, n: int, groups: List[np.ndarray]):
+    '''
+    Edge positions of each group and the edges in local node ids of the group.
+    Edges keep their order within a group.
+    '''
+    group_of_node = np.zeros(n, dtype=np.int64)
+    local_index = np.zeros(n, dtype=np.int64)
+    for g, nodes in enumerate(groups):
+        group_of_node[nodes] = g
+        local_index[nodes] = np.arange(len(nodes))
+    order = np.argsort(group_of_node[queries], kind='stable')
+    bounds = np.searchsorted(group_of_node[queries][order], np.arange(len(groups) + 1))
+    for g in range(len(groups)):
+        positions = order[bounds[g]:bounds[g+1]]
+        yield positions, local_index[queries[positions]], local_index[libs[positions]]
+
+
+def _group_linkage(queries: np.ndarray, libs: np.ndarray, label_vals: np.ndarray,
+                   part_size: int, label_limits: np.ndarray) -> np.ndarray:
+    '''Restricted linkage of one group. Returns the local root of each node.'''
+    return restricted_linkage(queries, libs, label_vals, part_size, label_limits, progress=False).roots()
+
+
+def parallel_linkage(queries: np.ndarray,
+                     libs: np.ndarray,
+                     label_vals: np.ndarray,
+                     part_size: int,
+                     label_limits: np.ndarray,
+                     groups: List[np.ndarray]) -> np.ndarray:
+    '''
+    `restricted_linkage` on each group of `component_groups` in a process pool.
+    The edges need to be sorted and cut at the threshold, as for the serial version.
+    Returns the mini-cluster number of each node, as `DisjointSet.clusters` does.
+    '''
+    label_vals = np.asarray(label_vals)
+    roots = np.arange(len(label_vals))
+    with ProcessPoolExecutor(len(groups)) as executor:
+        futures = [(nodes, executor.submit(_group_linkage, qry, lib, label_vals[nodes], part_size, label_limits))
+                   for nodes, (_, qry, lib) in zip(groups, _split_edges(queries, libs, len(label_vals), groups))]
+        for nodes, future in futures:
+            roots[nodes] = nodes[future.result()]
+    return number_clusters(roots)
+
+
+def _removal_worker(conn, args) -> None:
+    '''Keep a RemovalEngine of one group and run the commands of ParallelRemovalEngine.'''
+    try:
+        engine = RemovalEngine(*args)
+        while True:
+            command, arg = conn.recv()
+            if command == 'move':
+                conn.send(engine.move_nodes())
+            elif command == 'update':
+                engine.update()
+                conn.send((engine.bc_sum, engine.bc_count, engine.min_threshold()))
+            elif command == 'peek':
+                nodes = engine.most_problematic(arg, keep=True)
+                conn.send([(-int(engine.between_connectivity[node]), node) for node in nodes])
+            elif command == 'remove':
+                engine.remove(arg)
+                conn.send((engine.n_alive, engine.n_edges))
+            elif command == 'finish':
+                conn.send((engine.partitions, engine.between_connectivity, engine.alive))
+                return
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+
+class ParallelRemovalEngine():
+    '''
+    RemovalEngine over the groups of `component_groups`, with one worker
+    process per group. Has the interface of RemovalEngine, and the same
+    parameters plus the groups. The partitions, between_connectivity and
+    alive arrays are collected from the workers on `close`.
+    '''
+    def __init__(self,
+                 queries: np.ndarray,
+                 libs: np.ndarray,
+                 metrics: np.ndarray,
+                 partitions: np.ndarray,
+                 priority: np.ndarray,
+                 threshold: float,
+                 ignore_priority: bool = True,
+                 fixed: np.ndarray = None,
+                 neighbour_ranks: Tuple[np.ndarray, np.ndarray] = None,
+                 groups: List[np.ndarray] = None) -> None:
+
+        n = len(partitions)
+        self.groups = groups
+        self.partitions = np.asarray(partitions, dtype=np.int64).copy()
+        self.between_connectivity = np.zeros(n, dtype=np.int64)
+        self.alive = np.ones(n, dtype=bool)
+        self.n_alive = n
+        self.n_edges = len(queries)
+        self.bc_sum = 0
+        self.bc_count = 0
+        self._min_threshold = 1
+
+        self._group_of_node = np.zeros(n, dtype=np.int64)
+        self._local_index = np.zeros(n, dtype=np.int64)
+        self._conns = []
+        self._procs = []
+        for g, (nodes, (positions, qry, lib)) in enumerate(zip(groups, _split_edges(queries, libs, n, groups))):
+            self._group_of_node[nodes] = g
+            self._local_index[nodes] = np.arange(len(nodes))
+            args = (qry, lib, metrics[positions], self.partitions[nodes], np.asarray(priority)[nodes], threshold,
+                    ignore_priority, None if fixed is None else np.asarray(fixed)[nodes],
+                    None if neighbour_ranks is None else (neighbour_ranks[0][positions], neighbour_ranks[1][positions]))
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_removal_worker, args=(child_conn, args), daemon=True)
+            proc.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._procs.append(proc)
+
+    def _call(self, command: str, args: list) -> list:
+        '''Send a command to all workers, so that they run in parallel, then collect the replies.'''
+        for conn, arg in zip(self._conns, args):
+            conn.send((command, arg))
+        replies = [conn.recv() for conn in self._conns]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def move_nodes(self) -> int:
+        return sum(self._call('move', [None] * len(self._conns)))
+
+    def update(self) -> None:
+        replies = self._call('update', [None] * len(self._conns))
+        self.bc_sum = sum(bc_sum for bc_sum, _, _ in replies)
+        self.bc_count = sum(bc_count for _, bc_count, _ in replies)
+        self._min_threshold = min(min_threshold for _, _, min_threshold in replies)
+
+    def min_threshold(self) -> float:
+        return self._min_threshold
+
+    def most_problematic(self, n: int) -> List[int]:
+        '''
+        The n nodes with the highest between-partition connectivity. Each group
+        proposes its best n, ties are resolved by node id as in RemovalEngine.
+        '''
+        candidates = []
+        for nodes, proposals in zip(self.groups, self._call('peek', [n] * len(self._conns))):
+            candidates.extend((neg_bc, int(nodes[node])) for neg_bc, node in proposals)
+        return [node for _, node in heapq.nsmallest(n, candidates)]
+
+    def remove(self, nodes: List[int]) -> None:
+        nodes = np.asarray(nodes, dtype=np.int64)
+        groups = self._group_of_node[nodes]
+        local = self._local_index[nodes]
+        replies = self._call('remove', [local[groups == g].tolist() for g in range(len(self._conns))])
+        self.n_alive = sum(n_alive for n_alive, _ in replies)
+        self.n_edges = sum(n_edges for _, n_edges in replies)
+
+    def close(self) -> None:
+        '''Collect the results of the workers and stop them.'''
+        if not self._conns:
+            return
+        try:
+            for nodes, (partitions, between_connectivity, alive) in zip(self.groups, self._call('finish', [None] * len(self._conns))):
+                self.partitions[nodes] = partitions
+                self.between_connectivity[nodes] = between_connectivity
+                self.alive[nodes] = alive
+        finally:
+            for conn, proc in zip(self._conns, self._procs):
+                conn.close()
+                proc.join(timeout=10)
+                if proc.is_alive():
+                    proc.terminate()
+            self._conns, self._procs = [], []
@@ -0,0 +1,439 @@
+'''
+Compact, array-backed graph that can replace the networkx full_graph.
+
+networkx stores a Python dict per edge, which costs hundreds of bytes
+per edge and does not scale to 100M+ edges. CSRGraph stores the edges
+in compressed sparse row (CSR) layout instead: node ids are integers,
+`indptr` holds the row offsets, `indices` the neighbours and `metric`
+the edge weights as float32.
+
+CSRGraph implements the subset of the networkx.Graph interface that
+Graph-Part uses on the full_graph, so all downstream functions can run
+against either backend.
+'''
+import math
+from array import array
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+
+class CSRGraph():
+    '''
+    Undirected graph with integer node ids and edges in CSR layout.
+
+    Edges are collected in append-only buffers and compacted into the
+    CSR arrays the first time the graph is queried. As in the loaders for
+    the networkx backend, an edge that is added more than once keeps its
+    smallest metric. Removed nodes are masked instead of deleted, so that
+    node ids stay stable.
+
+    Metrics are stored in single precision. Compare them to thresholds
+    that were rounded to single precision as well, see `metric_threshold`.
+
+    With a resolution, metrics are stored as uint16 multiples of it
+    instead, see `quantise_metrics`. The metrics that the graph returns
+    are rounded to the resolution, and `edge_arrays` can return the
+    integer codes, which sort in linear time.
+    '''
+    def __init__(self, resolution: float = None) -> None:
+        self.resolution = resolution
+        metric_type = 'f' if resolution is None else 'H'
+
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self._node_data: List[Dict[str, Any]] = []
+        self._alive = np.ones(0, dtype=bool)
+
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.metric = np.zeros(0, dtype=np.float32 if resolution is None else np.uint16)
+        self._n_edges = 0
+        self._has_tombstones = False
+        self._dirty = False
+
+        # edges that were added since the last compaction.
+        self._pending_u = array('i')
+        self._pending_v = array('i')
+        self._pending_m = array(metric_type)
+        self._pending_chunks: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+        self.nodes = _NodeView(self)
+        self.edges = _EdgeView(self)
+
+    # Nodes
+
+    def add_node(self, node: str, **attr) -> None:
+        if node in self.index:
+            self._node_data[self.index[node]].update(attr)
+            return
+        self.index[node] = len(self.ids)
+        self.ids.append(node)
+        self._node_data.append(dict(attr))
+        self._dirty = True
+
+    def has_node(self, node: str) -> bool:
+        idx = self.index.get(node)
+        return idx is not None and bool(self.alive[idx])
+
+    def number_of_nodes(self) -> int:
+        return int(self.alive.sum())
+
+    def remove_nodes_from(self, nodes) -> None:
+        self._compact_if_needed()
+        alive = self.alive
+        for node in nodes:
+            idx = self.index.get(node)
+            if idx is None or not alive[idx]:
+                continue
+            alive[idx] = False
+            lo, hi = self.indptr[idx], self.indptr[idx+1]
+            nbs = self.indices[lo:hi]
+            self._n_edges -= int(np.count_nonzero(alive[nbs] & self._present(self.metric[lo:hi])))
+
+    @property
+    def alive(self) -> np.ndarray:
+        '''Boolean mask of the nodes that have not been removed.'''
+        if len(self._alive) != len(self.ids):
+            grown = np.ones(len(self.ids), dtype=bool)
+            grown[:len(self._alive)] = self._alive
+            self._alive = grown
+        return self._alive
+
+    # Edges
+
+    def add_edge(self, qry: str, lib: str, metric: float) -> None:
+        '''Add an edge. If the edge exists, keep the smaller metric.'''
+        u, v = self.index[qry], self.index[lib]
+        if self.resolution is not None:
+            metric = int(quantise_metrics(metric, self.resolution))
+        if not self._dirty:
+            pos = self._find(u, v)
+            if pos >= 0:
+                # update in place, no need to wait for the next compaction.
+                if not self._present(self.metric[pos]):
+                    self._n_edges += 1
+                if not self.metric[pos] <= metric:
+                    self.metric[pos] = metric
+                    self.metric[self._find(v, u)] = metric
+                return
+        self._pending_u.append(u)
+        self._pending_v.append(v)
+        self._pending_m.append(metric)
+        self._dirty = True
+
+    def add_edges_from_arrays(self, qry_idx: np.ndarray, lib_idx: np.ndarray, metrics: np.ndarray) -> None:
+        '''Bulk version of `add_edge` that takes integer node ids.'''
+        metrics = np.asarray(metrics, dtype=np.float32) if self.resolution is None else quantise_metrics(metrics, self.resolution)
+        self._pending_chunks.append((np.asarray(qry_idx, dtype=np.int32),
+                                     np.asarray(lib_idx, dtype=np.int32),
+                                     metrics))
+        self._dirty = True
+
+    def has_edge(self, qry: str, lib: str) -> bool:
+        if not self.has_node(qry) or not self.has_node(lib):
+            return False
+        self._compact_if_needed(tombstones=False)
+        pos = self._find(self.index[qry], self.index[lib])
+        return pos >= 0 and bool(self._present(self.metric[pos]))
+
+    def remove_edge(self, qry: str, lib: str) -> None:
+        if not self.has_edge(qry, lib):
+            raise KeyError(f'The edge {qry}-{lib} is not in the graph.')
+        u, v = self.index[qry], self.index[lib]
+        # mark as removed, dropped at the next compaction.
+        removed = np.inf if self.resolution is None else REMOVED_CODE
+        self.metric[self._find(u, v)] = removed
+        self.metric[self._find(v, u)] = removed
+        self._n_edges -= 1
+        self._has_tombstones = True
+
+    def number_of_edges(self) -> int:
+        self._compact_if_needed(tombstones=False)
+        return self._n_edges
+
+    def neighbors(self, node: str) -> Iterator[str]:
+        return iter(self[node])
+
+    def __getitem__(self, node: str) -> '_AdjacencyView':
+        self._compact_if_needed()
+        return _AdjacencyView(self, self.index[node])
+
+    def __len__(self) -> int:
+        return self.number_of_nodes()
+
+    def __contains__(self, node: str) -> bool:
+        return self.has_node(node)
+
+    def edge_arrays(self, quantised: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Get all edges between alive nodes as arrays (qry, lib, metric),
+        with qry < lib. Node ids index into `ids`.
+        With quantised, the metrics are the uint16 codes of a graph with a resolution.
+        '''
+        self._compact_if_needed()
+        rows = np.repeat(np.arange(len(self.ids), dtype=np.int32), np.diff(self.indptr))
+        alive = self.alive
+        mask = (rows < self.indices) & alive[rows] & alive[self.indices]
+        if quantised:
+            if self.resolution is None:
+                raise ValueError('The graph does not store quantised metrics.')
+            return rows[mask], self.indices[mask], self.metric[mask]
+        return rows[mask], self.indices[mask], self._decode(self.metric[mask])
+
+    # Internals
+
+    def _present(self, metric: np.ndarray) -> np.ndarray:
+        '''Whether stored metrics belong to edges that were not removed.'''
+        return np.isfinite(metric) if self.resolution is None else metric != REMOVED_CODE
+
+    def _decode(self, metric: np.ndarray) -> np.ndarray:
+        '''Stored metrics as float32.'''
+        return metric if self.resolution is None else dequantise_metrics(metric, self.resolution)
+
+    def _find(self, u: int, v: int) -> int:
+        '''Position of edge u-v in `indices`, -1 if absent.'''
+        lo = self.indptr[u]
+        row = self.indices[lo:self.indptr[u+1]]
+        pos = row.searchsorted(v)
+        if pos < len(row) and row[pos] == v:
+            return int(lo + pos)
+        return -1
+
+    def _compact_if_needed(self, tombstones: bool = True) -> None:
+        if self._dirty or (tombstones and self._has_tombstones):
+            self._compact()
+
+    def _compact(self) -> None:
+        '''Merge the pending edges into the CSR arrays and drop removed ones.'''
+        n = len(self.ids)
+        alive = self.alive
+        old_rows = np.repeat(np.arange(len(self.indptr)-1, dtype=np.int32), np.diff(self.indptr))
+        upper = old_rows < self.indices
+
+        qry = [old_rows[upper], np.frombuffer(self._pending_u, dtype=np.int32)] + [c[0] for c in self._pending_chunks]
+        lib = [self.indices[upper], np.frombuffer(self._pending_v, dtype=np.int32)] + [c[1] for c in self._pending_chunks]
+        met = [self.metric[upper], np.frombuffer(self._pending_m, dtype=self.metric.dtype)] + [c[2] for c in self._pending_chunks]
+        qry, lib, met = np.concatenate(qry), np.concatenate(lib), np.concatenate(met)
+        self._pending_u, self._pending_v, self._pending_m = array('i'), array('i'), array(self._pending_m.typecode)
+        self._pending_chunks = []
+
+        lo, hi = np.minimum(qry, lib), np.maximum(qry, lib)
+        keep = (lo != hi) & self._present(met) & alive[lo] & alive[hi]
+        lo, hi, met = lo[keep], hi[keep], met[keep]
+
+        # keep the minimum metric of each pair.
+        key = lo.astype(np.int64) * n + hi
+        order = np.lexsort((met, key))
+        key = key[order]
+        first = np.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        order = order[first]
+        lo, hi, met = lo[order], hi[order], met[order]
+
+        # both directions, neighbours sorted within each row for binary search.
+        src = np.concatenate((lo, hi))
+        dst = np.concatenate((hi, lo))
+        order = np.lexsort((dst, src))
+        self.indices = dst[order]
+        self.metric = np.concatenate((met, met))[order]
+        self.indptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self._n_edges = len(lo)
+        self._has_tombstones = False
+        self._dirty = False
+
+
+def insert_edge(graph, qry: str, lib: str, metric: float) -> None:
+    '''
+    Insert an edge into a graph of either backend, keeping the smaller
+    metric if the edge already exists. For CSRGraph this is deferred to the
+    next compaction, so that loaders do not need to query the graph.
+    '''
+    if isinstance(graph, CSRGraph):
+        graph.add_edge(qry, lib, metric=metric)
+    elif graph.has_edge(qry, lib):
+        if graph[qry][lib]['metric'] > metric:
+            graph.add_edge(qry, lib, metric=metric) #Notes: Adding an edge that already exists updates the edge data.
+    else:
+        graph.add_edge(qry, lib, metric=metric)
+
+
+def insert_edges(graph, nodes: List[str], qry_idx: np.ndarray, lib_idx: np.ndarray, metrics: np.ndarray) -> None:
+    '''
+    Bulk version of `insert_edge`. qry_idx and lib_idx are integer ids
+    into nodes, which for CSRGraph needs to be `graph.ids`.
+    Edges that occur more than once keep the smallest metric.
+    '''
+    if isinstance(graph, CSRGraph):
+        graph.add_edges_from_arrays(qry_idx, lib_idx, metrics)
+        return
+    if len(qry_idx) == 0:
+        return
+
+    # only the smallest metric of each pair needs to reach the graph.
+    # pairs are inserted in order of their first occurrence, like edge by edge insertion would.
+    key = np.minimum(qry_idx, lib_idx).astype(np.int64) * len(nodes) + np.maximum(qry_idx, lib_idx)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+    min_metrics = np.minimum.reduceat(metrics[order], starts)
+    first = order[starts]
+    by_occurrence = np.argsort(first)
+    first, min_metrics = first[by_occurrence], min_metrics[by_occurrence]
+    for qry, lib, metric in zip(qry_idx[first].tolist(), lib_idx[first].tolist(), min_metrics.tolist()):
+        insert_edge(graph, nodes[qry], nodes[lib], metric)
+
+
+class EdgeBuffer():
+    '''
+    Append-only buffer of edges as integer ids and metrics, for alignment
+    workers to collect their results in. An edge takes 16 bytes instead of
+    a tuple of Python objects. The buffer can be returned from a worker process.
+    '''
+    def __init__(self) -> None:
+        self.qry = array('i')
+        self.lib = array('i')
+        self.metric = array('d')
+
+    def append(self, qry: int, lib: int, metric: float) -> None:
+        self.qry.append(qry)
+        self.lib.append(lib)
+        self.metric.append(metric)
+
+    def __len__(self) -> int:
+        return len(self.qry)
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''The buffer as (qry_idx, lib_idx, metrics) arrays, without copying.'''
+        return (np.frombuffer(self.qry, dtype=np.intc),
+                np.frombuffer(self.lib, dtype=np.intc),
+                np.frombuffer(self.metric, dtype=np.float64))
+
+def metric_threshold(threshold: float, resolution: float = None) -> float:
+    '''
+    Round a threshold to the precision that CSRGraph stores metrics in.
+    This way, a metric that is exactly at the threshold still compares as equal.
+    For a graph with a resolution, the threshold is rounded to it first.
+    '''
+    if resolution is not None:
+        return float(dequantise_metrics(quantise_metrics(threshold, resolution), resolution))
+    return float(np.float32(threshold))
+
+
+# largest code of a quantised metric. The code above it marks removed edges.
+MAX_CODE = np.iinfo(np.uint16).max - 1
+REMOVED_CODE = MAX_CODE + 1
+
+
+def quantise_metrics(metrics: np.ndarray, resolution: float) -> np.ndarray:
+    '''
+    Round metrics to the nearest multiple of resolution, as uint16 codes.
+    Metrics need to be between 0 and MAX_CODE * resolution.
+    '''
+    codes = np.rint(np.asarray(metrics, dtype=np.float64) / resolution)
+    if codes.size > 0 and not (codes.min() >= 0 and codes.max() <= MAX_CODE):
+        raise ValueError(f'Quantised metrics need to be between 0 and {MAX_CODE * resolution}, '
+                         f'got {np.min(metrics)} to {np.max(metrics)}. Use a coarser resolution.')
+    return codes.astype(np.uint16)
+
+
+def dequantise_metrics(codes: np.ndarray, resolution: float) -> np.ndarray:
+    '''Metrics of uint16 codes, in single precision.'''
+    return (np.asarray(codes, dtype=np.float64) * resolution).astype(np.float32)
+
+
+class _NodeView():
+    '''Mimics networkx' G.nodes: callable, iterable and subscriptable.'''
+    def __init__(self, graph: CSRGraph) -> None:
+        self._graph = graph
+
+    def __call__(self, data: bool = False):
+        g = self._graph
+        alive = g.alive
+        if data:
+            return ((g.ids[i], g._node_data[i]) for i in np.flatnonzero(alive))
+        return (g.ids[i] for i in np.flatnonzero(alive))
+
+    def __iter__(self) -> Iterator[str]:
+        return self()
+
+    def __len__(self) -> int:
+        return self._graph.number_of_nodes()
+
+    def __contains__(self, node: str) -> bool:
+        return self._graph.has_node(node)
+
+    def __getitem__(self, node: str) -> Dict[str, Any]:
+        return self._graph._node_data[self._graph.index[node]]
+
+
+class _EdgeView():
+    '''Mimics networkx' G.edges: callable and subscriptable with (qry, lib).'''
+    def __init__(self, graph: CSRGraph) -> None:
+        self._graph = graph
+
+    def __call__(self, data: bool = False):
+        g = self._graph
+        qry, lib, met = g.edge_arrays()
+        if data:
+            return ((g.ids[u], g.ids[v], {'metric': m}) for u, v, m in zip(qry.tolist(), lib.tolist(), met.tolist()))
+        return ((g.ids[u], g.ids[v]) for u, v in zip(qry.tolist(), lib.tolist()))
+
+    def __iter__(self):
+        return self()
+
+    def __len__(self) -> int:
+        return self._graph.number_of_edges()
+
+    def __getitem__(self, edge: Tuple[str, str]) -> Dict[str, float]:
+        qry, lib = edge
+        return self._graph[qry][lib]
+
+
+class _AdjacencyView():
+    '''Mimics networkx' G[node]: maps alive neighbours to their edge data.'''
+    def __init__(self, graph: CSRGraph, idx: int) -> None:
+        self._graph = graph
+        self._idx = idx
+
+    def _row(self) -> Tuple[np.ndarray, np.ndarray]:
+        g = self._graph
+        lo, hi = g.indptr[self._idx], g.indptr[self._idx+1]
+        nbs, met = g.indices[lo:hi], g.metric[lo:hi]
+        mask = g.alive[nbs] & g._present(met)
+        return nbs[mask], g._decode(met[mask])
+
+    def __iter__(self) -> Iterator[str]:
+        ids = self._graph.ids
+        return (ids[nb] for nb in self._row()[0].tolist())
+
+    def __len__(self) -> int:
+        return len(self._row()[0])
+
+    def _metric(self, node: str) -> float:
+        '''Metric of the edge to node, NaN if there is none.'''
+        g = self._graph
+        idx = g.index.get(node)
+        if idx is None or not g.alive[idx]:
+            return math.nan
+        pos = g._find(self._idx, idx)
+        if pos < 0:
+            return math.nan
+        if not g._present(g.metric[pos]):
+            return math.inf
+        return float(g._decode(g.metric[pos:pos+1])[0])
+
+    def __contains__(self, node: str) -> bool:
+        return math.isfinite(self._metric(node))
+
+    def __getitem__(self, node: str) -> Dict[str, float]:
+        metric = self._metric(node)
+        if not math.isfinite(metric):
+            raise KeyError(node)
+        return {'metric': metric}
+
+    def items(self):
+        ids = self._graph.ids
+        nbs, met = self._row()
+        return ((ids[nb], {'metric': m}) for nb, m in zip(nbs.tolist(), met.tolist()))
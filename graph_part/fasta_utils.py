@@ -0,0 +1,109 @@
+'''
+Parallel parsing of large FASTA files.
+
+Reading a multi-gigabyte FASTA file line by line in Python takes minutes,
+although only the headers are needed to load the entities. The file is
+memory-mapped instead and split into byte ranges that start at a header,
+so that each range holds whole records. Worker processes parse their
+ranges independently and the partial results are merged in file order.
+'''
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, Tuple
+
+import numpy as np
+
+
+# ranges smaller than this are not worth a process of their own.
+MIN_RANGE_BYTES = 16 * 2**20
+
+
+def record_ranges(fasta_fp: str, n_ranges: int, min_range_bytes: int = MIN_RANGE_BYTES) -> List[Tuple[int, int]]:
+    '''
+    Split a FASTA file into at most n_ranges byte ranges of about equal size.
+    All ranges but the first start at a '>' at the start of a line.
+    '''
+    size = os.path.getsize(fasta_fp)
+    if size == 0:
+        return []
+    n_ranges = max(1, min(n_ranges, size // min_range_bytes))
+    cuts = [0]
+    with open(fasta_fp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for k in range(1, n_ranges):
+            pos = mm.find(b'\n>', max(size * k // n_ranges - 1, cuts[-1]))
+            if pos < 0:
+                break
+            cuts.append(pos + 1)
+    cuts.append(size)
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if end > start]
+
+
+def _parse_headers(fasta_fp: str, start: int, end: int, priority_name: str, labels_name: str) -> Tuple[List[str], List[bool], np.ndarray, dict]:
+    '''
+    Parse the header lines in a byte range with `process_fasta`. As in
+    `load_entities`, a header is any line that contains '>'.
+    The label values refer to the labels table of the range.
+    '''
+    from .graph_part import process_fasta
+
+    ids, priority, label_vals = [], [], []
+    labels = {}
+    with open(fasta_fp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.find(b'>', start, end)
+        while pos >= 0:
+            line_start = mm.rfind(b'\n', start, pos) + 1 or start
+            line_end = mm.find(b'\n', pos, end)
+            line_end = end if line_end < 0 else line_end + 1
+            AC, node_data = process_fasta(mm[line_start:line_end].decode(), priority_name, labels_name, labels)
+            ids.append(AC)
+            priority.append(node_data['priority'])
+            label_vals.append(node_data['label-val'])
+
+            # skip the sequence lines.
+            pos = mm.find(b'>', line_end, end)
+
+    return ids, priority, np.array(label_vals, dtype=np.int64), labels
+
+
+def merge_label_tables(tables: List[dict], label_vals: List[np.ndarray]) -> Tuple[dict, List[np.ndarray]]:
+    '''
+    Merge the labels tables of consecutive ranges into one. Label values are
+    numbered in order of first occurrence in the file, as `process_fasta`
+    does, and the counts are summed. Returns the table and the label values
+    of each range, renumbered to it.
+    '''
+    labels = {}
+    merged_vals = []
+    for table, vals in zip(tables, label_vals):
+        remap = np.zeros(len(table), dtype=np.int64)
+        # dicts keep insertion order, which is the order of the values of the range.
+        for label, entry in table.items():
+            if label not in labels:
+                labels[label] = {'val': len(labels), 'num': 0}
+            labels[label]['num'] += entry['num']
+            remap[entry['val']] = labels[label]['val']
+        merged_vals.append(remap[vals])
+    return labels, merged_vals
+
+
+def parse_fasta_headers(fasta_fp: str, priority_name: str, labels_name: str, n_procs: int = 1) -> Tuple[List[str], List[bool], List[int], dict]:
+    '''
+    Parse all headers of a FASTA file, with n_procs processes for large files.
+    Returns the identifiers, priorities, label values and the labels table,
+    as `process_fasta` makes them.
+    '''
+    ranges = record_ranges(fasta_fp, n_procs)
+    if len(ranges) > 1:
+        with ProcessPoolExecutor(len(ranges)) as executor:
+            starts, ends = zip(*ranges)
+            parts = list(executor.map(_parse_headers, repeat(fasta_fp), starts, ends, repeat(priority_name), repeat(labels_name)))
+    else:
+        parts = [_parse_headers(fasta_fp, start, end, priority_name, labels_name) for start, end in ranges]
+
+    labels, label_vals = merge_label_tables([part[3] for part in parts], [part[2] for part in parts])
+    ids = [AC for part in parts for AC in part[0]]
+    priority = [p for part in parts for p in part[1]]
+    label_vals = np.concatenate(label_vals).tolist() if len(parts) > 0 else []
+    return ids, priority, label_vals, labels
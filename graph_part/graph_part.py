@@ -3,9 +3,10 @@
 import pandas as pd 
 import numpy as np
 import networkx as nx
-from typing import Dict, List, Tuple, Any, Union
+from typing import Dict, List, Tuple, Any, Union, Optional
 import time
-from collections import Counter
+import contextlib
+import functools
 from itertools import product
 import time
 
@@ -13,6 +14,13 @@ from tqdm import tqdm
 
 from .transformations import TRANSFORMATIONS
 from .train_val_test_split import train_val_test_split
+from .csr_graph import CSRGraph, metric_threshold, quantise_metrics
+from .linkage import restricted_linkage
+from .removal import RemovalEngine
+from .components import component_groups, parallel_linkage, ParallelRemovalEngine
+from .node_table import NodeTable
+from .sequence_store import SequenceStore
+from .fasta_utils import parse_fasta_headers
 
 """
 This program partitions an entity set according to a single pairwise distance metric
@@ -84,198 +92,197 @@ def process_fasta(line: str, priority_name:str, labels_name:str, labels: dict) -
     return AC, node_data
 
 
-def load_entities(entity_fp: str, priority_name: str, labels_name: str):
-    part_graph = nx.Graph()
-    full_graph = nx.Graph()
+def load_entities(entity_fp: str, priority_name: str, labels_name: str, graph_backend: str = 'networkx', n_procs: int = 1,
+                  metric_resolution: float = None):
+    # the full graph holds all the edges. For large datasets, use the compact array-backed graph.
+    if metric_resolution is not None and graph_backend != 'csr':
+        raise ValueError('Quantised metrics (--metric-resolution) need the csr graph backend.')
+    full_graph = CSRGraph(metric_resolution) if graph_backend == 'csr' else nx.Graph()
 
-    labels = {}
     with open(entity_fp) as inf:
-        processing_as = None
-        for line in inf:
-            if '>' in line and processing_as != 'csv':
-                AC, node_data = process_fasta(line, priority_name, labels_name, labels)
-                processing_as = 'fasta'
-            elif processing_as == 'fasta':
-                continue
-            else:
-                AC, node_data = process_csv(line)
-                processing_as = 'csv'
-
-            full_graph.add_node(AC)
-            nx.set_node_attributes(full_graph, {AC:node_data})
-            
-            part_graph.add_node(AC)
-
-    return full_graph, part_graph, labels
-
-
-def partition_assignment(cluster_vector, label_vector, n_partitions, n_class):
+        first_line = inf.readline()
+    if first_line and '>' not in first_line:
+        AC, node_data = process_csv(first_line)
+
+    ## Only the headers are parsed, large files by n_procs processes.
+    ids, priority, label_vals, labels = parse_fasta_headers(entity_fp, priority_name, labels_name, n_procs)
+    for AC, p, l in zip(ids, priority, label_vals):
+        full_graph.add_node(AC, **{'priority': p, 'label-val': l})
+
+    return full_graph, NodeTable.from_graph(full_graph), labels
+
+
+def partition_assignment(cluster_vector, label_vector, n_partitions, n_class, initial_counts=None, largest_first=False):
     ''' Function to separate proteins into N partitions with balanced classes 
-        Courtesy of José Juan Almagro Armenteros '''
+        Courtesy of José Juan Almagro Armenteros
+        initial_counts optionally holds the label counts that the partitions already have.
+        The label counts of all clusters are computed at once. Clusters are assigned in
+        order of their number, or with largest_first from the largest to the smallest. '''
     
-    # Unique cluster number
-    u_cluster = np.unique(cluster_vector)
+    # Unique cluster number, and the cluster of each protein as an index into it
+    u_cluster, inverse = np.unique(cluster_vector, return_inverse=True)
+    inverse = inverse.reshape(-1)
     
+    # Number of each class in each cluster
+    cl_counts = np.bincount(inverse * n_class + np.asarray(label_vector, dtype=np.int64),
+                            minlength=len(u_cluster) * n_class).reshape(len(u_cluster), n_class)
+
     # Initialize matrices
     loc_number = np.ones((n_partitions,n_class))
-    cl_number = np.zeros(cluster_vector.shape[0])
-    
-    for i in u_cluster:
-        # Extract the labels for the proteins in that cluster
-        positions = np.where(cluster_vector == i)
-        cl_labels = label_vector[positions]
-        
-        # Count number of each class
-        u, count = np.unique(cl_labels, return_counts=True)
-        
-        u = u.astype(np.int32)
-        temp_loc_number = np.copy(loc_number)
-        temp_loc_number[:,u] += count
-        loc_per = loc_number/temp_loc_number
+    if initial_counts is not None:
+        loc_number += initial_counts
+    cl_group = np.zeros(len(u_cluster), dtype=np.int64)
+
+    order = range(len(u_cluster))
+    if largest_first:
+        order = np.argsort(-cl_counts.sum(axis=1), kind='stable').tolist()
+
+    for i in order:
+        count = cl_counts[i]
+        # classes that are not in the cluster contribute a ratio of 1 to every partition.
+        loc_per = loc_number/(loc_number + count)
         best_group = np.argmin(np.sum(loc_per,axis=1))
-        loc_number[best_group,u] += count
+        loc_number[best_group] += count
         
         # Store the selected partition
-        cl_number[positions] = best_group
+        cl_group[i] = best_group
     
-    return cl_number
+    return cl_group[inverse]
         
 
-def partition_data(full_graph: nx.classes.graph.Graph, 
-                   part_graph: nx.classes.graph.Graph,
+def get_edge_arrays(full_graph: Union[nx.classes.graph.Graph, CSRGraph],
+                    node_index: Dict[str, int],
+                    quantised: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Get all edges of full_graph as arrays (queries, libs, metrics).
+    queries and libs hold integer node ids, as defined by node_index.
+    With quantised, metrics are the uint16 codes of a CSRGraph with a resolution.
+    '''
+    if isinstance(full_graph, CSRGraph):
+        queries, libs, metrics = full_graph.edge_arrays(quantised)
+        remap = np.array([node_index.get(AC, -1) for AC in full_graph.ids], dtype=np.int64)
+        return remap[queries], remap[libs], metrics
+
+    queries = []
+    libs = []
+    metrics = []
+    for qry, lib, data in full_graph.edges(data=True):
+        queries.append(node_index[qry])
+        libs.append(node_index[lib])
+        metrics.append(data['metric'])
+
+    return np.array(queries, dtype=np.int64), np.array(libs, dtype=np.int64), np.array(metrics)
+
+
+def get_neighbour_ranks(full_graph: Union[nx.classes.graph.Graph, CSRGraph],
+                        node_index: Dict[str, int],
+                        queries: np.ndarray,
+                        libs: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    '''
+    Position of each edge (queries[i], libs[i]) among the neighbours of its
+    query and among those of its lib, in the order in which full_graph lists
+    them. Returns None for a CSRGraph, which lists neighbours by id.
+    '''
+    if isinstance(full_graph, CSRGraph):
+        return None
+
+    n = len(node_index)
+    src = []
+    dst = []
+    for node, neighbours in full_graph.adj.items():
+        i = node_index[node]
+        for neighbour in neighbours:
+            src.append(i)
+            dst.append(node_index[neighbour])
+    src, dst = np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64)
+    if len(src) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # the neighbours of each node are listed together.
+    starts = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+    rank = np.arange(len(src)) - np.repeat(starts, np.diff(np.r_[starts, len(src)]))
+    key = src * n + dst
+    order = np.argsort(key)
+    qry_rank = rank[order[np.searchsorted(key, queries * n + libs, sorter=order)]]
+    lib_rank = rank[order[np.searchsorted(key, libs * n + queries, sorter=order)]]
+    return qry_rank, lib_rank
+
+
+def partition_data(full_graph: Union[nx.classes.graph.Graph, CSRGraph], 
+                   node_table: NodeTable,
                    labels: dict,
                    threshold: float,
                    nr_of_parts: int,
-                   mode: int):
+                   mode: int,
+                   largest_first: bool = False,
+                   n_procs: int = 1):
+    ''' Link the entities into mini-clusters and assign these to partitions.
+        With n_procs > 1, the connected components of large graphs are linked in parallel. '''
     part_size = full_graph.number_of_nodes()//nr_of_parts
 
     label_limits = np.array([x[1]['lim'] for x in sorted(labels.items(), key=lambda x:x[1]['val'] )])
     print(part_size, label_limits)
     
-    count = 0
-    ## AC, cluster, label
-    acs = []
-    clusters = []
-    labels = []
     print("Initialization mode", mode)
+    labels = node_table.label
 
-    ## Initialize the initialization
-    for ind, AC in tqdm(enumerate(part_graph.nodes()), desc='Initializing'):
-        label_counts = np.zeros(len(label_limits), dtype=int)
-        label_counts[full_graph.nodes[AC]['label-val']] = 1
-        cluster_nr = ind
-        
-        if mode == 'simple':
-            d = full_graph.nodes[AC]
-            acs.append(AC)
-            clusters.append(cluster_nr)
-            labels.append(d['label-val'])
-        nx.set_node_attributes(part_graph, {
-            AC:{
-                'cluster': cluster_nr,
-                'C-size': 1,
-                'label-counts': label_counts
-            }
-        })
+    ## Initialize the initialization, each entity is its own mini-cluster.
+    clusters = np.arange(len(node_table))
 
     ## Restricted closest neighbour linkage
     if mode in ['slow-nn', 'fast-nn']:
         ## Linking entities, if restrictions allow
-
-
         # NOTE sorting the networkx edges using sorted() becomes extremely slow on large graphs.
         # partly, because .edges takes forever to yield its EdgeView
         # workaround by instead extracting all the metric values into a numpy vector and argsorting this.
         # tested on ~400m edges, np.argsort 10 min vs. sorted() multiple hours
-        queries = []
-        libs = []
-        metrics = []
-                
         start = time.perf_counter()
 
-        for qry, lib, data in full_graph.edges(data=True):
-            queries.append(qry)
-            libs.append(lib)
-            metrics.append(data['metric'])
+        resolution = getattr(full_graph, 'resolution', None)
+        queries, libs, metrics = get_edge_arrays(full_graph, node_table.index, quantised=resolution is not None)
 
         elapsed_align = time.perf_counter() - start
         print(f"Edge iteration completed in {elapsed_align:0.2f} seconds.")
         
-        
-        metrics = np.array(metrics)
-        inds = np.argsort(metrics)
+        if resolution is not None:
+            ## Quantised metrics are uint16, for which numpy's stable sort is a linear-time radix sort.
+            inds = np.flatnonzero(metrics <= quantise_metrics(threshold, resolution))
+            inds = inds[np.argsort(metrics[inds], kind='stable')]
+        else:
+            inds = np.argsort(metrics)
+            ## No need to consider edges above the threshold.
+            inds = inds[:np.searchsorted(metrics[inds], threshold, side='right')]
         elapsed_align = time.perf_counter() - start
         print(f"Edge sorting competed at {elapsed_align:0.2f} seconds.")
-        for idx in tqdm(inds, desc='clustering'):
-            qry, lib = queries[idx], libs[idx]
-            data = full_graph.edges[qry, lib]
 
-            ### continue as below
+        # Union-find keeps the size and label counts of each mini-cluster at its root,
+        # so that merging does not need to touch all members of the mini-cluster.
+        groups = component_groups(queries[inds], libs[inds], len(node_table), n_procs)
+        if groups is not None:
+            print(f"Linking {len(groups)} groups of connected components in parallel.")
+            clusters = parallel_linkage(queries[inds], libs[inds], labels, part_size, label_limits, groups)
+        else:
+            forest = restricted_linkage(queries[inds], libs[inds], labels, part_size, label_limits)
+            clusters = forest.clusters()
 
-        # for qry, lib, data in tqdm(sorted(full_graph.edges(data=True), key=lambda x: x[2]['metric']), desc='Clustering'):
-            if data['metric'] > threshold:
-                ## No need to continue if threshold reached.
-                break
-            
-            if part_graph.has_edge(qry, lib):
-                ## Update edge if it exists
-                if part_graph[qry][lib]['metric'] > data['metric']:
-                    nx.set_edge_attributes(part_graph,{(qry,lib):data['metric']}, 'metric')
-                continue
-            
-            if part_graph.nodes[qry]['cluster'] == part_graph.nodes[lib]['cluster']:
-               continue
-
-            ## RESTRICTIONS!
-            if part_graph.nodes[qry]['C-size'] >= part_size:
-                continue
-            if part_graph.nodes[lib]['C-size'] >= part_size:
-                continue
-            if (part_graph.nodes[qry]['label-counts']+part_graph.nodes[lib]['label-counts'] >= label_limits).any():
-                continue
-            
-            ## Add edge and update mini-cluster
-            attr = part_graph.nodes[qry]
-            if attr['cluster'] != part_graph.nodes[lib]['cluster'] or mode == 'fast-nn':
-                attr['C-size'] += part_graph.nodes[lib]['C-size']
-                attr['label-counts'] += part_graph.nodes[lib]['label-counts']
-            nx.set_node_attributes(part_graph, {qry:attr})
-            part_graph.add_edge(qry, lib, metric=data['metric'])
-
-            for descendant in nx.descendants(part_graph, qry):
-                nx.set_node_attributes(part_graph, {descendant:attr})
-
-            count += 1
-            #if count % 10000 == 0:
-            #    print("edges:", part_graph.number_of_edges()) 
-            #    print (attr, data)
-        #with open('graph_part_miniclusters.txt','w+') as outf:
-        for cc_nr, cc in enumerate(nx.connected_components(part_graph)):
-            for n in cc:
-                d = full_graph.nodes[n]
-                acs.append(n)
-                clusters.append(cc_nr)
-                labels.append(d['label-val'])
-                    #outf.write("%s,%d\n" % (n,cc_nr))
-
-    acs = np.array(acs)
-    clusters = np.array(clusters)
-    labels = np.array(labels)
     print(len(np.unique(labels)))
-    partitioning = partition_assignment(clusters, labels, nr_of_parts, len(np.unique(labels)))
-    for ind, p in enumerate(partitioning):
-        attr = part_graph.nodes[acs[ind]]
-        attr['cluster'] = p
-        nx.set_node_attributes(part_graph,{acs[ind]:attr})
+    node_table.cluster[:] = clusters
+    node_table.partition[:] = partition_assignment(clusters, labels, nr_of_parts, len(np.unique(labels)), largest_first=largest_first)
 
 
-def remover( full_graph: nx.classes.graph.Graph, 
-             part_graph: nx.classes.graph.Graph, 
+def remover( full_graph: Union[nx.classes.graph.Graph, CSRGraph], 
+             node_table: NodeTable, 
              threshold:float, 
              json_dict: Dict[str, Any],
              move_to_most_neighbourly:bool = True, 
              ignore_priority:bool = True,
-             verbose: bool = True ):
+             verbose: bool = True,
+             fixed: set = None,
+             n_procs: int = 1 ):
+    ''' Move and remove entities until no edge below the threshold connects two partitions.
+        Entities in fixed are neither moved nor removed, and only the neighbourhoods
+        of the other entities are considered.
+        With n_procs > 1, the connected components of large graphs are processed in parallel. '''
 
     if ignore_priority:
         json_dict['removal_step_1'] = {}
@@ -286,63 +293,84 @@ def remover( full_graph: nx.classes.graph.Graph,
     
     if verbose:
         print("Min-threshold", "\t", "#Entities", "\t", "#Edges", "\t", "Connectivity", "\t", "#Problematics", "\t", "#Relocated", "\t", "#To-be-removed")
-    removing_round = 0
-    while True:
-        between_connectivity = {}
-        min_oc_wth= 1
-        number_moved = 0
-        for n,d in full_graph.nodes(data=True):
-            neighbours = nx.neighbors(full_graph,n)
-            neighbour_clusters = Counter((part_graph.nodes[nb]['cluster'] for nb in nx.neighbors(full_graph,n) if full_graph[n][nb]['metric'] < threshold))
-            cluster = part_graph.nodes[n]['cluster']
-            nb_oc_wth = []
-            
-            ## FIRST MOVE NODE TO CLUSTER WITH MOST NEIGHBOURS
-            if move_to_most_neighbourly:
-                if len(neighbour_clusters) > 0:
-                    most_neighbourly_cluster = max(neighbour_clusters.items(), key=lambda x:x[1])[0]
-                    if most_neighbourly_cluster != cluster:
-                        part_graph.nodes[n]['cluster'] = most_neighbourly_cluster
-                        number_moved += 1
-            
-            if ignore_priority and full_graph.nodes[n]['priority']:
-                between_connectivity[n] = 0
-                continue
-
-            for neighbour in neighbours:
-                nb_cluster = part_graph.nodes[neighbour]['cluster']
-                if nb_cluster != cluster and full_graph[n][neighbour]['metric'] < threshold:
-                    min_oc_wth = min(min_oc_wth, full_graph[n][neighbour]['metric'])
-                    nb_oc_wth.append(full_graph[n][neighbour]['metric'])
-
-            between_connectivity[n] = len(nb_oc_wth)
-            
-        nx.set_node_attributes(full_graph, between_connectivity, 'between_connectivity')
-        bc_sum = np.sum(np.fromiter((d['between_connectivity'] for n,d in full_graph.nodes(data=True)),int))
-        bc_count = np.sum(np.fromiter((1 for n,d in full_graph.nodes(data=True) if d['between_connectivity'] > 0),int))
-
-        removing_round += 1
-        number_to_remove = int(bc_count*np.log10(removing_round)/100)+1 # int(bc_count*0.01)+1
-        ## Remove 1% + 1 of the most problematic entities
-        remove_these = [x[0] for x in sorted(((n,d['between_connectivity']) for n,d in full_graph.nodes(data=True) if d['between_connectivity'] > 0), key=lambda x:x[1], reverse=True)[:number_to_remove]]
+
+    # The engine keeps the between-partition connectivity up to date as counters,
+    # so that each round only needs to touch the neighbourhoods of moved and removed entities.
+    acs = list(full_graph.nodes())
+    rows = node_table.indices(acs)
+    node_index = {AC: ind for ind, AC in enumerate(acs)}
+    queries, libs, metrics = get_edge_arrays(full_graph, node_index)
+    # ties in the moving step are resolved in the neighbour order of the graph.
+    ranks = get_neighbour_ranks(full_graph, node_index, queries, libs)
+    is_fixed = None
+    # fixed entities and edges that are left out, to report the counts of the full graph.
+    n_outside_nodes, n_outside_edges = 0, 0
+    if fixed is not None:
+        ## Only edges of entities that can change matter. Keep them and their neighbours.
+        is_fixed = np.array([AC in fixed for AC in acs], dtype=bool)
+        keep = ~is_fixed[queries] | ~is_fixed[libs]
+        nodes = np.union1d(np.flatnonzero(~is_fixed), np.concatenate((queries[keep], libs[keep])))
+        remap = np.full(len(acs), -1, dtype=np.int64)
+        remap[nodes] = np.arange(len(nodes))
+        n_outside_nodes, n_outside_edges = len(acs) - len(nodes), len(keep) - int(keep.sum())
+        queries, libs, metrics = remap[queries[keep]], remap[libs[keep]], metrics[keep]
+        ranks = None if ranks is None else (ranks[0][keep], ranks[1][keep])
+        acs, rows, is_fixed = [acs[i] for i in nodes], rows[nodes], is_fixed[nodes]
+
+    groups = component_groups(queries, libs, len(acs), n_procs)
+    engine_class = RemovalEngine if groups is None else functools.partial(ParallelRemovalEngine, groups=groups)
+    engine = engine_class(queries, libs, metrics,
+                          partitions = node_table.partition[rows],
+                          priority = node_table.priority[rows],
+                          threshold = threshold,
+                          ignore_priority = ignore_priority,
+                          fixed = is_fixed,
+                          neighbour_ranks = ranks)
+
+    # the parallel engine collects the results from its workers when it is closed.
+    with contextlib.closing(engine) if groups is not None else contextlib.nullcontext():
+        removing_round = 0
+        while True:
+            ## FIRST MOVE NODES TO CLUSTER WITH MOST NEIGHBOURS
+            number_moved = engine.move_nodes() if move_to_most_neighbourly else 0
+            engine.update()
+
+            min_oc_wth = engine.min_threshold()
+            bc_sum = engine.bc_sum
+            bc_count = engine.bc_count
+
+            removing_round += 1
+            number_to_remove = int(bc_count*np.log10(removing_round)/100)+1 # int(bc_count*0.01)+1
+            ## Remove 1% + 1 of the most problematic entities
+            remove_these = engine.most_problematic(number_to_remove)
+            n_entities = engine.n_alive + n_outside_nodes
+            n_edges = engine.n_edges + n_outside_edges
         
-        if verbose:
-            print(round(min_oc_wth,7), "\t\t", full_graph.number_of_nodes(), "\t\t", full_graph.number_of_edges(), "\t\t", bc_sum, "\t\t", bc_count, "\t\t", number_moved, "\t\t", len(remove_these))
+            if verbose:
+                print(round(min_oc_wth,7), "\t\t", n_entities, "\t\t", n_edges, "\t\t", bc_sum, "\t\t", bc_count, "\t\t", number_moved, "\t\t", len(remove_these))
         
-        json_dict[dict_key][removing_round] = {
-                                                "Min-threshold": round(min_oc_wth,7) ,
-                                                "#Entities": full_graph.number_of_nodes(),
-                                                "#Edges": full_graph.number_of_edges(),
-                                                "Connectivity": int(bc_sum), 
-                                                "#Problematics": int(bc_count), 
-                                                "#Relocated": number_moved, 
-                                                "#To-be-removed":len(remove_these)
-                                                }
-
-        full_graph.remove_nodes_from(remove_these)
-        # If we've removed the last problematic entities, we stop
-        if full_graph.number_of_nodes()==0 or bc_sum==0 or len(remove_these) == bc_count:
-            break
+            json_dict[dict_key][removing_round] = {
+                                                    "Min-threshold": round(min_oc_wth,7) ,
+                                                    "#Entities": n_entities,
+                                                    "#Edges": n_edges,
+                                                    "Connectivity": int(bc_sum), 
+                                                    "#Problematics": int(bc_count), 
+                                                    "#Relocated": number_moved, 
+                                                    "#To-be-removed":len(remove_these)
+                                                    }
+
+            engine.remove(remove_these)
+            # If we've removed the last problematic entities, we stop
+            if engine.n_alive==0 or bc_sum==0 or len(remove_these) == bc_count:
+                break
+
+    ## Write the result back to the table and the graph.
+    node_table.partition[rows] = engine.partitions
+    between_connectivity = dict.fromkeys(full_graph.nodes(), 0) if fixed is not None else {}
+    between_connectivity.update((AC, int(bc)) for AC, bc in zip(acs, engine.between_connectivity))
+    nx.set_node_attributes(full_graph, between_connectivity, 'between_connectivity')
+    full_graph.remove_nodes_from([AC for AC, alive in zip(acs, engine.alive) if not alive])
+
 
 def score_partitioning(df:pd.core.frame.DataFrame) -> float:
     s0 = df.shape[0]
@@ -350,14 +378,15 @@ def score_partitioning(df:pd.core.frame.DataFrame) -> float:
     return float((df.product(axis=1)**(1/s1)).product()**(1/s0))
 
 def display_results(
-    part_graph: nx.classes.graph.Graph, 
-    full_graph: nx.classes.graph.Graph,
+    node_table: NodeTable, 
+    full_graph: Union[nx.classes.graph.Graph, CSRGraph],
     labels: dict,
     nr_of_parts: int,
     verbose: bool = True) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
     """ """
     df = pd.DataFrame(((d) for n,d in full_graph.nodes(data=True)))
-    df['cluster'] = [part_graph.nodes[n]['cluster'] for n in full_graph.nodes()]
+    # partitions are reported as floats, as they always were.
+    df['cluster'] = node_table.partition[node_table.indices(full_graph.nodes())].astype(float)
 
     # It can happen that removal completely removed one partition.
     # In this case, we need to report back an error
@@ -385,23 +414,36 @@ def display_results(
     return df, result
     
 
+def min_between_partitions(
+    queries: np.ndarray,
+    libs: np.ndarray,
+    metrics: np.ndarray,
+    partitions: np.ndarray) -> Tuple[float, int]:
+    """ Find the smallest metric of all edges that connect two partitions.
+        Returns the metric and the index of the edge, or (inf, -1) if there is no such edge. """
+    between = np.flatnonzero(partitions[queries] != partitions[libs])
+    if len(between) == 0:
+        return float('Inf'), -1
+    idx = between[np.argmin(metrics[between])]
+    return float(metrics[idx]), int(idx)
+
+
 def removal_needed(
-    part_graph: nx.classes.graph.Graph, 
-    full_graph: nx.classes.graph.Graph,
-    threshold: float) -> bool:
-    """ """
-    min_between = float('Inf')
-    for qry, lib, fed in full_graph.edges(data=True):
-        if part_graph.nodes[qry]['cluster'] != part_graph.nodes[lib]['cluster']:
-            if fed['metric'] < min_between:
-                min_between = fed['metric']
-            if min_between < threshold:
-                print ("! ", qry, lib, fed, " !")
-                return True
-    return False
-
-
-def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_dict: Dict[str,Any], verbose: bool = True) -> Tuple[nx.classes.graph.Graph, nx.classes.graph.Graph, dict]:
+    node_table: NodeTable, 
+    full_graph: Union[nx.classes.graph.Graph, CSRGraph],
+    threshold: float) -> Tuple[bool, float]:
+    """ Check whether any edge below the threshold connects two partitions.
+        Returns the answer and the smallest metric between partitions. """
+    queries, libs, metrics = get_edge_arrays(full_graph, node_table.index)
+
+    min_between, idx = min_between_partitions(queries, libs, metrics, node_table.partition)
+    if min_between < threshold:
+        print ("! ", node_table.ids[queries[idx]], node_table.ids[libs[idx]], {'metric': min_between}, " !")
+        return True, min_between
+    return False, min_between
+
+
+def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_dict: Dict[str,Any], verbose: bool = True) -> Tuple[Union[nx.classes.graph.Graph, CSRGraph], NodeTable, dict]:
     '''
     This function performs the alignments and constructs the graphs.
 
@@ -422,14 +464,16 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
 
     Returns:
     ------------
-        full_graph: nx.classes.graph.Graph
-            Networkx graph that has sequences as nodes and their distances as edge attributes
-        part_graph: nx.classes.graph.Graph
-            Networkx graph that collects the final partition assignments.
+        full_graph: nx.classes.graph.Graph or CSRGraph
+            Graph that has sequences as nodes and their distances as edge attributes.
+            A CSRGraph if config['graph_backend'] is 'csr'.
+        node_table: NodeTable
+            Table of the entities that collects the partition assignments.
         labels: dict
             Dictionary of label statistics
     '''
-    full_graph, part_graph, labels = load_entities(config['fasta_file'], config['priority_name'], config['labels_name'])
+    full_graph, node_table, labels = load_entities(config['fasta_file'], config['priority_name'], config['labels_name'], config.get('graph_backend', 'networkx'),
+                                                   config.get('threads') or 1, config.get('metric_resolution'))
 
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
@@ -440,6 +484,10 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
         print(pd.DataFrame(labels).T)
     json_dict['labels_start'] = labels
 
+    ## The aligners share one copy of the sequences.
+    sequence_store = None
+    if config['alignment_mode'] in ['needle', 'mmseqs2needle']:
+        sequence_store = SequenceStore.from_fasta(config['fasta_file'], n_procs=config.get('threads') or 1)
 
     if config['alignment_mode'] == 'precomputed':
         from .precomputed_utils import load_edge_list
@@ -451,16 +499,53 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
 
     elif config['alignment_mode'] == 'mmseqs2':
         from .mmseqs_utils import generate_edges_mmseqs
-        generate_edges_mmseqs(config['fasta_file'], full_graph, config['transformation'], threshold, config['threshold'], denominator=config['denominator'], delimiter='|', is_nucleotide=config['nucleotide'], use_prefilter=config['prefilter'])
+        generate_edges_mmseqs(config['fasta_file'], full_graph, config['transformation'], threshold, config['threshold'], denominator=config['denominator'], delimiter='|', is_nucleotide=config['nucleotide'], use_prefilter=config['prefilter'],
+                              kmer_length=config.get('kmer_length'), min_shared_kmers=config.get('min_shared_kmers'),
+                              n_threads=config.get('threads'), split_memory_limit=config.get('split_memory_limit'),
+                              cache_dir=config.get('cache_dir'))
         elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
         if verbose:
             print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")    
 
+    elif config['alignment_mode'] == 'needle' and config.get('previous_checkpoint'):
+        from .incremental_utils import generate_edges_incremental
+        print('Computing pairwise sequence identities of new sequences.')
+        json_dict['incremental'] = generate_edges_incremental(config['previous_checkpoint'], config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'],
+                            prefilter=config.get('prefilter'), kmer_length=config.get('kmer_length'), min_shared_kmers=config.get('min_shared_kmers'), n_procs=config['threads'], parallel_mode=config['parallel_mode'], delimiter='|',
+                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], aligner=config.get('aligner', 'needleall'),
+                            sequence_store=sequence_store)
+        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+        if verbose:
+            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+    elif config['alignment_mode'] == 'needle' and config.get('alignment_cache'):
+        from .alignment_cache import generate_edges_cached
+        print('Computing pairwise sequence identities of new sequences.')
+        json_dict['alignment_cache'] = generate_edges_cached(config['alignment_cache'], config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'],
+                            prefilter=config.get('prefilter'), kmer_length=config.get('kmer_length'), min_shared_kmers=config.get('min_shared_kmers'), n_procs=config['threads'], parallel_mode=config['parallel_mode'], delimiter='|',
+                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], aligner=config.get('aligner', 'needleall'),
+                            sequence_store=sequence_store)
+        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+        if verbose:
+            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
+    elif config['alignment_mode'] == 'needle' and config.get('prefilter'):
+        from .kmer_utils import generate_edges_kmer_prefilter
+        print('Computing pairwise sequence identities of k-mer candidates.')
+        json_dict['candidate_pairs'] = generate_edges_kmer_prefilter(config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'],
+                            kmer_length=config.get('kmer_length'), min_shared_kmers=config.get('min_shared_kmers'), n_procs=config['threads'], parallel_mode=config['parallel_mode'], delimiter='|',
+                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], aligner=config.get('aligner', 'needleall'),
+                            sequence_store=sequence_store)
+        elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
+        if verbose:
+            print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
+
     elif config['alignment_mode'] == 'needle' and config['threads']>1:
         from .needle_utils import generate_edges_mp
         print('Computing pairwise sequence identities.')
-        generate_edges_mp(config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'], n_chunks=config['chunks'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|', 
-                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'])
+        json_dict['alignments_skipped'] = generate_edges_mp(config['fasta_file'], full_graph, config['transformation'], threshold, denominator=config['denominator'], n_chunks=config['chunks'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|', 
+                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], aligner=config.get('aligner', 'needleall'),
+                            sequence_store=sequence_store)
         elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
         if verbose:
             print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
@@ -468,8 +553,9 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
     elif config['alignment_mode'] == 'needle':
         from .needle_utils import generate_edges
         print('Computing pairwise sequence identities.')
-        generate_edges(config['fasta_file'],full_graph, config['transformation'], threshold, denominator=config['denominator'], delimiter='|',
-                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'])
+        json_dict['alignments_skipped'] = generate_edges(config['fasta_file'],full_graph, config['transformation'], threshold, denominator=config['denominator'], delimiter='|',
+                            is_nucleotide=config['nucleotide'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'], aligner=config.get('aligner', 'needleall'),
+                            sequence_store=sequence_store)
         elapsed_align = time.perf_counter() - json_dict['time_script_start'] 
         if verbose:
             print(f"Pairwise alignment executed in {elapsed_align:0.2f} seconds.")
@@ -478,7 +564,7 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
         from .mmseqs_needle_combined_utils import generate_edges_mmseqs_needle_combined
         recompute_threshold = TRANSFORMATIONS[config['transformation']](config['recompute_threshold'])
         print('Computing pairwise sequence identities.')
-        generate_edges_mmseqs_needle_combined(
+        json_dict['recompute'] = generate_edges_mmseqs_needle_combined(
             config['fasta_file'],
             full_graph,
             transformation=config['transformation'],
@@ -492,12 +578,20 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
             delimiter='|',
             is_nucleotide=config['nucleotide'],
             use_prefilter=config['prefilter'],
+            kmer_length=config.get('kmer_length'),
+            min_shared_kmers=config.get('min_shared_kmers'),
+            split_memory_limit=config.get('split_memory_limit'),
+            cache_dir=config.get('cache_dir'),
+            miss_rate=config.get('miss_rate'),
+            alignment_cache=config.get('alignment_cache'),
             gapopen=config['gapopen'],
             gapextend=config['gapextend'],
             endweight=config['endweight'],
             endopen=config['endopen'],
             endextend=config['endextend'],
-            matrix=config['matrix']
+            matrix=config['matrix'],
+            aligner=config.get('aligner', 'needleall'),
+            sequence_store=sequence_store,
         )
         # generate_edges_mmseqs_needle_combined(config['fasta_file'], full_graph, config['transformation'], threshold, recompute_threshold, config['threshold'], denominator_needle=config['denominator_needle'], denominator_mmseqs=config['denominator_mmseqs'], n_procs=config['threads'], parallel_mode=config['parallel_mode'], triangular=config['triangular'], delimiter='|', 
                                             #   is_nucleotide=config['nucleotide'], use_prefilter=config['prefilter'], gapopen=config['gapopen'], gapextend=config['gapextend'], endweight=config['endweight'], endopen=config['endopen'], endextend=config['endextend'], matrix=config['matrix'])
@@ -506,27 +600,43 @@ def make_graphs_from_sequences(config: Dict[str, Any], threshold: float, json_di
         raise NotImplementedError('Encountered unspecified alignment mode. This should never happen.')
 
     
-    return full_graph, part_graph, labels
+    return full_graph, node_table, labels
 
 
-def partition_and_remove(full_graph: nx.classes.graph.Graph, part_graph: nx.classes.graph.Graph, labels: dict, json_dict: dict,
+def partition_and_remove(full_graph: Union[nx.classes.graph.Graph, CSRGraph], node_table: NodeTable, labels: dict, json_dict: dict,
                             threshold: float, config: dict, write_intermediate_file: bool = False, verbose: bool = True) -> pd.core.frame.DataFrame:
     '''
     This function runs the core Graph-Part algorithm. Its inputs are generated by
     `make_graphs_from_sequences` or another function that produces outputs of the same
     kind for non-sequence data.
     '''
-    
-    partition_data(full_graph, part_graph, labels, threshold, config['partitions'], config['initialization_mode'])
+    if isinstance(full_graph, CSRGraph) or full_graph.graph.get('single_precision', False):
+        # metrics are stored in single precision, compare them at the same precision.
+        threshold = metric_threshold(threshold, getattr(full_graph, 'resolution', None))
+
+    partition_data(full_graph, node_table, labels, threshold, config['partitions'], config['initialization_mode'], config.get('largest_first', False),
+                   config.get('threads') or 1)
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+    df, result = display_results(node_table, full_graph, labels, config['partitions'], verbose=verbose)
     if config['test_ratio']>0:
-        train_val_test_split(part_graph, full_graph, threshold, config['test_ratio'], config['val_ratio'], config['partitions'])
+        train_val_test_split(node_table, full_graph, threshold, config['test_ratio'], config['val_ratio'], config['partitions'])
         config['partitions'] = 3 if config['val_ratio']>0 else 2
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+    df, result = display_results(node_table, full_graph, labels, config['partitions'], verbose=verbose)
     if write_intermediate_file:
         df.to_csv(config['out_file'] + "pre-removal")
+
+    return remove_and_report(full_graph, node_table, labels, json_dict, result, threshold, config, verbose=verbose)
+
+
+def remove_and_report(full_graph: Union[nx.classes.graph.Graph, CSRGraph], node_table: NodeTable, labels: dict, json_dict: dict,
+                      result: pd.core.frame.DataFrame, threshold: float, config: dict, verbose: bool = True, fixed: set = None) -> pd.core.frame.DataFrame:
+    '''
+    Run the removal step on an initial partitioning, and collect the
+    statistics before and after it in json_dict. result is the table of
+    the initial partitioning from `display_results`.
+    Entities in fixed are neither moved nor removed, see `remover`.
+    '''
     print('Currently have this many samples:', full_graph.number_of_nodes())
 
     json_dict['partitioning_pre_removal'] = result.to_json()
@@ -535,25 +645,31 @@ def partition_and_remove(full_graph: nx.classes.graph.Graph, part_graph: nx.clas
 
     
     ## Check if we need to remove any
-    if removal_needed(part_graph, full_graph, threshold):     
+    needed, min_between = removal_needed(node_table, full_graph, threshold)
+    json_dict['min_between_pre_removal'] = min_between if np.isfinite(min_between) else None
+    if needed:
         print('Need to remove! Currently have this many samples:', full_graph.number_of_nodes())
 
-        remover(full_graph, part_graph, threshold, json_dict, config['allow_moving'], True, verbose=verbose)    
+        remover(full_graph, node_table, threshold, json_dict, config['allow_moving'], True, verbose=verbose, fixed=fixed,
+                n_procs=config.get('threads') or 1)
 
-    if removal_needed(part_graph, full_graph, threshold):   
+    if removal_needed(node_table, full_graph, threshold)[0]:
         print('Need to remove priority! Currently have this many samples:', full_graph.number_of_nodes())
-        remover(full_graph, part_graph, threshold, json_dict, config['allow_moving'], False, verbose=verbose)    
+        remover(full_graph, node_table, threshold, json_dict, config['allow_moving'], False, verbose=verbose, fixed=fixed,
+                n_procs=config.get('threads') or 1)
 
     print('After removal we have this many samples:', full_graph.number_of_nodes())
 
 
-    df, result = display_results(part_graph, full_graph, labels, config['partitions'], verbose=verbose)
+    df, result = display_results(node_table, full_graph, labels, config['partitions'], verbose=verbose)
 
     json_dict['partitioning_after_removal'] = result.to_json()
     json_dict['samples_after_removal'] = full_graph.number_of_nodes()
     json_dict['score_after_removal'] = score_partitioning(result[range(config['partitions'])])
 
-    if removal_needed(part_graph, full_graph, threshold):
+    needed, min_between = removal_needed(node_table, full_graph, threshold)
+    json_dict['min_between_end'] = min_between if np.isfinite(min_between) else None
+    if needed:
         print ("Something is wrong! Removal still needed!")
         json_dict['removal_needed_end'] = True
     else:
@@ -562,6 +678,180 @@ def partition_and_remove(full_graph: nx.classes.graph.Graph, part_graph: nx.clas
     return df
 
 
+def partition_incremental(full_graph: Union[nx.classes.graph.Graph, CSRGraph], node_table: NodeTable, labels: dict, json_dict: dict,
+                          threshold: float, config: dict, verbose: bool = True) -> pd.core.frame.DataFrame:
+    '''
+    Add new entities to the partitions of an earlier run, given by the output
+    file config['previous_output'] and the binary checkpoint config['previous_checkpoint'].
+
+    Entities of the earlier output keep their partitions. Entities that the
+    earlier run removed stay removed. The new entities are linked into
+    mini-clusters among themselves, as in `partition_data`. Mini-clusters
+    with neighbours in the earlier partitions join the partition with the
+    most neighbours, the others are assigned with `partition_assignment`,
+    starting from the label counts that the partitions already have.
+    The removal step only moves and removes new entities.
+    '''
+    from .checkpoint import load_checkpoint
+
+    if isinstance(full_graph, CSRGraph) or full_graph.graph.get('single_precision', False):
+        # metrics are stored in single precision, compare them at the same precision.
+        threshold = metric_threshold(threshold, getattr(full_graph, 'resolution', None))
+
+    previous = pd.read_csv(config['previous_output'], index_col='AC', dtype={'AC': str})['cluster']
+    _, checkpoint_ids, _, _, _ = load_checkpoint(config['previous_checkpoint'])
+    removed_before = set(checkpoint_ids).difference(previous.index)
+    full_graph.remove_nodes_from([AC for AC in list(full_graph.nodes()) if AC in removed_before])
+
+    acs = list(full_graph.nodes())
+    is_new = ~pd.Index(acs).isin(previous.index)
+    n_partitions = int(previous.max()) + 1
+    rows = node_table.indices(acs)
+    node_labels = node_table.label[rows]
+    partitions = np.full(len(acs), -1, dtype=np.int64)
+    partitions[~is_new] = previous.reindex(pd.Index(acs)[~is_new]).to_numpy().astype(np.int64)
+    print(f'Adding {is_new.sum()} new entities to {n_partitions} partitions of {(~is_new).sum()} entities.')
+
+    queries, libs, metrics = get_edge_arrays(full_graph, {AC: ind for ind, AC in enumerate(acs)})
+    conflicts = ~is_new[queries] & ~is_new[libs] & (partitions[queries] != partitions[libs]) & (metrics < threshold)
+    if conflicts.any():
+        raise ValueError('The previous partitions are not separated at this threshold. Use the threshold of the previous run or a stricter one.')
+
+    ## Mini-clusters of the new entities.
+    new = np.flatnonzero(is_new)
+    new_index = np.full(len(acs), -1, dtype=np.int64)
+    new_index[new] = np.arange(len(new))
+    clusters = np.arange(len(new))
+    if config['initialization_mode'] in ['slow-nn', 'fast-nn'] and len(new) > 0:
+        within = is_new[queries] & is_new[libs]
+        inds = np.argsort(metrics[within])
+        inds = inds[:np.searchsorted(metrics[within][inds], threshold, side='right')]
+        label_limits = np.array([x[1]['lim'] for x in sorted(labels.items(), key=lambda x:x[1]['val'] )])
+        forest = restricted_linkage(new_index[queries[within]][inds], new_index[libs[within]][inds], node_labels[new],
+                                    len(acs)//n_partitions, label_limits)
+        clusters = forest.clusters()
+
+    ## Mini-clusters that are linked to earlier partitions join the one with the most links.
+    cross = is_new[queries] != is_new[libs]
+    new_ends = np.where(is_new[queries[cross]], queries[cross], libs[cross])
+    old_ends = np.where(is_new[queries[cross]], libs[cross], queries[cross])
+    links = np.zeros((len(new), n_partitions), dtype=np.int64)
+    np.add.at(links, (clusters[new_index[new_ends]], partitions[old_ends]), 1)
+    cluster_partition = np.where(links.max(axis=1, initial=0) > 0, links.argmax(axis=1), -1)
+    new_partitions = cluster_partition[clusters]
+
+    ## The other mini-clusters are balanced against the label counts of the partitions.
+    n_class = len(labels)
+    counts = np.zeros((n_partitions, n_class))
+    assigned = partitions >= 0
+    np.add.at(counts, (partitions[assigned], node_labels[assigned]), 1)
+    np.add.at(counts, (new_partitions[new_partitions >= 0], node_labels[new][new_partitions >= 0]), 1)
+    free = new_partitions < 0
+    if free.any():
+        new_partitions[free] = partition_assignment(clusters[free], node_labels[new][free], n_partitions, n_class, counts, config.get('largest_first', False))
+    partitions[new] = new_partitions
+
+    node_table.partition[rows] = partitions
+    json_dict['new_entities'] = int(is_new.sum())
+
+    df, result = display_results(node_table, full_graph, labels, n_partitions, verbose=verbose)
+    config['partitions'] = n_partitions
+    return remove_and_report(full_graph, node_table, labels, json_dict, result, threshold, config, verbose=verbose,
+                             fixed=set(previous.index))
+
+
+def threshold_graph(full_graph: Union[nx.classes.graph.Graph, CSRGraph],
+                    acs: List[str],
+                    queries: np.ndarray,
+                    libs: np.ndarray,
+                    metrics: np.ndarray,
+                    positions: np.ndarray) -> Union[nx.classes.graph.Graph, CSRGraph]:
+    '''
+    Make a new full graph with all nodes of full_graph, but only the edges
+    at positions in the edge arrays. The graph is the same as one that was
+    built at the stricter threshold directly.
+    '''
+    if isinstance(full_graph, CSRGraph):
+        positions = np.sort(positions)
+        graph = CSRGraph(full_graph.resolution)
+        for AC in acs:
+            graph.add_node(AC, **full_graph.nodes[AC])
+        graph.add_edges_from_arrays(queries[positions], libs[positions], metrics[positions])
+        return graph
+
+    # removing edges keeps the order of the remaining ones, which matters for ties in partition_data.
+    removed = np.ones(len(queries), dtype=bool)
+    removed[positions] = False
+    graph = full_graph.copy()
+    graph.remove_edges_from((acs[qry], acs[lib]) for qry, lib in zip(queries[removed].tolist(), libs[removed].tolist()))
+    return graph
+
+
+def partition_threshold_sweep(full_graph: Union[nx.classes.graph.Graph, CSRGraph],
+                              node_table: NodeTable,
+                              labels: dict,
+                              json_dict: dict,
+                              config: Dict[str, Union[str,int,float,bool]],
+                              write_output_file: bool = True,
+                              write_json_report: bool = True,
+                              verbose: bool = True) -> Dict[float, pd.core.frame.DataFrame]:
+    '''
+    Run `partition_and_remove` for each threshold in config['thresholds'].
+    full_graph needs to hold the edges of the loosest threshold. The edges
+    are sorted by metric once, each threshold then uses a prefix of them.
+
+    Results are written to out_file with the threshold added to the name.
+    Returns a dict of threshold -> partition assignment DataFrame.
+    '''
+    import copy
+    import json
+    import os
+
+    acs = list(full_graph.nodes())
+    queries, libs, metrics = get_edge_arrays(full_graph, {AC: i for i, AC in enumerate(acs)})
+    resolution = getattr(full_graph, 'resolution', None)
+    if resolution is not None:
+        # the codes sort in linear time, and in the same order as the metrics.
+        _, _, codes = get_edge_arrays(full_graph, {AC: i for i, AC in enumerate(acs)}, quantised=True)
+        order = np.argsort(codes, kind='stable')
+    else:
+        order = np.argsort(metrics, kind='stable')
+    sorted_metrics = metrics[order]
+    single_precision = isinstance(full_graph, CSRGraph) or full_graph.graph.get('single_precision', False)
+
+    out_root, out_ext = os.path.splitext(config['out_file'])
+    results = {}
+    for threshold in config['thresholds']:
+        s = time.perf_counter()
+        print(f'Partitioning at threshold {threshold}.')
+        # partition_and_remove changes the config in train-val-test mode, so each run gets its own.
+        this_config = dict(config, threshold=threshold, out_file=f'{out_root}_{threshold}{out_ext}')
+        this_config['threshold_transformed'] = TRANSFORMATIONS[config['transformation']](threshold)
+        this_json_dict = dict(json_dict, config=this_config, time_threshold_start=s)
+
+        cut_off = metric_threshold(this_config['threshold_transformed'], resolution) if single_precision else this_config['threshold_transformed']
+        n_edges = np.searchsorted(sorted_metrics, cut_off, side='right')
+        this_full_graph = threshold_graph(full_graph, acs, queries, libs, metrics, order[:n_edges])
+        print("Full graph nr. of edges:", this_full_graph.number_of_edges())
+        this_json_dict['graph_edges_start'] = this_full_graph.number_of_edges()
+
+        df = partition_and_remove(this_full_graph, node_table.copy(), copy.deepcopy(labels), this_json_dict,
+                                  this_config['threshold_transformed'], this_config, write_intermediate_file=False, verbose=verbose)
+        results[threshold] = df
+
+        if write_output_file:
+            df.to_csv(this_config['out_file'])
+
+        this_json_dict['time_script_complete'] = time.perf_counter()
+        if verbose:
+            print(f"Partitioning at threshold {threshold} executed in {time.perf_counter() - s:0.2f} seconds.")
+
+        if write_json_report:
+            json.dump(this_json_dict, open(f'{out_root}_{threshold}_report.json', 'w'))
+
+    return results
+
+
 def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_file: bool = True, write_json_report: bool=True, verbose: bool=True) -> pd.core.frame.DataFrame:
     '''
     Core Graph-Part partitioning function. `config` contains all parameters passed from the command line
@@ -577,6 +867,9 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
         If True, write a report of all summary statistics. Used by the webserver.
     verbose:  bool
         If True, print all processing steps to command line.
+
+    If config['thresholds'] is given, runs a threshold sweep and returns a
+    dict of threshold -> DataFrame instead. See `partition_threshold_sweep`.
     '''
 
     s = time.perf_counter()
@@ -586,13 +879,20 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
     json_dict['time_script_start'] = s
     json_dict['config'] = config
 
-    if write_output_file:
+    if write_output_file and not config.get('thresholds'):
         try:
             with open(config['out_file'], 'w+') as outf:
                 pass
         except:
-            raise ValueError("Output file path (-of/--out-file) improper or nonexistent.") 
-        
+            raise ValueError("Output file path (-of/--out-file) improper or nonexistent.")
+
+    if config.get('previous_output') is not None and (config.get('previous_checkpoint') is None or config.get('thresholds')):
+        raise ValueError('Incremental partitioning (--previous-output) needs --previous-checkpoint, and does not support --thresholds.')
+
+    if config.get('thresholds'):
+        ## Threshold sweep: compute the edges once, at the loosest threshold.
+        config['threshold'] = max(config['thresholds'], key=TRANSFORMATIONS[config['transformation']])
+
     threshold = TRANSFORMATIONS[config['transformation']](config['threshold'])
     json_dict['config']['threshold_transformed'] = threshold
 
@@ -600,7 +900,7 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
     ## Processing starts here:
 
     ## Load entities/samples as networkx graphs. labels contains label metadata.
-    full_graph, part_graph, labels = make_graphs_from_sequences(config, threshold, json_dict, verbose)
+    full_graph, node_table, labels = make_graphs_from_sequences(config, threshold, json_dict, verbose)
 
 
     ## Let's look at the number of edges
@@ -609,7 +909,14 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
     json_dict['graph_edges_start'] = full_graph.number_of_edges()
     json_dict['time_edges_complete'] = time.perf_counter()
 
-    if config['save_checkpoint_path'] is not None:
+    if config['save_checkpoint_path'] is not None and config.get('checkpoint_format', 'csv') == 'binary':
+        from .checkpoint import save_checkpoint
+        print(f'Saving binary checkpoint at {config["save_checkpoint_path"]} ...')
+        acs = list(full_graph.nodes())
+        queries, libs, metrics = get_edge_arrays(full_graph, {AC: i for i, AC in enumerate(acs)})
+        save_checkpoint(config['save_checkpoint_path'], acs, queries, libs, metrics, config)
+
+    elif config['save_checkpoint_path'] is not None:
         from .transformations import INVERSE_TRANSFORMATIONS
         from tqdm.auto import tqdm
         print(f'Saving edge list at {config["save_checkpoint_path"]} ...')
@@ -621,9 +928,14 @@ def run_partitioning(config: Dict[str, Union[str,int,float,bool]], write_output_
                 f.write(qry+ ',' + lib +',' + str(score) +'\n')
 
 
-    
+    if config.get('thresholds'):
+        return partition_threshold_sweep(full_graph, node_table, labels, json_dict, config, write_output_file, write_json_report, verbose)
+
     ## Finally, let's partition this
-    df = partition_and_remove(full_graph, part_graph, labels, json_dict, threshold, config, write_intermediate_file=False, verbose=verbose)
+    if config.get('previous_output') is not None:
+        df = partition_incremental(full_graph, node_table, labels, json_dict, threshold, config, verbose=verbose)
+    else:
+        df = partition_and_remove(full_graph, node_table, labels, json_dict, threshold, config, write_intermediate_file=False, verbose=verbose)
 
     ## clustering to outfile. This will probably change...
     if write_output_file:
@@ -0,0 +1,100 @@
+'''
+Alignment for incremental partitioning.
+
+When new sequences are added to a dataset that was partitioned before,
+the alignments of the earlier run are read from its binary checkpoint.
+Only the new sequences are aligned, against all others and among
+themselves. The partitioning step is `graph_part.partition_incremental`.
+'''
+import networkx as nx
+import pandas as pd
+from typing import Dict
+
+from .checkpoint import load_checkpoint
+from .needle_utils import new_sequence_pairs
+from .sequence_store import SequenceStore
+from .precomputed_utils import load_checkpoint_edges
+
+
+def generate_edges_incremental(checkpoint_fp: str,
+                               entity_fp: str,
+                               full_graph: nx.classes.graph.Graph,
+                               transformation: str,
+                               threshold: float,
+                               denominator: str = 'full',
+                               prefilter: bool = False,
+                               kmer_length: int = None,
+                               min_shared_kmers: int = None,
+                               n_procs: int = 4,
+                               parallel_mode: str = 'multithread',
+                               delimiter: str = '|',
+                               is_nucleotide: bool = False,
+                               gapopen: float = 10,
+                               gapextend: float = 0.5,
+                               endweight: bool = False,
+                               endopen: float = 10,
+                               endextend: float = 0.5,
+                               matrix: str = 'EBLOSUM62',
+                               aligner: str = 'needleall',
+                               sequence_store: SequenceStore = None,
+                               ) -> Dict[str, int]:
+    '''
+    Load the edges of the checkpoint of an earlier run into the graph, and
+    align the sequences that are not in the checkpoint against all others.
+    New pairs are aligned once, in batches of pairs. The checkpoint needs
+    to be made with the same alignment parameters.
+    The sequences are read from sequence_store, or from entity_fp if it is not given.
+    Returns the number of new sequences and of aligned pairs.
+    '''
+    from .kmer_utils import DEFAULT_KMER_LENGTH, DEFAULT_MIN_SHARED_KMERS
+    from .mmseqs_needle_combined_utils import generate_needle_edges_pairwise_mp
+
+    header, checkpoint_ids, _, _, _ = load_checkpoint(checkpoint_fp)
+    ## new alignments would not be comparable to the ones of the checkpoint.
+    params = dict(alignment_mode='needle', denominator=denominator, nucleotide=is_nucleotide, gapopen=gapopen, gapextend=gapextend,
+                  endweight=endweight, endopen=endopen, endextend=endextend, matrix=matrix)
+    mismatched = [f'{key} ({header[key]} in the checkpoint, {value} now)' for key, value in params.items()
+                  if header.get(key) is not None and header[key] != value]
+    if len(mismatched) > 0:
+        raise ValueError('The checkpoint was made with other alignment parameters: ' + ', '.join(mismatched) + '.')
+    if str(header.get('transformation')) == str(transformation) and header.get('threshold_transformed') is not None \
+            and threshold > header['threshold_transformed']:
+        raise ValueError(f"The checkpoint only contains edges up to {header['threshold_transformed']}, the threshold is {threshold}. "
+                         "Incremental runs need the same or a stricter threshold.")
+    load_checkpoint_edges(checkpoint_fp, full_graph, transformation, threshold)
+
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp, delimiter)
+    ids, seqs = sequence_store.ids, sequence_store.sequences()
+    is_new = ~pd.Index(ids).isin(checkpoint_ids)
+
+    if prefilter:
+        kmer_length = DEFAULT_KMER_LENGTH[is_nucleotide] if kmer_length is None else kmer_length
+        min_shared_kmers = DEFAULT_MIN_SHARED_KMERS if min_shared_kmers is None else min_shared_kmers
+    queries, libs = new_sequence_pairs(seqs, is_new, denominator, transformation, threshold, prefilter, kmer_length, min_shared_kmers)
+
+    pairs = [(ids[q], ids[l]) for q, l in zip(queries.tolist(), libs.tolist())]
+    print(f'Aligning {len(pairs)} pairs of {is_new.sum()} new sequences.')
+    if len(pairs) > 0:
+        generate_needle_edges_pairwise_mp(
+            sequence_store = sequence_store,
+            pairs = pairs,
+            full_graph = full_graph,
+            transformation = transformation,
+            threshold = threshold,
+            denominator = denominator,
+            n_procs = n_procs,
+            parallel_mode = parallel_mode,
+            triangular = True,
+            delimiter = delimiter,
+            is_nucleotide = is_nucleotide,
+            gapopen = gapopen,
+            gapextend = gapextend,
+            endweight = endweight,
+            endopen = endopen,
+            endextend = endextend,
+            matrix = matrix,
+            aligner = aligner,
+        )
+
+    return {'new_sequences': int(is_new.sum()), 'aligned_pairs': len(pairs)}
@@ -0,0 +1,168 @@
+'''
+K-mer index prefilter for the needle mode.
+
+All-vs-all alignment grows quadratically with the number of sequences,
+while most pairs are far below any useful threshold. Homologous sequences
+share short exact words (k-mers). An inverted index from each k-mer to the
+sequences that contain it finds all pairs that share at least `min_shared`
+k-mers, without looking at the pairs that share none. Only these candidate
+pairs are aligned.
+
+The sensitivity is set by the k-mer length and by `min_shared`. Shorter
+k-mers and a lower `min_shared` find more distant pairs, but produce
+more candidates to align.
+'''
+import networkx as nx
+import numpy as np
+from typing import List, Tuple
+from tqdm.auto import tqdm
+
+from .needle_utils import length_feasible
+from .sequence_store import SequenceStore
+from .mmseqs_needle_combined_utils import generate_needle_edges_pairwise_mp
+
+
+# default k-mer lengths. Random pairs of proteins share about one 4-mer per 160,000 pairs of positions.
+DEFAULT_KMER_LENGTH = {False: 4, True: 11}
+DEFAULT_MIN_SHARED_KMERS = 3
+
+
+def encode_kmers(seqs: List[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Find the distinct k-mers of each sequence.
+    Returns the k-mers as integer codes and the index of the sequence
+    that contains them, sorted by k-mer.
+    '''
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    residues = np.frombuffer(''.join(seqs).upper().encode('ascii', errors='replace'), dtype=np.uint8)
+    alphabet, residues = np.unique(residues, return_inverse=True)
+    base = max(len(alphabet), 2)
+    if k * np.log2(base) > 62:
+        raise ValueError(f'k-mers of length {k} over {base} characters do not fit into 64 bit integers. Use a shorter --kmer-length.')
+
+    # k-mer code at each position of the concatenated sequences.
+    codes = np.zeros(max(len(residues) - k + 1, 0), dtype=np.int64)
+    for offset in range(k):
+        codes = codes * base + residues[offset:offset + len(codes)]
+
+    # only keep k-mers that lie within one sequence.
+    seq_idx = np.repeat(np.arange(len(seqs)), lengths)[:len(codes)]
+    ends = np.cumsum(lengths)
+    within = np.arange(len(codes)) + k <= ends[seq_idx]
+    codes, seq_idx = codes[within], seq_idx[within]
+
+    # distinct (k-mer, sequence) entries, sorted by k-mer.
+    order = np.lexsort((seq_idx, codes))
+    codes, seq_idx = codes[order], seq_idx[order]
+    distinct = np.r_[True, (codes[1:] != codes[:-1]) | (seq_idx[1:] != seq_idx[:-1])]
+    return codes[distinct], seq_idx[distinct]
+
+
+def find_candidate_pairs(seqs: List[str], k: int = 4, min_shared: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Find all pairs of sequences that share at least min_shared distinct k-mers.
+    Each pair is returned once, as (i, j) with i < j.
+    '''
+    kmers, postings = encode_kmers(seqs, k)
+
+    # the index: sequences containing k-mer number x are postings[starts[x]:starts[x+1]].
+    is_first = np.r_[True, kmers[1:] != kmers[:-1]]
+    starts = np.r_[np.flatnonzero(is_first), len(kmers)]
+    kmer_number = np.cumsum(is_first) - 1
+
+    # the k-mers of each sequence.
+    by_seq = np.argsort(postings, kind='stable')
+    seq_kmers = kmer_number[by_seq]
+    seq_starts = np.searchsorted(postings[by_seq], np.arange(len(seqs) + 1))
+
+    queries, libs = [], []
+    for i in tqdm(range(len(seqs)), desc='Searching k-mer index', leave=False):
+        own = seq_kmers[seq_starts[i]:seq_starts[i+1]]
+        if len(own) == 0:
+            continue
+        # gather the posting lists of all k-mers of the sequence.
+        list_starts, list_lens = starts[own], starts[own + 1] - starts[own]
+        positions = np.repeat(list_starts - np.cumsum(list_lens) + list_lens, list_lens) + np.arange(list_lens.sum())
+        hits = postings[positions]
+        hits = hits[hits > i]
+        if len(hits) == 0:
+            continue
+        counts = np.bincount(hits - (i + 1))
+        found = np.flatnonzero(counts >= min_shared) + i + 1
+        queries.append(np.full(len(found), i, dtype=np.int64))
+        libs.append(found)
+
+    if len(queries) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(queries), np.concatenate(libs)
+
+
+def generate_edges_kmer_prefilter(entity_fp: str,
+                                  full_graph: nx.classes.graph.Graph,
+                                  transformation: str,
+                                  threshold: float,
+                                  denominator: str = 'full',
+                                  kmer_length: int = None,
+                                  min_shared_kmers: int = None,
+                                  n_procs: int = 4,
+                                  parallel_mode: str = 'multithread',
+                                  delimiter: str = '|',
+                                  is_nucleotide: bool = False,
+                                  gapopen: float = 10,
+                                  gapextend: float = 0.5,
+                                  endweight: bool = False,
+                                  endopen: float = 10,
+                                  endextend: float = 0.5,
+                                  matrix: str = 'EBLOSUM62',
+                                  aligner: str = 'needleall',
+                                  sequence_store: SequenceStore = None,
+                                  ) -> int:
+    '''
+    Replaces the all-vs-all alignment of the needle mode. Finds the candidate
+    pairs with the k-mer index, drops those whose lengths cannot reach the
+    threshold and aligns the rest in batches of pairs.
+    Each candidate pair is aligned once, as in triangular mode.
+    The sequences are read from sequence_store, or from entity_fp if it is not given.
+    Returns the number of candidate pairs.
+    '''
+    if kmer_length is None:
+        kmer_length = DEFAULT_KMER_LENGTH[is_nucleotide]
+    if min_shared_kmers is None:
+        min_shared_kmers = DEFAULT_MIN_SHARED_KMERS
+
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp, delimiter)
+    ids = sequence_store.ids
+
+    queries, libs = find_candidate_pairs(sequence_store.sequences(), kmer_length, min_shared_kmers)
+    lengths = sequence_store.lengths
+    feasible = length_feasible(lengths[queries], lengths[libs], denominator, transformation, threshold)
+    queries, libs = queries[feasible], libs[feasible]
+
+    n_all = len(ids) * (len(ids) - 1) // 2
+    print(f'Found {len(queries)} candidate pairs sharing at least {min_shared_kmers} {kmer_length}-mers, out of {n_all} pairs.')
+
+    pairs = [(ids[q], ids[l]) for q, l in zip(queries.tolist(), libs.tolist())]
+    if len(pairs) > 0:
+        generate_needle_edges_pairwise_mp(
+            sequence_store = sequence_store,
+            pairs = pairs,
+            full_graph = full_graph,
+            transformation = transformation,
+            threshold = threshold,
+            denominator = denominator,
+            n_procs = n_procs,
+            parallel_mode = parallel_mode,
+            triangular = True,
+            delimiter = delimiter,
+            is_nucleotide = is_nucleotide,
+            gapopen = gapopen,
+            gapextend = gapextend,
+            endweight = endweight,
+            endopen = endopen,
+            endextend = endextend,
+            matrix = matrix,
+            aligner = aligner,
+        )
+
+    return len(pairs)
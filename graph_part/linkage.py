@@ -0,0 +1,104 @@
+'''
+Restricted nearest neighbour linkage on a disjoint-set forest.
+
+Entities are linked along the edges in order of increasing distance,
+unless the merged mini-cluster would exceed the partition size or
+the label limits. Merging two mini-clusters is near-constant time, as
+only the roots hold the cluster size and the label counts.
+'''
+import numpy as np
+from typing import List
+from tqdm import tqdm
+
+
+class DisjointSet():
+    '''
+    Union-find over integer node ids, with union by size and path compression.
+    Each root keeps the size and the label counts of its mini-cluster.
+    '''
+    def __init__(self, label_vals: np.ndarray, n_labels: int) -> None:
+        n = len(label_vals)
+        # python lists are faster than numpy arrays for scalar access.
+        self.parent: List[int] = list(range(n))
+        self.size: List[int] = [1] * n
+        self.label_counts = np.zeros((n, n_labels), dtype=np.int64)
+        self.label_counts[np.arange(n), label_vals] = 1
+
+    def find(self, x: int) -> int:
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, root_a: int, root_b: int) -> int:
+        '''Merge two mini-clusters given by their roots. Returns the new root.'''
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        self.label_counts[root_a] += self.label_counts[root_b]
+        return root_a
+
+    def roots(self) -> np.ndarray:
+        '''The root of each node.'''
+        return np.array([self.find(x) for x in range(len(self.parent))])
+
+    def clusters(self) -> np.ndarray:
+        '''
+        Mini-cluster number of each node. Mini-clusters are numbered in
+        order of their first node, like nx.connected_components does.
+        '''
+        return number_clusters(self.roots())
+
+
+def number_clusters(roots: np.ndarray) -> np.ndarray:
+    '''Number the mini-clusters given by the root of each node in order of their first node.'''
+    _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
+
+
+def restricted_linkage(queries: np.ndarray,
+                       libs: np.ndarray,
+                       label_vals: np.ndarray,
+                       part_size: int,
+                       label_limits: np.ndarray,
+                       chunk_size: int = 1000000,
+                       progress: bool = True) -> DisjointSet:
+    '''
+    Link entities along the edges (queries[i], libs[i]), which need to be
+    sorted by increasing metric and cut at the threshold already.
+    A link is only made if neither mini-cluster has reached the partition
+    size and the combined label counts stay below the label limits.
+
+    Returns the DisjointSet holding the mini-clusters.
+    '''
+    forest = DisjointSet(label_vals, len(label_limits))
+    find, size, label_counts = forest.find, forest.size, forest.label_counts
+
+    pbar = tqdm(total=len(queries), desc='Clustering', disable=not progress)
+    # convert to python ints in chunks, a full conversion would take a lot of memory.
+    for start in range(0, len(queries), chunk_size):
+        qry_chunk = queries[start:start+chunk_size].tolist()
+        lib_chunk = libs[start:start+chunk_size].tolist()
+        for qry, lib in zip(qry_chunk, lib_chunk):
+            root_qry, root_lib = find(qry), find(lib)
+            if root_qry == root_lib:
+                continue
+
+            ## RESTRICTIONS!
+            if size[root_qry] >= part_size or size[root_lib] >= part_size:
+                continue
+            if (label_counts[root_qry] + label_counts[root_lib] >= label_limits).any():
+                continue
+
+            forest.union(root_qry, root_lib)
+        pbar.update(len(qry_chunk))
+    pbar.close()
+
+    return forest
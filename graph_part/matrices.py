@@ -0,0 +1,99 @@
+'''
+Substitution matrices for the built-in aligner.
+
+The EMBOSS default matrices are included. Other matrices are read
+in the EMBOSS format from a file path or from the EMBOSS data directory
+($EMBOSS_DATA), the same way needle finds them with -datafile.
+'''
+import os
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+
+
+EBLOSUM62 = '''
+   A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+* -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+'''
+
+EDNAFULL = '''
+   A  T  G  C  S  W  R  Y  K  M  B  V  H  D  N  U
+A  5 -4 -4 -4 -4  1  1 -4 -4  1 -4 -1 -1 -1 -2 -4
+T -4  5 -4 -4 -4  1 -4  1  1 -4 -1 -4 -1 -1 -2  5
+G -4 -4  5 -4  1 -4  1 -4  1 -4 -1 -1 -4 -1 -2 -4
+C -4 -4 -4  5  1 -4 -4  1 -4  1 -1 -1 -1 -4 -2 -4
+S -4 -4  1  1 -1 -4 -2 -2 -2 -2 -1 -1 -3 -3 -1 -4
+W  1  1 -4 -4 -4 -1 -2 -2 -2 -2 -3 -3 -1 -1 -1  1
+R  1 -4  1 -4 -2 -2 -1 -4 -2 -2 -3 -1 -3 -1 -1 -4
+Y -4  1 -4  1 -2 -2 -4 -1 -2 -2 -1 -3 -1 -3 -1  1
+K -4  1  1 -4 -2 -2 -2 -2 -1 -4 -1 -3 -3 -1 -1  1
+M  1 -4 -4  1 -2 -2 -2 -2 -4 -1 -3 -1 -1 -3 -1 -4
+B -4 -1 -1 -1 -1 -3 -3 -1 -1 -3 -1 -2 -2 -2 -1 -1
+V -1 -4 -1 -1 -1 -3 -1 -3 -3 -1 -2 -1 -2 -2 -1 -4
+H -1 -1 -4 -1 -3 -1 -3 -1 -3 -1 -2 -2 -1 -2 -1 -1
+D -1 -1 -1 -4 -3 -1 -1 -3 -1 -3 -2 -2 -2 -1 -1 -1
+N -2 -2 -2 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2
+U -4  5 -4 -4 -4  1 -4  1  1 -4 -1 -4 -1 -1 -2  5
+'''
+
+BUILTIN_MATRICES = {
+    'EBLOSUM62': EBLOSUM62,
+    'EDNAFULL': EDNAFULL,
+}
+
+
+def parse_matrix(text: str) -> Tuple[str, np.ndarray]:
+    '''
+    Parse a substitution matrix in the EMBOSS format.
+    Lines starting with # are comments, the first other line holds the alphabet.
+    Returns the alphabet and the score matrix.
+    '''
+    lines = [line.split() for line in text.splitlines() if line.strip() and not line.startswith('#')]
+    alphabet = ''.join(lines[0])
+    scores = np.zeros((len(alphabet), len(alphabet)), dtype=np.float32)
+    for row in lines[1:]:
+        scores[alphabet.index(row[0])] = [float(x) for x in row[1:]]
+
+    return alphabet, scores
+
+
+@lru_cache(maxsize=None)
+def load_matrix(matrix: str) -> Tuple[str, np.ndarray]:
+    '''Get a substitution matrix by its EMBOSS name or by its path.'''
+    if matrix in BUILTIN_MATRICES:
+        return parse_matrix(BUILTIN_MATRICES[matrix])
+
+    candidates = [matrix]
+    if 'EMBOSS_DATA' in os.environ:
+        candidates.append(os.path.join(os.environ['EMBOSS_DATA'], matrix))
+    for file_path in candidates:
+        if os.path.isfile(file_path):
+            with open(file_path) as f:
+                return parse_matrix(f.read())
+
+    raise ValueError(f'Substitution matrix {matrix} not found. Built-in matrices are {", ".join(BUILTIN_MATRICES)}. '
+                     'Other EMBOSS matrices can be given as a file path or found through $EMBOSS_DATA.')
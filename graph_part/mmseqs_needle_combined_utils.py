@@ -6,6 +6,7 @@ needleall to get the exact metric value.
 
 This is faster than running needleall on the full dataset.
 '''
+import contextlib
 import networkx as nx
 import os
 import tempfile
@@ -16,7 +17,9 @@ import subprocess
 from tqdm.auto import tqdm
 from .transformations import TRANSFORMATIONS
 from .mmseqs_utils import generate_edges_mmseqs
-from .needle_utils import parse_fasta, NORMALIZATIONS
+from .needle_utils import NORMALIZATIONS
+from .sequence_store import SequenceStore
+from .alignment_cache import AlignmentCache, sequence_hash
 
 
 # the elementary alignment operation for a pair. 
@@ -180,7 +183,7 @@ def _generate_needle_edges_pairwise_batch(
         lib_file: str,
         # sequences: Dict[str,str],
         # pairs: List[Tuple[str, str]],
-        seq_lens: Dict[str, int],
+        sequence_store: SequenceStore,
         transformation: str,
         denominator: str = 'full',
         triangular: bool = False,
@@ -254,7 +257,7 @@ def _generate_needle_edges_pairwise_batch(
                     identity = float(n_matches/(length-gaps))
                 else:
                     n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = NORMALIZATIONS[denominator](n_matches, seq_lens[this_qry], seq_lens[this_lib])
+                    identity = NORMALIZATIONS[denominator](n_matches, sequence_store.length(this_qry), sequence_store.length(this_lib))
                 
                 try:
                     metric = TRANSFORMATIONS[transformation](identity)
@@ -267,8 +270,75 @@ def _generate_needle_edges_pairwise_batch(
         
                                 
 
+# needleall aligns all queries of a batch against all library sequences. A batch may
+# align up to this many times as many pairs as were requested.
+MAX_ALIGNMENTS_PER_PAIR = 3
+# batches per worker, so that workers that finish early can pick up more.
+BATCHES_PER_WORKER = 4
+
+
+def batch_pairs(pairs: List[Tuple[str, str]], n_procs: int = 4) -> List[List[Tuple[str, str]]]:
+    '''
+    Group pairs into batches that can be aligned with one needleall call
+    each. A batch is aligned as all of its queries against all of its
+    library sequences, so pairs that share sequences are grouped together,
+    as long as the batch does not align more than MAX_ALIGNMENTS_PER_PAIR
+    times the requested pairs. The batch size is set so that each worker
+    gets BATCHES_PER_WORKER batches.
+    Pairs can be flipped, each pair is aligned in one direction.
+    '''
+    batch_size = max(1, int(np.ceil(len(pairs) / (n_procs * BATCHES_PER_WORKER))))
+
+    neighbours = {}
+    for n1, n2 in pairs:
+        neighbours.setdefault(n1, []).append(n2)
+        neighbours.setdefault(n2, []).append(n1)
+
+    # the sequence with more partners is the query, so that queries have long library lists.
+    by_query = {}
+    for n1, n2 in pairs:
+        if len(neighbours[n2]) > len(neighbours[n1]):
+            n1, n2 = n2, n1
+        by_query.setdefault(n1, []).append(n2)
+
+    # visit queries in breadth-first order, so that queries with shared partners are next to each other.
+    order, seen = [], set()
+    for root in by_query:
+        if root in seen:
+            continue
+        seen.add(root)
+        queue = [root]
+        while queue:
+            node = queue.pop(0)
+            if node in by_query:
+                order.append(node)
+            for other in neighbours[node]:
+                if other not in seen:
+                    seen.add(other)
+                    queue.append(other)
+
+    batches = []
+    batch, libs = [], set()
+    n_queries = 0
+    for qry in order:
+        qry_libs = by_query[qry]
+        new_libs = libs.union(qry_libs)
+        n_alignments = (n_queries + 1) * len(new_libs)
+        n_pairs = len(batch) + len(qry_libs)
+        if len(batch) > 0 and (n_pairs > batch_size or n_alignments > MAX_ALIGNMENTS_PER_PAIR * n_pairs):
+            batches.append(batch)
+            batch, new_libs, n_queries = [], set(qry_libs), 0
+        batch.extend((qry, lib) for lib in qry_libs)
+        libs = new_libs
+        n_queries += 1
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
 def generate_needle_edges_pairwise_mp(
-        sequences: Dict[str,str],
+        sequence_store: SequenceStore,
         pairs: List[Tuple[str, str]],
         full_graph: nx.classes.graph.Graph, 
         transformation: str,
@@ -285,50 +355,54 @@ def generate_needle_edges_pairwise_mp(
         endopen: float = 10,
         endextend: float = 0.5,
         matrix: str = 'EBLOSUM62', 
+        aligner: str = 'needleall',
+        results: Dict[Tuple[str,str], float] = None,
         ) -> None:
     '''
-    Splits up the list of pairs so that each parallel worker handles one.
-    Collects the results and inserts them into the graph.
+    Groups the pairs into batches, see `batch_pairs`, and aligns each
+    batch with one needleall call. Collects the results of the requested
+    pairs and inserts them into the graph.
+    pairs hold identifiers of sequence_store. In multiprocess mode, workers
+    attach to a copy of the store in shared memory instead of receiving the
+    sequence lengths with each batch.
+    If results is given, the metrics of all pairs are also collected there.
     '''
+    if aligner == 'builtin':
+        return _generate_builtin_edges_pairwise_mp(sequence_store, pairs, full_graph, transformation, threshold, denominator, n_procs, parallel_mode,
+                                                   gapopen, gapextend, endweight, endopen, endextend, matrix, results)
 
-    # split the list of pairs
-    chunks = np.array_split(pairs, len(pairs)/1)
+    batches = batch_pairs(pairs, n_procs)
+    index = sequence_store.index
 
-    # create a temporary directory
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for idx, pairs in tqdm(enumerate(chunks), desc='Writing files', leave=False):
-
-            # write the sequences to files for alignment
-            query_file = open(os.path.join(temp_dir, f'{idx}_query.fasta'), 'w')
-            lib_file = open(os.path.join(temp_dir, f'{idx}_lib.fasta'), 'w')
-            for n1, n2 in pairs:
-                query_file.write(f'>{n1}\n{sequences[n1]}\n')
-                lib_file.write(f'>{n2}\n{sequences[n2]}\n')
-
-            query_file.close()
-            lib_file.close()
-
-        # prepare seq lens once for all workers
-        seq_lens = {x: len(y) for x, y in sequences.items()}
-
-        # create a pool of workers
-        if parallel_mode == 'multithread':
-            executor = concurrent.futures.ThreadPoolExecutor(n_procs)
-        elif parallel_mode == 'multiprocess':
-            executor = concurrent.futures.ProcessPoolExecutor(n_procs)
-        else:
-            raise ValueError(f'Unknown parallel mode {parallel_mode}')
+    # threads read the store directly, processes attach to a shared copy.
+    shared = sequence_store.shared() if parallel_mode == 'multiprocess' else contextlib.nullcontext(sequence_store)
 
-        # print(f'Each chunk is {len(chunks[0])} pairs.')
-        
-        # submit the jobs
-        futures = []
-        for idx, chunk in enumerate(chunks):
-            futures.append(executor.submit(
-                _generate_needle_edges_pairwise_batch,#_generate_needle_edges_pairwise,
-                qry_file = os.path.join(temp_dir, f'{idx}_query.fasta'),
-                lib_file = os.path.join(temp_dir, f'{idx}_lib.fasta'),
-                seq_lens = seq_lens,
+    # create a pool of workers
+    if parallel_mode == 'multithread':
+        executor = concurrent.futures.ThreadPoolExecutor(n_procs)
+    elif parallel_mode == 'multiprocess':
+        executor = concurrent.futures.ProcessPoolExecutor(n_procs)
+    else:
+        raise ValueError(f'Unknown parallel mode {parallel_mode}')
+
+    # create a temporary directory
+    with shared as worker_store, tempfile.TemporaryDirectory() as temp_dir:
+
+        # write the files of each batch and submit it.
+        futures = {}
+        for idx, batch in enumerate(batches):
+            qry_file = os.path.join(temp_dir, f'{idx}_query.fasta')
+            lib_file = os.path.join(temp_dir, f'{idx}_lib.fasta')
+            with open(qry_file, 'w') as f:
+                sequence_store.write_fasta(f, (index[n1] for n1 in dict.fromkeys(n1 for n1, n2 in batch)))
+            with open(lib_file, 'w') as f:
+                sequence_store.write_fasta(f, (index[n2] for n2 in dict.fromkeys(n2 for n1, n2 in batch)))
+
+            future = executor.submit(
+                _generate_needle_edges_pairwise_batch,
+                qry_file = qry_file,
+                lib_file = lib_file,
+                sequence_store = worker_store,
                 transformation = transformation,
                 denominator = denominator,
                 triangular = triangular,
@@ -339,36 +413,181 @@ def generate_needle_edges_pairwise_mp(
                 endopen = endopen,
                 endextend = endextend,
                 matrix = matrix,
-            ))
+            )
+            futures[future] = batch
 
         # collect the results
-        pbar = tqdm(total=len(pairs))
+        pbar = tqdm(total=len(pairs), unit=' pairs')
         for future in concurrent.futures.as_completed(futures):
             if future.exception() is not None:
                 print(future.exception())
                 raise RuntimeError('One of the alignment processes did not complete sucessfully.')
             out_dict = future.result()
-            for pair, metric in out_dict.items():
-                
+            # the batch also aligned pairs that were not requested, these are not used.
+            for pair in futures[future]:
+                # needleall does not report pairs below its minimum score,
+                # as in _align_two_single_sequence_files.
+                metric = out_dict.get(pair)
+                aligned = metric is not None
+                if not aligned:
+                    metric = TRANSFORMATIONS[transformation](0.0)
+                if results is not None:
+                    results[pair] = metric
+
                 # if the exact metric does not violate the threshold,
                 # we can remove it from the graph
-                # we need to check whether it's actually in the graph though,
-                # as in chunk mode we also compute some alignments that are not
-                # required. needeall limitations ...
-                if (metric > threshold) and full_graph.has_edge(pair[0], pair[1]):
-                    full_graph.remove_edge(pair[0], pair[1])
+                if not aligned or metric > threshold:
+                    if full_graph.has_edge(pair[0], pair[1]):
+                        full_graph.remove_edge(pair[0], pair[1])
 
                 # otherwise, we insert the metric into the graph
                 else:
-                    full_graph.add_edge(pair[0], pair[1], metric=metric, delimiter=delimiter)
-                    
+                    full_graph.add_edge(pair[0], pair[1], metric=metric)
 
-            pbar.update(len(out_dict))
+            pbar.update(len(futures[future]))
+        pbar.close()
 
         # shutdown the pool of workers
         executor.shutdown(wait=True)
 
 
+def _generate_builtin_edges_pairwise_mp(
+        sequence_store: SequenceStore,
+        pairs: List[Tuple[str, str]],
+        full_graph: nx.classes.graph.Graph, 
+        transformation: str,
+        threshold: float,
+        denominator: str = 'full',
+        n_procs: int = 4,
+        parallel_mode: str = 'multithread',
+        gapopen: float = 10,
+        gapextend: float = 0.5,
+        endweight: bool = True,
+        endopen: float = 10,
+        endextend: float = 0.5,
+        matrix: str = 'EBLOSUM62', 
+        results: Dict[Tuple[str,str], float] = None,
+        ) -> None:
+    '''
+    Same as `generate_needle_edges_pairwise_mp`, but with the builtin aligner.
+    The pairs are sorted by query, so that each worker can align a query
+    against all its library sequences at once.
+    '''
+    from .nw_utils import align_pairs_builtin
+
+    pairs = sorted(pairs)
+    chunks = [pairs[i:i+1000] for i in range(0, len(pairs), 1000)]
+
+    if parallel_mode == 'multithread':
+        executor = concurrent.futures.ThreadPoolExecutor(n_procs)
+    elif parallel_mode == 'multiprocess':
+        executor = concurrent.futures.ProcessPoolExecutor(n_procs)
+    else:
+        raise ValueError(f'Unknown parallel mode {parallel_mode}')
+
+    # threads read the store directly, processes attach to a shared copy.
+    shared = sequence_store.shared() if parallel_mode == 'multiprocess' else contextlib.nullcontext(sequence_store)
+    with shared as worker_store:
+        futures = []
+        for chunk in chunks:
+            futures.append(executor.submit(align_pairs_builtin, worker_store, chunk, transformation, denominator,
+                                           gapopen, gapextend, endweight, endopen, endextend, matrix))
+
+        pbar = tqdm(total=len(pairs))
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                print(future.exception())
+                raise RuntimeError('One of the alignment processes did not complete sucessfully.')
+            out_dict = future.result()
+            if results is not None:
+                results.update(out_dict)
+            for pair, metric in out_dict.items():
+                if metric > threshold:
+                    if full_graph.has_edge(pair[0], pair[1]):
+                        full_graph.remove_edge(pair[0], pair[1])
+                else:
+                    full_graph.add_edge(pair[0], pair[1], metric=metric)
+
+            pbar.update(len(out_dict))
+
+        executor.shutdown(wait=True)
+
+
+# stratified sample of the mmseqs2 edges that is aligned with needle to calibrate the recompute band.
+CALIBRATION_BINS = 10
+CALIBRATION_PAIRS_PER_BIN = 100
+
+
+def sample_calibration_pairs(metrics: np.ndarray, threshold: float, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Draw a sample of the pairs with metrics above the threshold, stratified
+    into CALIBRATION_BINS bins of equal width. Sparse bins at the far end
+    of the range are then still represented.
+    Returns the indices of the sampled pairs and their weights, the number
+    of pairs that each of them represents.
+    '''
+    rng = np.random.default_rng(seed)
+    candidates = np.flatnonzero(metrics > threshold)
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    edges = np.linspace(threshold, metrics[candidates].max(), CALIBRATION_BINS + 1)
+    bins = np.clip(np.searchsorted(edges, metrics[candidates], side='left') - 1, 0, CALIBRATION_BINS - 1)
+
+    sample, weights = [], []
+    for b in range(CALIBRATION_BINS):
+        members = candidates[bins == b]
+        if len(members) == 0:
+            continue
+        chosen = rng.choice(members, size=min(len(members), CALIBRATION_PAIRS_PER_BIN), replace=False)
+        sample.append(chosen)
+        weights.append(np.full(len(chosen), len(members) / len(chosen)))
+
+    return np.concatenate(sample), np.concatenate(weights)
+
+
+def fit_recompute_threshold(metrics: np.ndarray, sample: np.ndarray, weights: np.ndarray, exact: np.ndarray,
+                            threshold: float, miss_rate: float, n_edges: int = 0) -> Tuple[float, int, float]:
+    '''
+    Pick the narrowest recompute band (threshold, recompute_threshold] for
+    which the expected fraction of missed edges is at most miss_rate.
+
+    The error of mmseqs2 is the difference between the exact metric of the
+    sampled pairs and their mmseqs2 metric. A pair outside the band with
+    mmseqs2 metric m is a missed edge if m + error <= threshold, which has
+    the probability of the weighted error distribution at threshold - m.
+    Pairs in the sample are known exactly, and are never missed.
+    metrics are the mmseqs2 metrics of the pairs above the threshold, and
+    n_edges is the number of edges of the graph that are already known.
+    Returns the recompute threshold, the number of pairs to recompute,
+    and the expected miss rate.
+    '''
+    errors = exact - metrics[sample]
+    order = np.argsort(errors)
+    errors, cdf = errors[order], np.cumsum(weights[order]) / weights.sum()
+
+    known = np.zeros(len(metrics), dtype=bool)
+    known[sample] = True
+    above = np.flatnonzero((metrics > threshold) & ~known)
+    above = above[np.argsort(metrics[above], kind='stable')]
+
+    # probability of each pair outside the sample to be an edge.
+    idx = np.searchsorted(errors, threshold - metrics[above], side='right') - 1
+    p_edge = np.where(idx >= 0, cdf[np.clip(idx, 0, None)], 0.0)
+
+    expected_edges = n_edges + np.sum(exact <= threshold) + p_edge.sum()
+    # expected misses when recomputing the k closest pairs.
+    missed = np.r_[np.cumsum(p_edge[::-1])[::-1], 0.0]
+    allowed = miss_rate * max(expected_edges, 1.0)
+    # the last position is always allowed, as it misses nothing.
+    k = int(np.flatnonzero(missed <= allowed)[0])
+
+    # ties at the band edge are recomputed as well.
+    recompute_threshold = float(metrics[above[k-1]]) if k > 0 else threshold
+    n_recompute = int(np.sum(metrics[above] <= recompute_threshold))
+    return recompute_threshold, n_recompute, float(missed[k] / max(expected_edges, 1.0))
+
+
 def generate_edges_mmseqs_needle_combined(
         entity_fp: str, 
         full_graph: nx.classes.graph.Graph, 
@@ -389,7 +608,15 @@ def generate_edges_mmseqs_needle_combined(
         endextend: float = 0.5,
         matrix: str = 'EBLOSUM62',
         use_prefilter: bool = False,
-        ) -> None:
+        aligner: str = 'needleall',
+        kmer_length: int = None,
+        min_shared_kmers: int = None,
+        split_memory_limit: str = None,
+        cache_dir: str = None,
+        miss_rate: float = None,
+        alignment_cache: str = None,
+        sequence_store: SequenceStore = None,
+        ) -> dict:
     '''
     First we run mmseqs2 on all sequences.
     If their mmseqs2 identity is below the recompute_threshold,
@@ -397,6 +624,15 @@ def generate_edges_mmseqs_needle_combined(
 
     The recompute_threshold therefore needs to be higher than the
     final threshold.
+
+    With miss_rate, the recompute_threshold is only the widest band that
+    is considered. A sample of the pairs is aligned with needle first, and
+    the band is narrowed as far as the expected fraction of missed edges
+    allows, see `fit_recompute_threshold`.
+    With alignment_cache, pairs whose exact metric is known from an
+    earlier run are not recomputed, see `alignment_cache.AlignmentCache`.
+    The sequences are read from sequence_store, or from entity_fp if it is not given.
+    Returns a summary of the recomputation for the report.
     '''
     
     # first run mmseqs2 to get the approximate values
@@ -412,30 +648,32 @@ def generate_edges_mmseqs_needle_combined(
         delimiter = delimiter,
         is_nucleotide = is_nucleotide,
         use_prefilter = use_prefilter,
+        kmer_length = kmer_length,
+        min_shared_kmers = min_shared_kmers,
+        n_threads = n_procs,
+        split_memory_limit = split_memory_limit,
+        cache_dir = cache_dir,
     )
 
     # above command inserted all pairwise distances into the graph.
     # MMseqs distances are overestimated. We now recompute the exact values
     # for all pairs with a distance above the recompute_threshold.
     pairs = []
+    metrics = []
+    n_edges = 0
     for u, v, data in full_graph.edges(data=True):
         if data['metric'] > threshold:
             pairs.append((u,v))
+            metrics.append(data['metric'])
+        else:
+            n_edges += 1
 
-    # get the sequences, make dict
-    ids, seqs = parse_fasta(entity_fp)
-    ids = [i[1:] for i in ids] # get clean ids ('>')
-    seqs = dict(zip(ids, seqs))
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp)
 
-    print('Computing NW values for %i pairs.' % len(pairs))
-
-    # compute the exact values
-    generate_needle_edges_pairwise_mp(
-        sequences = seqs,
-        pairs = pairs,
-        full_graph = full_graph,
+    needle_args = dict(
+        sequence_store = sequence_store,
         transformation = transformation,
-        threshold = threshold,
         denominator = denominator_needle,
         n_procs = n_procs,
         parallel_mode = parallel_mode,
@@ -448,11 +686,72 @@ def generate_edges_mmseqs_needle_combined(
         endopen = endopen,
         endextend = endextend,
         matrix = matrix,
+        aligner = aligner,
     )
 
+    summary = {'recompute_threshold_transformed': recompute_threshold}
+    results = {}
+    if alignment_cache is not None:
+        pair_params = dict(aligner=aligner, transformation=transformation, denominator=denominator_needle, nucleotide=is_nucleotide,
+                           gapopen=gapopen, gapextend=gapextend, endweight=endweight, endopen=endopen, endextend=endextend, matrix=matrix)
+        cache = AlignmentCache(alignment_cache, pair_params)
+        hashes = {id: sequence_hash(sequence_store.get(i)) for i, id in enumerate(sequence_store.ids)}
+        known = cache.lookup_pairs([(hashes[u], hashes[v]) for u, v in pairs], threshold)
+        remaining, remaining_metrics = [], []
+        for (u, v), metric in zip(pairs, metrics):
+            exact = known.get((hashes[u], hashes[v]))
+            if exact is None:
+                remaining.append((u, v))
+                remaining_metrics.append(metric)
+            elif exact > threshold:
+                full_graph.remove_edge(u, v)
+            else:
+                full_graph.add_edge(u, v, metric=exact)
+                n_edges += 1
+        print('Found %i of %i pairs in the alignment cache.' % (len(pairs) - len(remaining), len(pairs)))
+        summary['cached_pairs'] = len(pairs) - len(remaining)
+        pairs, metrics = remaining, remaining_metrics
+
+    if miss_rate is not None and len(pairs) > 0:
+        metrics = np.array(metrics)
+        sample, weights = sample_calibration_pairs(metrics, threshold)
+        sample_pairs = [pairs[i] for i in sample]
+        print('Calibrating the recompute threshold on %i pairs.' % len(sample_pairs))
+
+        # exact metrics of the sample, without a threshold.
+        sample_graph = nx.Graph()
+        generate_needle_edges_pairwise_mp(pairs = sample_pairs, full_graph = sample_graph, threshold = np.inf, results = results, **needle_args)
+        exact = np.array([sample_graph[u][v]['metric'] for u, v in sample_pairs])
+        for (u, v), metric in zip(sample_pairs, exact):
+            if metric > threshold:
+                full_graph.remove_edge(u, v)
+            else:
+                full_graph.add_edge(u, v, metric=metric)
+
+        recompute_threshold, n_recompute, expected_miss_rate = fit_recompute_threshold(metrics, sample, weights, exact, threshold, miss_rate, n_edges)
+        print(f'Recomputing {n_recompute} pairs with metrics up to {recompute_threshold:.4f}, expected miss rate {expected_miss_rate:.4f}.')
+
+        # pairs outside the band are left to mmseqs2, they are no edges.
+        in_sample = np.zeros(len(pairs), dtype=bool)
+        in_sample[sample] = True
+        for pair, metric, known in zip(pairs, metrics, in_sample):
+            if not known and metric > recompute_threshold:
+                full_graph.remove_edge(*pair)
+        pairs = [pair for pair, metric, known in zip(pairs, metrics, in_sample) if not known and metric <= recompute_threshold]
+
+        summary.update(recompute_threshold_transformed = recompute_threshold,
+                       calibration_pairs = len(sample_pairs),
+                       predicted_recompute_pairs = n_recompute,
+                       predicted_miss_rate = expected_miss_rate)
 
+    print('Computing NW values for %i pairs.' % len(pairs))
 
+    # compute the exact values
+    generate_needle_edges_pairwise_mp(pairs = pairs, full_graph = full_graph, threshold = threshold, results = results, **needle_args)
 
+    if alignment_cache is not None:
+        cache.store_pairs((hashes[u], hashes[v], metric) for (u, v), metric in results.items())
+        cache.close()
 
-
-
+    summary['recompute_pairs'] = len(pairs)
+    return summary
@@ -1,7 +1,16 @@
 import subprocess
 import os
 import shutil
-from .transformations import TRANSFORMATIONS
+import glob
+import hashlib
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+from .transformations import ARRAY_TRANSFORMATIONS, DECREASING_TRANSFORMATIONS
+from .csr_graph import CSRGraph, insert_edges
+from .needle_utils import length_feasible, feasible_length_range
 import networkx as nx
 from tqdm.auto import tqdm
 
@@ -13,6 +22,159 @@ from tqdm.auto import tqdm
 
 
 
+def write_prefilter_db(seq_db: str,
+                       pref_db: str,
+                       denominator: str,
+                       transformation: str,
+                       threshold: float,
+                       kmer_length: int = None,
+                       min_shared_kmers: int = None,
+                       ) -> Tuple[int, int]:
+    '''
+    Write a prefilter result for aligning seq_db against itself, so that
+    `mmseqs align` can be run without `mmseqs prefilter`.
+    Each sequence gets all targets as prefilter hits, except for those whose
+    lengths are too different to reach the threshold (see `length_feasible`)
+    and, if min_shared_kmers is given, those that share fewer k-mers
+    (see `kmer_utils.find_candidate_pairs`).
+
+    As in the prefilter trick of the MMseqs2 user guide, the hits are the
+    lines of the target index. Returns the number of pairs to align and
+    the number of all pairs.
+    '''
+    with open(seq_db + '.index', 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    keys = [line.split(b'\t')[0].decode() for line in lines]
+    offsets = np.array([int(line.split(b'\t')[1]) for line in lines], dtype=np.int64)
+    # entries end with a newline and a null byte.
+    lengths = np.array([int(line.split(b'\t')[2]) for line in lines], dtype=np.int64) - 2
+
+    if min_shared_kmers is None:
+        # sorted by length, the feasible targets of each sequence are one contiguous block of lines.
+        order = np.argsort(lengths, kind='stable')
+        block = b''.join(lines[i] for i in order)
+        line_ends = np.r_[0, np.cumsum([len(lines[i]) for i in order])]
+        starts, ends = feasible_length_range(lengths, lengths[order], denominator, transformation, threshold)
+        n_pairs = int(np.sum(ends - starts))
+        entries = (block[line_ends[start]:line_ends[end]] for start, end in zip(starts.tolist(), ends.tolist()))
+    else:
+        from .kmer_utils import DEFAULT_KMER_LENGTH, find_candidate_pairs
+        with open(seq_db, 'rb') as f:
+            seq_data = f.read()
+        seqs = [seq_data[o:o+l].decode('ascii', errors='replace') for o, l in zip(offsets.tolist(), lengths.tolist())]
+        queries, libs = find_candidate_pairs(seqs, kmer_length or DEFAULT_KMER_LENGTH[False], min_shared_kmers)
+        # the candidates are unordered pairs, align both directions as without the k-mer floor.
+        queries, libs = np.r_[queries, libs], np.r_[libs, queries]
+        feasible = length_feasible(lengths[queries], lengths[libs], denominator, transformation, threshold)
+        order = np.argsort(queries[feasible], kind='stable')
+        queries, libs = queries[feasible][order], libs[feasible][order]
+        bounds = np.searchsorted(queries, np.arange(len(keys) + 1))
+        n_pairs = len(queries)
+        entries = (b''.join(lines[t] for t in libs[bounds[i]:bounds[i+1]].tolist()) for i in range(len(keys)))
+
+    with open(pref_db, 'wb') as data, open(pref_db + '.index', 'w') as index:
+        position = 0
+        for key, entry in zip(keys, entries):
+            data.write(entry + b'\0')
+            index.write(f'{key}\t{position}\t{len(entry) + 1}\n')
+            position += len(entry) + 1
+
+    # dbtype 7: prefilter result.
+    with open(pref_db + '.dbtype', 'wb') as f:
+        f.write(bytes([7, 0, 0, 0]))
+
+    return n_pairs, len(keys) * len(keys)
+
+
+def load_alignments(alignments_fp: str,
+                    full_graph: nx.classes.graph.Graph,
+                    transformation: str,
+                    threshold: float,
+                    delimiter: str = '|',
+                    chunk_size: int = 1000000) -> None:
+    '''
+    Insert the alignments of a `convertalis` output with the columns
+    query, target and fident into the graph.
+    The file is read in chunks of chunk_size lines. Identifiers are mapped
+    to nodes once per distinct value, edges are inserted in bulk.
+    '''
+    if os.path.getsize(alignments_fp) == 0:
+        return
+
+    if isinstance(full_graph, CSRGraph):
+        nodes = full_graph.ids
+    else:
+        nodes = list(full_graph.nodes())
+    node_index = pd.Index(nodes)
+
+    def to_nodes(column: pd.Series) -> np.ndarray:
+        # alignments only have a few distinct identifiers, split them instead of all values.
+        codes, uniques = pd.factorize(column)
+        return node_index.get_indexer([u.split(delimiter)[0] for u in uniques])[codes]
+
+    reader = pd.read_csv(alignments_fp, sep='\t', header=None, usecols=[0, 1, 2],
+                         dtype={0: str, 1: str, 2: np.float64}, chunksize=chunk_size, engine='c')
+    pbar = tqdm(unit=' alignments')
+    for chunk in reader:
+        metric = ARRAY_TRANSFORMATIONS[transformation](chunk[2].to_numpy())
+        qry, lib = to_nodes(chunk[0]), to_nodes(chunk[1])
+        # nodes that are missing in the graph are skipped.
+        keep = (qry != lib) & ~(metric > threshold) & (qry >= 0) & (lib >= 0)
+        insert_edges(full_graph, nodes, qry[keep], lib[keep], metric[keep])
+        pbar.update(len(chunk))
+    pbar.close()
+
+
+def fasta_hash(entity_fp: str) -> str:
+    '''Hash of the content of a fasta file, to find its cached databases.'''
+    sha = hashlib.sha256()
+    with open(entity_fp, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def get_seq_db(entity_fp: str, work_dir: str, is_nucleotide: bool = False, create_index: bool = False, thread_args: List[str] = []) -> str:
+    '''
+    Get the mmseqs2 sequence database of the fasta file in work_dir,
+    and create it if it does not exist yet. The database directory is
+    named by the hash of the fasta file and the database type, so that
+    it can be reused by later runs on the same data.
+    Returns the path of the database.
+    '''
+    typ = '2' if is_nucleotide else '1'
+    db_dir = os.path.join(work_dir, f'{fasta_hash(entity_fp)}_{typ}')
+    seq_db = os.path.join(db_dir, 'seq_db')
+
+    if not os.path.exists(seq_db + '.dbtype'):
+        # build in a separate directory, so that an interrupted run does not leave a broken database.
+        build_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            subprocess.run(['mmseqs', 'createdb', '--dbtype', typ, entity_fp, os.path.join(build_dir, 'seq_db')], check=True)
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        try:
+            os.rename(build_dir, db_dir)
+        except OSError:
+            # another run created it in the meantime.
+            shutil.rmtree(build_dir, ignore_errors=True)
+    else:
+        print(f'Using cached MMseqs2 database {seq_db}.')
+
+    if create_index and not os.path.exists(seq_db + '.idx'):
+        with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+            try:
+                subprocess.run(['mmseqs', 'createindex', seq_db, tmp_dir, '-s', '7.5'] + thread_args, check=True)
+            except BaseException:
+                # a partial index would be used by later runs.
+                for path in glob.glob(seq_db + '.idx*'):
+                    os.remove(path)
+                raise
+
+    return seq_db
+
+
 def generate_edges_mmseqs(entity_fp: str, 
                   full_graph: nx.classes.graph.Graph, 
                   tranformation: str,
@@ -22,60 +184,94 @@ def generate_edges_mmseqs(entity_fp: str,
                   delimiter: str = '|',
                   is_nucleotide: bool = False,
                   use_prefilter: bool = False,
+                  kmer_length: int = None,
+                  min_shared_kmers: int = None,
+                  n_threads: int = None,
+                  split_memory_limit: str = None,
+                  cache_dir: str = None,
                   ) -> None:
+    '''
+    Run mmseqs2 on the fasta file and insert the found edges into the graph.
+    Without use_prefilter, proteins are aligned all-vs-all, except for the pairs
+    that are left out by `write_prefilter_db`.
+    n_threads and split_memory_limit are passed to mmseqs2. By default,
+    mmseqs2 uses all cores and all memory.
+
+    With cache_dir, the databases are kept there for later runs, see
+    `get_seq_db`. The alignments are kept as well, and reused by runs with
+    the same parameters and the same or a stricter threshold.
+    Otherwise, everything is written to a temporary directory.
+    '''
 
 
     if shutil.which('mmseqs') is None:
         print('MMseqs2 was not found. Please run `conda install -c conda-forge -c bioconda mmseqs2`')
         exit()
 
-    os.makedirs('temp', exist_ok=True)
+    thread_args = ['--threads', str(n_threads)] if n_threads is not None and n_threads > 0 else []
 
-    # Run all mmseqs ops to get a tab file that contains the alignments.
-    typ = '2' if is_nucleotide else '1'
-    subprocess.run(['mmseqs', 'createdb', '--dbtype', typ, entity_fp, 'temp/seq_db'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = tmp_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            work_dir = cache_dir
 
-    # However, this function will not work with nucleotidenucleotide searches, 
-    # since we need to have a valid diagonal for the banded alignment.
-    if is_nucleotide or use_prefilter:
-        subprocess.run(['mmseqs', 'prefilter', '-s', '7.5', 'temp/seq_db', 'temp/seq_db', 'temp/pref'])
-    else:
-        subprocess.run(['mmseqs_fake_prefilter.sh', 'temp/seq_db', 'temp/seq_db', 'temp/pref', 'seq_db'])
-
-    # 0: alignment length 1: shorter, 2: longer sequence
-    id_mode = {'n_aligned':'0', 'shortest':'1', 'longest':'2'}[denominator]
-    
-    command = ['mmseqs', 'align',  'temp/seq_db', 'temp/seq_db', 'temp/pref', 'temp/align_db', '--alignment-mode', '3', '-e', 'inf', '--seq-id-mode', id_mode]
-    if threshold_original is not None:
-        command = command + ['--min-seq-id', str(threshold_original)]
-    subprocess.run(command)
-    subprocess.run(['mmseqs', 'convertalis', 'temp/seq_db', 'temp/seq_db', 'temp/align_db', 'temp/alignments.tab'])
-
-    # Read the result
-    with open('temp/alignments.tab') as inf:
-        for line_nr, line in tqdm(enumerate(inf)):
-            spl = line.strip().split('\t')
-
-            this_qry = spl[0].split(delimiter)[0]
-            this_lib = spl[1].split(delimiter)[0]
-            ident = float(spl[2])
+        seq_db = get_seq_db(entity_fp, work_dir, is_nucleotide, create_index=use_prefilter and not is_nucleotide and cache_dir is not None, thread_args=thread_args)
+
+        # alignments depend on these parameters, and on the threshold.
+        params = {'denominator': denominator, 'prefilter': is_nucleotide or use_prefilter, 'transformation': str(tranformation),
+                  'kmer_length': kmer_length, 'min_shared_kmers': min_shared_kmers}
+        params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        align_dir = os.path.join(os.path.dirname(seq_db), f'align_{params_hash}')
+        params_file = os.path.join(align_dir, 'params.json')
+        alignments_fp = os.path.join(align_dir, 'alignments.tab')
+
+        cached = None
+        if os.path.exists(params_file):
+            with open(params_file) as f:
+                cached = json.load(f)
+        # alignments found at a looser threshold contain all alignments of a stricter one.
+        reusable = cached is not None and (cached['threshold_transformed'] == threshold_transformed or
+                   (tranformation in DECREASING_TRANSFORMATIONS and cached['threshold_transformed'] >= threshold_transformed))
 
+        if reusable:
+            print(f'Using cached MMseqs2 alignments {alignments_fp}.')
+        else:
+            shutil.rmtree(align_dir, ignore_errors=True)
+            os.makedirs(align_dir)
             try:
-                metric = TRANSFORMATIONS[tranformation](ident)
-            except ValueError or TypeError:
-                raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (spl[1]))
+                pref_db, align_db = os.path.join(align_dir, 'pref'), os.path.join(align_dir, 'align_db')
+
+                # Run all mmseqs ops to get a tab file that contains the alignments.
+                # However, this function will not work with nucleotidenucleotide searches, 
+                # since we need to have a valid diagonal for the banded alignment.
+                if is_nucleotide or use_prefilter:
+                    command = ['mmseqs', 'prefilter', '-s', '7.5', seq_db, seq_db, pref_db] + thread_args
+                    if split_memory_limit is not None:
+                        command = command + ['--split-memory-limit', split_memory_limit]
+                    subprocess.run(command, check=True)
+                else:
+                    n_pairs, n_all = write_prefilter_db(seq_db, pref_db, denominator, tranformation, threshold_transformed, kmer_length, min_shared_kmers)
+                    print(f'Aligning {n_pairs} of {n_all} pairs, skipped pairs cannot reach the threshold.')
+
+                # 0: alignment length 1: shorter, 2: longer sequence
+                id_mode = {'n_aligned':'0', 'shortest':'1', 'longest':'2'}[denominator]
             
-            if this_qry == this_lib:
-                continue
-            if metric > threshold_transformed:
-                continue
-            if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                continue
-            if full_graph.has_edge(this_qry, this_lib):
-                if full_graph[this_qry][this_lib]['metric'] > metric:
-                    #nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-                    full_graph.add_edge(this_qry, this_lib, metric=metric) #Notes: Adding an edge that already exists updates the edge data. 
-            else:
-                full_graph.add_edge(this_qry, this_lib, metric=metric)  
-
-    shutil.rmtree('temp', ignore_errors=True)
+                command = ['mmseqs', 'align', seq_db, seq_db, pref_db, align_db, '--alignment-mode', '3', '-e', 'inf', '--seq-id-mode', id_mode] + thread_args
+                if threshold_original is not None:
+                    command = command + ['--min-seq-id', str(threshold_original)]
+                subprocess.run(command, check=True)
+                # only the columns that are used. fident is the sequence identity according to --seq-id-mode.
+                subprocess.run(['mmseqs', 'convertalis', seq_db, seq_db, align_db, alignments_fp,
+                                '--format-output', 'query,target,fident'] + thread_args, check=True)
+
+                # written last, marks the alignments as complete.
+                with open(params_file, 'w') as f:
+                    json.dump(dict(params, threshold_transformed=threshold_transformed, threshold_original=threshold_original), f)
+            except BaseException:
+                # failed or interrupted alignments must not be reused.
+                shutil.rmtree(align_dir, ignore_errors=True)
+                raise
+
+        # Read the result
+        load_alignments(alignments_fp, full_graph, tranformation, threshold_transformed, delimiter)
@@ -9,6 +9,7 @@ import pandas as pd
 import networkx as nx
 from tqdm.auto import tqdm
 from .graph_part import partition_and_remove
+from .node_table import NodeTable
 
 
 # TODO
@@ -19,9 +20,8 @@ from .graph_part import partition_and_remove
 
 def load_entities(molecules: Dict[str,str], labels: Dict[str,str] = None, priorities: Dict[str,str] = None):
     '''
-    Construct the graphs by adding nodes. No edges are generated in this step.
+    Construct the graph and the table of entities by adding nodes. No edges are generated in this step.
     '''
-    part_graph = nx.Graph()
     full_graph = nx.Graph()
 
     labels_out = {}
@@ -41,7 +41,6 @@ def load_entities(molecules: Dict[str,str], labels: Dict[str,str] = None, priori
         label = labels_out[label]['val']
 
         full_graph.add_node(id)
-        part_graph.add_node(id)
         node_data = {
         'priority': priority,
         'label-val': label
@@ -49,7 +48,7 @@ def load_entities(molecules: Dict[str,str], labels: Dict[str,str] = None, priori
         nx.set_node_attributes(full_graph, {id:node_data})
 
             
-    return full_graph, part_graph, labels_out
+    return full_graph, NodeTable.from_graph(full_graph), labels_out
 
 
 
@@ -147,6 +146,7 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
                      valid_size: float = 0,
                      threshold: float = 0.3,
                      initialization_mode: str = 'slow-nn',
+                     largest_first: bool = False,
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
@@ -179,7 +179,7 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
     molecules, labels, priority = _convert_to_dict(molecules, labels, priority)
 
     # make the graph
-    full_graph, part_graph, labels = load_entities(molecules, labels, priority)
+    full_graph, node_table, labels = load_entities(molecules, labels, priority)
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
         labels[l]['lim'] = labels[l]['num']//partitions
@@ -198,6 +198,7 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
         "priority_name": "priority" if priority is not None else None,
         "labels_name": "label" if labels is not None else None,
         "initialization_mode": initialization_mode,
+        "largest_first": largest_first,
         "no_moving": no_moving,
         "remove_same": remove_same,
         "test_ratio": test_size,
@@ -210,7 +211,7 @@ def train_test_validation_split(molecules: Union[List[str], np.ndarray, Dict[str
         "removal_type": not remove_same,
     }
 
-    partition_assignment_df = partition_and_remove(full_graph, part_graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
+    partition_assignment_df = partition_and_remove(full_graph, node_table, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -231,6 +232,7 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
                      partitions: int = 5,
                      threshold: float = 0.3,
                      initialization_mode: str = 'slow-nn',
+                     largest_first: bool = False,
                      no_moving: bool = False,
                      remove_same: bool = False,
                      save_checkpoint_path: str = None,
@@ -251,7 +253,7 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
     molecules, labels, priority = _convert_to_dict(molecules, labels, priority)
 
     # make the graph
-    full_graph, part_graph, labels = load_entities(molecules, labels, priority)
+    full_graph, node_table, labels = load_entities(molecules, labels, priority)
     for l in labels:
         """ Find the expected number of entities labelled l in any partition """
         labels[l]['lim'] = labels[l]['num']//partitions
@@ -270,6 +272,7 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
         "priority_name": "priority" if priority is not None else None,
         "labels_name": "label" if labels is not None else None,
         "initialization_mode": initialization_mode,
+        "largest_first": largest_first,
         "no_moving": no_moving,
         "remove_same": remove_same,
         "test_ratio": 0,
@@ -282,7 +285,7 @@ def stratified_k_fold(molecules: Union[List[str], np.ndarray, Dict[str,str]],
         "removal_type": not remove_same,
     }
 
-    partition_assignment_df = partition_and_remove(full_graph, part_graph, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
+    partition_assignment_df = partition_and_remove(full_graph, node_table, labels, json_dict={}, threshold=threshold, config=config, verbose=verbose)
 
     # 4. Make output lists.
     partition_assignment_df = partition_assignment_df.reset_index()
@@ -3,17 +3,22 @@ This file contains functions that call needleall on a provided
 .fasta file and insert the computed pairwise sequence identities
 as edges into a provided networkx graph.
 '''
+import contextlib
 import multiprocessing
 import networkx as nx
 from os import path, remove
 import shutil
 import numpy as np
 import math
+import itertools
 from itertools import groupby
 from typing import Dict, List, Tuple, Iterator
 import concurrent.futures
+import pandas as pd
 from tqdm.auto import tqdm
-from .transformations import TRANSFORMATIONS
+from .transformations import TRANSFORMATIONS, ARRAY_TRANSFORMATIONS, DECREASING_TRANSFORMATIONS
+from .csr_graph import CSRGraph, EdgeBuffer, insert_edge, insert_edges
+from .sequence_store import SequenceStore
 
 
 NORMALIZATIONS = {'shortest': lambda a,b,c: a/min(b,c), # a identity b len(seq1) c len(seq2)
@@ -21,15 +26,85 @@ NORMALIZATIONS = {'shortest': lambda a,b,c: a/min(b,c), # a identity b len(seq1)
                   'mean' : lambda a,b,c: a/((b+c)/2),
                   }
 
+# Upper bound of the identity of two sequences, given only their lengths a and b.
+# At most min(a,b) positions are identical, and a global alignment is at least max(a,b) long.
+# `shortest` and `no_gaps` can reach 100% at any lengths.
+IDENTITY_BOUNDS = {'full': lambda a,b: np.minimum(a,b)/np.maximum(a,b),
+                   'longest': lambda a,b: np.minimum(a,b)/np.maximum(a,b),
+                   'mean': lambda a,b: np.minimum(a,b)/((a+b)/2),
+                   }
 
 
-def get_len_dict(ids: List[str], seqs: List[str]) -> Dict[str,int]:
-    '''Get a dictionary that contains the length of each sequence.'''
-    len_dict = {}
-    for id, seq in zip(ids, seqs):
-        len_dict[id.lstrip('>')] = len(seq)
-    
-    return len_dict
+
+def length_feasible(len_a, len_b, denominator: str, transformation: str, threshold: float) -> np.ndarray:
+    '''
+    Check which pairs of sequences can reach the threshold at all, given
+    only their lengths. Works on scalars and on arrays of lengths.
+    Pairs for which this is False never need to be aligned.
+    '''
+    if denominator not in IDENTITY_BOUNDS or transformation not in DECREASING_TRANSFORMATIONS:
+        return np.ones(np.broadcast(len_a, len_b).shape, dtype=bool)
+    bound = IDENTITY_BOUNDS[denominator](np.asarray(len_a, dtype=np.float64), np.asarray(len_b, dtype=np.float64))
+    # needle rounds the full identity to 0.1%, leave some room for that.
+    return ~(ARRAY_TRANSFORMATIONS[transformation](bound + 0.001) > threshold)
+
+
+def feasible_length_range(lengths: np.ndarray, sorted_lengths: np.ndarray, denominator: str, transformation: str, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    For each length in lengths, find the range start:end of sorted_lengths
+    that passes `length_feasible`. The bound only depends on the ratio of
+    the lengths, so the feasible lengths are contiguous once sorted.
+    All ranges are found at once with a vectorised binary search.
+    '''
+    lengths = np.asarray(lengths)
+    own = np.searchsorted(sorted_lengths, lengths)
+    n = len(sorted_lengths)
+
+    def search(lo, hi, feasible_below):
+        # first index in lo:hi at which feasibility flips.
+        while np.any(lo < hi):
+            mid = (lo + hi) // 2
+            ok = length_feasible(lengths, sorted_lengths[np.minimum(mid, n-1)], denominator, transformation, threshold)
+            go_right = ok != feasible_below
+            lo, hi = np.where(go_right & (lo < hi), mid + 1, lo), np.where(go_right | (lo >= hi), hi, mid)
+        return lo
+
+    # shorter lengths: infeasible ... feasible. longer lengths: feasible ... infeasible.
+    starts = search(np.zeros_like(own), own, feasible_below=True)
+    ends = search(own, np.full_like(own, n), feasible_below=False)
+    # if even equal lengths are infeasible, the range is empty.
+    empty = ~length_feasible(lengths, lengths, denominator, transformation, threshold)
+    return np.where(empty, 0, starts), np.where(empty, 0, ends)
+
+
+def new_sequence_pairs(seqs: List[str], is_new: np.ndarray, denominator: str, transformation: str, threshold: float,
+                       prefilter: bool = False, kmer_length: int = None, min_shared_kmers: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Find the pairs of sequences that involve at least one new sequence
+    and can reach the threshold by length, each pair once.
+    With prefilter, only the candidate pairs of the k-mer index are used,
+    see `kmer_utils.find_candidate_pairs`.
+    Returns the pairs as index arrays (queries, libs).
+    '''
+    lengths = np.array([len(seq) for seq in seqs])
+    if prefilter:
+        from .kmer_utils import find_candidate_pairs
+        queries, libs = find_candidate_pairs(seqs, kmer_length, min_shared_kmers)
+        keep = is_new[queries] | is_new[libs]
+        queries, libs = queries[keep], libs[keep]
+        feasible = length_feasible(lengths[queries], lengths[libs], denominator, transformation, threshold)
+        return queries[feasible], libs[feasible]
+
+    new = np.flatnonzero(is_new)
+    order = np.argsort(lengths, kind='stable')
+    starts, ends = feasible_length_range(lengths[new], lengths[order], denominator, transformation, threshold)
+    counts = ends - starts
+    queries = np.repeat(new, counts)
+    libs = order[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+    # pairs of two new sequences are kept in one direction.
+    keep = (libs != queries) & (~is_new[libs] | (libs > queries))
+    return queries[keep], libs[keep]
+
 
 def parse_fasta(fastafile: str, sep='|') -> Tuple[List[str],List[str]]:
     '''
@@ -53,31 +128,70 @@ def parse_fasta(fastafile: str, sep='|') -> Tuple[List[str],List[str]]:
     return ids, seqs
 
 
-def chunk_fasta_file(ids: List[str], seqs: List[str], n_chunks: int) -> int:
+def balance_chunks(lengths: List[int], n_chunks: int) -> List[np.ndarray]:
+    '''
+    Split the sequences into at most n_chunks chunks with about the same
+    number of residues. Aligning two chunks costs the sum of len(a)*len(b)
+    over all their pairs, which is the product of their residue counts,
+    so all pairs of chunks cost about the same.
+    Sequences are sorted by length, so that each chunk holds sequences
+    of similar length.
+    Returns the indices of the sequences in each chunk.
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return []
+    order = np.argsort(lengths, kind='stable')
+    residues = np.cumsum(lengths[order])
+    # cut where the running residue count reaches the next multiple of total/n_chunks.
+    cuts = np.searchsorted(residues, residues[-1] * np.arange(1, n_chunks) / n_chunks, side='right')
+    return [chunk for chunk in np.split(order, cuts) if len(chunk) > 0]
+
+
+def chunk_fasta_file(sequence_store: SequenceStore, n_chunks: int) -> List[np.ndarray]:
     '''
     Break up fasta file into multiple smaller files that can be
-    used for multiprocessing.
-    Returns the number of generated chunks.
+    used for multiprocessing. The chunks are balanced by their
+    number of residues, see `balance_chunks`. A single chunk keeps
+    the order of the file.
+    Returns the indices of the sequences in each generated chunk.
     '''
+    if n_chunks == 1:
+        chunks = [np.arange(len(sequence_store))] if len(sequence_store) > 0 else []
+    else:
+        chunks = balance_chunks(sequence_store.lengths, n_chunks)
 
-    chunk_size = math.ceil(len(ids)/n_chunks)
+    for i, chunk in enumerate(chunks):
+        with open(f'graphpart_{i}.fasta.tmp', 'w') as f:
+            sequence_store.write_fasta(f, chunk)
 
-    empty_chunks = 0
-    for i in range(n_chunks):
-        # because of ceil() we sometimes make less partitions than specified.
-        if i*chunk_size>=len(ids):
-            empty_chunks +=1
-            continue
+    return chunks
 
-        chunk_ids = ids[i*chunk_size:(i+1)*chunk_size]
-        chunk_seqs = seqs[i*chunk_size:(i+1)*chunk_size]
 
-        with open(f'graphpart_{i}.fasta.tmp', 'w') as f:
-            for id, seq in zip(chunk_ids, chunk_seqs):
-                f.write(id+'\n')
-                f.write(seq+'\n')
+def _map_to_graph(full_graph: nx.classes.graph.Graph, ids: List[str]) -> Tuple[List[str], np.ndarray]:
+    '''
+    Get the nodes of the graph and an array that maps the index of
+    each identifier in ids to its index in the nodes, or -1.
+    '''
+    if isinstance(full_graph, CSRGraph):
+        nodes = full_graph.ids
+    else:
+        nodes = list(full_graph.nodes())
+    return nodes, pd.Index(nodes).get_indexer(ids)
 
-    return n_chunks - empty_chunks
+
+def _insert_edge_buffer(full_graph: nx.classes.graph.Graph, nodes: List[str], remap: np.ndarray, edges: EdgeBuffer) -> None:
+    '''
+    Insert the edges of a worker into the graph. The ids in the buffer
+    are mapped to nodes with remap, see `_map_to_graph`.
+    '''
+    qry, lib, metric = edges.arrays()
+    if len(qry) > 0:
+        qry, lib = np.where(qry < 0, -1, remap[qry]), np.where(lib < 0, -1, remap[lib])
+    # NOTE this case should raise an error - graph was constructed from same file before, and so all the nodes should be there.
+    if (qry < 0).any() or (lib < 0).any():
+        raise RuntimeError('Tried to insert an edge into the graph, but did not find its nodes. This should not happen, please report a bug.')
+    insert_edges(full_graph, nodes, qry, lib, metric)
 
 
 def generate_edges(entity_fp: str, 
@@ -93,21 +207,40 @@ def generate_edges(entity_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
-                  ) -> None:
+                  aligner: str = 'needleall',
+                  sequence_store: SequenceStore = None,
+                  ) -> int:
     '''
     Call needleall and insert found edges into the graph as they are computed.
     This is the default implementation that runs one single process for the full
     dataset without multithreading.
+    With aligner='builtin', the alignments are computed in-process instead,
+    skipping pairs whose lengths cannot reach the threshold.
+    The sequences are read from sequence_store, or from entity_fp if it is not given.
+    Returns the number of skipped alignments.
     '''
-    if shutil.which('needleall') is None:
+    if aligner == 'needleall' and shutil.which('needleall') is None:
         print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
         exit()
 
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp, delimiter)
+
+    if aligner == 'builtin':
+        from .nw_utils import compute_edges_builtin
+        nodes, remap = _map_to_graph(full_graph, sequence_store.ids)
+        all_idx = np.arange(len(sequence_store))
+        skipped = 0
+        for qry in tqdm(range(len(sequence_store))):
+            count, edges = compute_edges_builtin([qry], all_idx, sequence_store, tranformation, threshold, denominator,
+                                                 gapopen, gapextend, endweight, endopen, endextend, matrix)
+            skipped += len(sequence_store) - 1 - count
+            _insert_edge_buffer(full_graph, nodes, remap, edges)
+        print(f'Skipped {skipped} alignments of sequences whose lengths are too different to reach the threshold.')
+        return skipped
+
     # rewrite the .fasta file to prevent issues with '|'
-    ids, seqs = parse_fasta(entity_fp, delimiter)
-    seq_lens = get_len_dict(ids, seqs)
-    #import ipdb; ipdb.set_trace()
-    chunk_fasta_file(ids, seqs,n_chunks=1)
+    chunk_fasta_file(sequence_store, n_chunks=1)
 
     if is_nucleotide:
         type_1, type_2, = '-snucleotide1', '-snucleotide2'
@@ -161,7 +294,7 @@ def generate_edges(entity_fp: str,
                     identity = float(n_matches/(length-gaps))
                 else:
                     n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = NORMALIZATIONS[denominator](n_matches, seq_lens[this_qry], seq_lens[this_lib])
+                    identity = NORMALIZATIONS[denominator](n_matches, sequence_store.length(this_qry), sequence_store.length(this_lib))
                 #line = "# Identity:      14/443 ( 3.2%)"
                 # n_matches =  int(line[11:].split('/')[0]) #int() does not mind leading spaces
 
@@ -177,14 +310,10 @@ def generate_edges(entity_fp: str,
                 # NOTE this case should raise an error - graph was constructed from same file before, and so all the nodes should be there.
                 if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
                     raise RuntimeError(f'Tried to insert edge {this_qry}-{this_lib} into the graph, but did not find nodes. This should not happen, please report a bug.')
-                if full_graph.has_edge(this_qry, this_lib):
-                    if full_graph[this_qry][this_lib]['metric'] > metric:
-                        nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-                        
-                else:
-                    full_graph.add_edge(this_qry, this_lib, metric=metric)
+                insert_edge(full_graph, this_qry, this_lib, metric)
 
     remove('graphpart_0.fasta.tmp')
+    return 0
 
 from multiprocessing import Manager
 
@@ -192,7 +321,7 @@ def compute_edges(query_fp: str,
                   library_fp: str,
                   transformation: str,
                   threshold: float,
-                  seq_lens: Dict[str,int],
+                  sequence_store: SequenceStore,
                   denominator = 'full',
                   delimiter: str = '|',
                   is_nucleotide: bool = False,
@@ -202,13 +331,15 @@ def compute_edges(query_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
-                  ) -> Tuple[int, List[Tuple[str,str,float]]]:
+                  ) -> Tuple[int, EdgeBuffer]:
     '''
     Run needleall on query_fp and library_fp,
     Retrieve pairwise similiarities, transform and
-    insert into edge_dict.
+    collect the edges within the threshold as they are parsed.
+    Returns the number of alignments and the edges, with identifiers
+    replaced by their index in sequence_store (-1 if missing).
     '''
-    identity_list = []
+    edges = EdgeBuffer()
 
     if is_nucleotide:
         type_1, type_2, = '-snucleotide1', '-snucleotide2'
@@ -265,7 +396,7 @@ def compute_edges(query_fp: str,
                     identity = float(n_matches/(length-gaps))
                 else:
                     n_matches =  int(identity_line[11:].split('/')[0]) #int() does not mind leading spaces
-                    identity = NORMALIZATIONS[denominator](n_matches, seq_lens[this_qry], seq_lens[this_lib])
+                    identity = NORMALIZATIONS[denominator](n_matches, sequence_store.length(this_qry), sequence_store.length(this_lib))
                 #line = "# Identity:      14/443 ( 3.2%)"
                 # n_matches =  int(line[11:].split('/')[0]) #int() does not mind leading spaces
                 
@@ -279,11 +410,10 @@ def compute_edges(query_fp: str,
                 if metric > threshold:
                     continue
                 
-                identity_list.append((this_qry, this_lib, metric))
-                # NOTE this case should raise an error - graph was constructed from same file before, and so all the nodes should be there.
- 
+                edges.append(sequence_store.index.get(this_qry, -1), sequence_store.index.get(this_lib, -1), metric)
+
 
-    return (count, identity_list)
+    return (count, edges)
 
 def generate_edges_mp(entity_fp: str, 
                   full_graph: nx.classes.graph.Graph, 
@@ -302,87 +432,122 @@ def generate_edges_mp(entity_fp: str,
                   endopen: float = 10,
                   endextend: float = 0.5,
                   matrix: str = 'EBLOSUM62',
-                  ) -> None:
+                  aligner: str = 'needleall',
+                  sequence_store: SequenceStore = None,
+                  ) -> int:
     '''
     Call needleall to compute all pairwise sequence identities in the dataset.
     Uses chunked fasta files and multiple threads with needelall subprocesses 
     to speed up computation.
+    With aligner='builtin', each worker aligns its chunks in-process instead.
+
+    The chunks are balanced by their number of residues and the most
+    expensive chunk pairs are dispatched first. At most 2*n_procs chunk
+    pairs are in flight at a time. Results are inserted into the graph
+    as their jobs complete.
+
+    As the chunks hold sequences of similar length, chunk pairs whose
+    lengths are too different to reach the threshold are skipped, see
+    `length_feasible`. The builtin aligner also skips such pairs within
+    a chunk pair. Returns the number of skipped alignments.
+
+    The sequences are read from sequence_store, or from entity_fp if it is
+    not given. In multiprocess mode, workers attach to a copy of the store
+    in shared memory, see `SequenceStore.shared`.
     '''
-    if shutil.which('needleall') is None:
+    if aligner == 'needleall' and shutil.which('needleall') is None:
         print('EMBOSS needleall was not found. Please run `conda install -c bioconda emboss`')
         exit()
 
     # chunk the input
-    ids, seqs = parse_fasta(entity_fp)
-    seq_lens = get_len_dict(ids, seqs)
-
-    n_chunks = chunk_fasta_file(ids, seqs, n_chunks) #get the actual number of generated chunks.
-
-    # start n_procs threads, each thread starts a subprocess
-    # Because of threading's GIL we can write edges directly to the full_graph object.
-    jobs = []
-
-    # this is approximate, but good enough for progress bar drawing.
-    if triangular:
-        n_alignments = 0
-        chunk_size = math.ceil(len(ids)/n_chunks)
-        for i in range(n_chunks):
-            for j in range(i, n_chunks):
-                n_alignments += chunk_size*chunk_size
+    if sequence_store is None:
+        sequence_store = SequenceStore.from_fasta(entity_fp)
+    lengths = sequence_store.lengths
+
+    if aligner == 'builtin':
+        # the builtin aligner takes the chunks from the store.
+        from .nw_utils import compute_edges_builtin
+        chunks = balance_chunks(lengths, n_chunks)
     else:
-        n_alignments = len(ids)*len(ids)
-
-    # define in which interval each thread updates the progress bar.
-    # if all update all the time, this would slow down the loop and make runtimes estimate unstable.
-    # update every 1000 OR update every 0.05% of the total, divided by number of procs. 
-    # this worked well on large datasets with 64 threads - fewer threads should then be unproblematic.
-    pbar_update_interval = int((n_alignments * 0.0005)/n_procs) 
-    pbar_update_interval = min(1000, pbar_update_interval)
-
-    #pbar = tqdm(total= n_alignments)
+        chunks = chunk_fasta_file(sequence_store, n_chunks)
+    n_chunks = len(chunks) #get the actual number of generated chunks.
+
+    # workers return edges as indices into the store, which are mapped to the graph nodes once.
+    nodes, remap = _map_to_graph(full_graph, sequence_store.ids)
+
+    # the cost of a chunk pair is the number of dynamic programming cells, sum(len(a)*len(b)).
+    residues = [int(lengths[chunk].sum()) for chunk in chunks]
+    chunk_pairs = [(i, j) for i in range(n_chunks) for j in range(i if triangular else 0, n_chunks)]
+    n_pairs = {(i, j): len(chunks[i])*len(chunks[j]) for i, j in chunk_pairs}
+    if aligner == 'builtin':
+        # the builtin aligner does not align sequences to themselves.
+        n_pairs.update({(i, i): len(chunks[i])*(len(chunks[i])-1) for i in range(n_chunks)})
+    n_total = sum(n_pairs.values())
+
+    # skip chunk pairs in which even the closest lengths cannot reach the threshold.
+    shortest = [int(lengths[chunk].min()) for chunk in chunks]
+    longest = [int(lengths[chunk].max()) for chunk in chunks]
+    def is_feasible(i, j):
+        closest_a, closest_b = min(longest[i], longest[j]), max(shortest[i], shortest[j])
+        return closest_a >= closest_b or bool(length_feasible(closest_a, closest_b, denominator, transformation, threshold))
+    chunk_pairs = [pair for pair in chunk_pairs if is_feasible(*pair)]
+    skipped = n_total - sum(n_pairs[pair] for pair in chunk_pairs)
+    costs = {(i, j): residues[i]*residues[j] for i, j in chunk_pairs}
+    # dispatch the most expensive pairs first, so that no long job is left running at the end.
+    chunk_pairs = iter(sorted(chunk_pairs, key=lambda pair: costs[pair], reverse=True))
 
     if parallel_mode == 'multithread':
         executor_cls = concurrent.futures.ThreadPoolExecutor
     elif parallel_mode == 'multiprocess':
         executor_cls = concurrent.futures.ProcessPoolExecutor
 
-    with executor_cls(max_workers=n_procs) as executor:
-        for i in range(n_chunks):
-            start = i if triangular else 0
-            for j in range(start, n_chunks):
-                q = f'graphpart_{i}.fasta.tmp'
-                l = f'graphpart_{j}.fasta.tmp'
-                future = executor.submit(compute_edges, q, l, transformation, threshold, seq_lens, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
-                jobs.append(future)
-
-
-
-        pbar = tqdm(total=n_alignments)
-        for job in jobs:
-            if job.exception() is not None:
-                print(job.exception())
-                # TODO we don't yet know how to recover correctly. It just should not happen in general.
-                raise RuntimeError('One of the alignment processes did not complete sucessfully.')
-            else:
-                count, chunk_identities = job.result()
-
-                # while we wait on more jobs to finish, we can parse results as they come in.
-                for this_qry, this_lib, metric in chunk_identities:
-
-                    if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                        raise RuntimeError(f'Tried to insert edge {this_qry}-{this_lib} into the graph, but did not find nodes. This should not happen, please report a bug.')
-                    if full_graph.has_edge(this_qry, this_lib):
-                        if full_graph[this_qry][this_lib]['metric'] > metric:
-                            full_graph.add_edge(this_qry, this_lib, metric=metric) #Notes: Adding an edge that already exists updates the edge data. 
-                            
-                            # this seems to be slow:
-                            #nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-
-                    else:
-                        full_graph.add_edge(this_qry, this_lib, metric=metric) 
-                
-                pbar.update(count)
+    def submit(executor, i, j):
+        if aligner == 'builtin':
+            future = executor.submit(compute_edges_builtin, chunks[i], chunks[j], worker_store, transformation, threshold, denominator,
+                                     gapopen, gapextend, endweight, endopen, endextend, matrix)
+        else:
+            q = f'graphpart_{i}.fasta.tmp'
+            l = f'graphpart_{j}.fasta.tmp'
+            future = executor.submit(compute_edges, q, l, transformation, threshold, worker_store, denominator, delimiter, is_nucleotide, gapopen, gapextend, endweight, endopen, endextend, matrix)
+        job_costs[future] = (i, j, costs[(i, j)])
+        return future
+
+    # only keep a few jobs per worker in flight. Their results are inserted into the graph
+    # in the order they complete, so memory does not grow with the number of chunk pairs.
+    max_in_flight = 2 * n_procs
+    job_costs = {}
+
+    # threads read the store directly, processes attach to a shared copy.
+    shared = sequence_store.shared() if parallel_mode == 'multiprocess' else contextlib.nullcontext(sequence_store)
+    with shared as worker_store, executor_cls(max_workers=n_procs) as executor:
+        pending = set(submit(executor, i, j) for i, j in itertools.islice(chunk_pairs, max_in_flight))
+
+        pbar = tqdm(total=sum(costs.values()), unit=' cells', unit_scale=True)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for job in done:
+                if job.exception() is not None:
+                    print(job.exception())
+                    # TODO we don't yet know how to recover correctly. It just should not happen in general.
+                    raise RuntimeError('One of the alignment processes did not complete sucessfully.')
+
+                next_pair = next(chunk_pairs, None)
+                if next_pair is not None:
+                    pending.add(submit(executor, *next_pair))
+
+                count, edges = job.result()
+                _insert_edge_buffer(full_graph, nodes, remap, edges)
+                i, j, cost = job_costs.pop(job)
+                if aligner == 'builtin':
+                    # the builtin aligner also skips pairs within a chunk pair.
+                    skipped += n_pairs[(i, j)] - count
+                pbar.update(cost)
+        pbar.close()
+    print(f'Skipped {skipped} of {n_total} alignments of sequences whose lengths are too different to reach the threshold.')
 
     #delete the chunks
-    for i in range(n_chunks):
-        remove(f'graphpart_{i}.fasta.tmp')
\ No newline at end of file
+    if aligner == 'needleall':
+        for i in range(n_chunks):
+            remove(f'graphpart_{i}.fasta.tmp')
+
+    return skipped
\ No newline at end of file
@@ -0,0 +1,60 @@
+'''
+Columnar table of the entities and their partitioning state.
+
+The state of each entity used to be a dict of attributes on a node of a
+networkx graph (part_graph), holding its partition and a copy of the size
+and label counts of its mini-cluster. NodeTable keeps one contiguous array
+per attribute instead, indexed by integer node ids in the order in which
+the entities were loaded. All stages share the table, and updating the
+partitions of many entities is a single array assignment.
+'''
+import numpy as np
+from typing import Dict, Iterable, List
+
+
+class NodeTable():
+    '''
+    Entities as integer node ids, with one array per attribute:
+        cluster:   mini-cluster of the initialization, -1 before `partition_data`.
+        priority:  retention priority flag.
+        label:     label id, as in the 'label-val' node attribute.
+        partition: current partition, -1 if not assigned.
+
+    Removed entities stay in the table, the full_graph tells which are left.
+    '''
+    def __init__(self, ids: Iterable[str], priority: Iterable[bool] = None, label: Iterable[int] = None) -> None:
+        self.ids: List[str] = list(ids)
+        self.index: Dict[str, int] = {AC: i for i, AC in enumerate(self.ids)}
+        n = len(self.ids)
+        self.priority = np.zeros(n, dtype=bool) if priority is None else np.array(priority, dtype=bool)
+        self.label = np.zeros(n, dtype=np.int32) if label is None else np.array(label, dtype=np.int32)
+        self.cluster = np.full(n, -1, dtype=np.int64)
+        self.partition = np.full(n, -1, dtype=np.int64)
+
+    @classmethod
+    def from_graph(cls, full_graph) -> 'NodeTable':
+        '''Make a table of the nodes of full_graph, with their 'priority' and 'label-val' attributes.'''
+        ids, priority, label = [], [], []
+        for AC, data in full_graph.nodes(data=True):
+            ids.append(AC)
+            priority.append(data['priority'])
+            label.append(data['label-val'])
+        return cls(ids, priority, label)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def indices(self, nodes: Iterable[str]) -> np.ndarray:
+        '''Integer node ids of nodes.'''
+        return np.array([self.index[AC] for AC in nodes], dtype=np.int64)
+
+    def copy(self) -> 'NodeTable':
+        '''Copy of the table. The arrays are copied, the ids are shared.'''
+        table = NodeTable.__new__(NodeTable)
+        table.ids = self.ids
+        table.index = self.index
+        table.priority = self.priority.copy()
+        table.label = self.label.copy()
+        table.cluster = self.cluster.copy()
+        table.partition = self.partition.copy()
+        return table
@@ -0,0 +1,283 @@
+'''
+Built-in global alignment, as an alternative to EMBOSS needleall.
+
+Implements the Needleman-Wunsch algorithm with affine gap penalties
+(Gotoh) and the same parameters as needle: gapopen, gapextend, endweight,
+endopen, endextend and the substitution matrix. A gap of length k costs
+gapopen + (k-1)*gapextend. End gaps are free, unless endweight is set.
+
+Instead of aligning pairs one by one, one query is aligned against a
+batch of library sequences at once. The dynamic programming matrix is
+filled row by row, each row being a vectorised NumPy operation over all
+sequences in the batch. Within a row, horizontal gaps are resolved with a
+running maximum instead of a loop.
+
+No traceback is needed: every cell carries the number of aligned pairs and
+identical pairs of its best path. A global alignment covers both sequences,
+so the alignment length and the number of gaps follow from the number of
+aligned pairs. When several alignments have the same score, the one that
+is kept can differ from the one needle reports.
+'''
+import numpy as np
+from typing import Dict, List, Tuple
+
+from .matrices import load_matrix
+from .csr_graph import EdgeBuffer
+from .transformations import TRANSFORMATIONS
+from .needle_utils import NORMALIZATIONS, length_feasible
+from .sequence_store import SequenceStore
+
+
+# cells per row of a batch, limits memory to a few 100 MB.
+MAX_BATCH_CELLS = 2**21
+
+# pairs and matches of a path are packed into one integer, pairs in the high bits.
+PAIR = np.int64(1) << 32
+MATCH_MASK = PAIR - 1
+
+NEG_INF = np.float32(-1e30)
+
+
+def encode_sequences(seqs: List[str], alphabet: str) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    '''
+    Encode sequences as indices into the alphabet of the substitution matrix,
+    and as uppercase characters to count identities.
+    Unknown characters are treated as X (proteins) or N (nucleotides).
+    '''
+    unknown = alphabet.index('X') if 'X' in alphabet else alphabet.index('N') if 'N' in alphabet else len(alphabet)-1
+    lookup = np.full(256, unknown, dtype=np.int32)
+    for i, char in enumerate(alphabet):
+        lookup[ord(char.upper())] = i
+        lookup[ord(char.lower())] = i
+
+    chars = [np.frombuffer(seq.upper().encode('ascii', errors='replace'), dtype=np.uint8) for seq in seqs]
+    codes = [lookup[c] for c in chars]
+    return codes, chars
+
+
+def _end_gap_penalties(n: int, endweight: bool, endopen: float, endextend: float) -> np.ndarray:
+    '''Penalty of an end gap of length 0 to n.'''
+    penalties = np.zeros(n+1, dtype=np.float32)
+    if endweight:
+        penalties[1:] = endopen + np.arange(n) * endextend
+    return penalties
+
+
+def align_batch(qry_codes: np.ndarray,
+                qry_chars: np.ndarray,
+                lib_codes: List[np.ndarray],
+                lib_chars: List[np.ndarray],
+                scores: np.ndarray,
+                gapopen: float = 10,
+                gapextend: float = 0.5,
+                endweight: bool = False,
+                endopen: float = 10,
+                endextend: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Globally align one query against a batch of library sequences.
+    Returns the number of aligned pairs and the number of identical pairs
+    of each alignment.
+    '''
+    n = len(qry_codes)
+    lib_lens = np.array([len(c) for c in lib_codes])
+    n_libs, width = len(lib_codes), int(lib_lens.max(initial=0))
+
+    # pad the library sequences. Cells right of a sequence end never influence the cells left of it.
+    codes = np.zeros((n_libs, width), dtype=np.int32)
+    chars = np.zeros((n_libs, width), dtype=np.uint8)
+    for i, (c, ch) in enumerate(zip(lib_codes, lib_chars)):
+        codes[i, :len(c)] = c
+        chars[i, :len(ch)] = ch
+
+    go, ge = np.float32(gapopen), np.float32(gapextend)
+    end_qry = _end_gap_penalties(n, endweight, endopen, endextend)
+    end_lib = _end_gap_penalties(width, endweight, endopen, endextend)
+    columns = np.arange(width+1)
+    rows = np.arange(n_libs)
+
+    # first row: leading gap in the query.
+    H = np.tile(-end_lib, (n_libs, 1))
+    H_path = np.zeros((n_libs, width+1), dtype=np.int64)
+    E = np.full((n_libs, width), NEG_INF, dtype=np.float32)
+    E_path = np.zeros((n_libs, width), dtype=np.int64)
+
+    # best alignment that ends with a gap after the last library residue.
+    best = H[rows, lib_lens] - end_qry[n]
+    best_path = np.zeros(n_libs, dtype=np.int64)
+
+    for i in range(1, n+1):
+        # vertical gaps
+        E_open = H[:, 1:] - go
+        E_ext = E - ge
+        extend = E_ext > E_open
+        E = np.maximum(E_ext, E_open)
+        E_path = np.where(extend, E_path, H_path[:, 1:])
+
+        # aligned pairs
+        diag = H[:, :-1] + scores[qry_codes[i-1]][codes]
+        diag_path = H_path[:, :-1] + PAIR + (chars == qry_chars[i-1])
+        take_diag = diag >= E
+
+        H_row = np.empty_like(H)
+        H_row[:, 0] = -end_qry[i]
+        np.maximum(diag, E, out=H_row[:, 1:])
+        path_row = np.empty_like(H_path)
+        path_row[:, 0] = 0
+        path_row[:, 1:] = np.where(take_diag, diag_path, E_path)
+
+        # horizontal gaps: F[j] = max_{k<j} (H[k] - gapopen - (j-k-1)*gapextend)
+        shifted = H_row + ge * columns
+        running = np.maximum.accumulate(shifted, axis=1)
+        origin = np.maximum.accumulate(np.where(shifted >= running, columns, 0), axis=1)
+        F = running[:, :-1] - go - ge * columns[:-1]
+        F_path = np.take_along_axis(path_row, origin[:, :-1], axis=1)
+
+        take_F = F > H_row[:, 1:]
+        H = H_row
+        np.maximum(F, H_row[:, 1:], out=H[:, 1:])
+        H_path = path_row
+        H_path[:, 1:] = np.where(take_F, F_path, path_row[:, 1:])
+
+        # the alignment can end here with a gap in the library sequence.
+        end_here = H[rows, lib_lens] - end_qry[n-i]
+        better = end_here > best
+        best = np.where(better, end_here, best)
+        best_path = np.where(better, H_path[rows, lib_lens], best_path)
+
+    # the alignment can also end with a gap in the query.
+    trailing = H - end_lib[np.clip(lib_lens[:, None] - columns, 0, None)]
+    trailing[columns > lib_lens[:, None]] = NEG_INF
+    last = trailing.argmax(axis=1)
+    better = trailing[rows, last] > best
+    best_path = np.where(better, H_path[rows, last], best_path)
+
+    return best_path >> 32, best_path & MATCH_MASK
+
+
+def compute_identity(n_matches: int, length: int, gaps: int, len_qry: int, len_lib: int, denominator: str = 'full') -> float:
+    '''
+    Sequence identity from alignment counts, with the same denominators
+    as the needleall parsers.
+    '''
+    if denominator == 'full':
+        # needle reports the percentage with one decimal, which is what the needleall parsers use.
+        return round(100 * n_matches / length, 1) / 100 if length > 0 else 0.0
+    elif denominator == 'no_gaps':
+        return float(n_matches/(length-gaps))
+    else:
+        return NORMALIZATIONS[denominator](n_matches, len_qry, len_lib)
+
+
+def align_one_to_many(qry_seq: str,
+                      lib_seqs: List[str],
+                      gapopen: float = 10,
+                      gapextend: float = 0.5,
+                      endweight: bool = False,
+                      endopen: float = 10,
+                      endextend: float = 0.5,
+                      matrix: str = 'EBLOSUM62') -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Align a query against each library sequence.
+    Returns the number of identical positions, the number of gaps and
+    the length of each alignment, as needle reports them.
+    '''
+    alphabet, scores = load_matrix(matrix)
+    (qry_codes,), (qry_chars,) = encode_sequences([qry_seq], alphabet)
+    lib_codes, lib_chars = encode_sequences(lib_seqs, alphabet)
+
+    n_pairs = np.zeros(len(lib_seqs), dtype=np.int64)
+    n_matches = np.zeros(len(lib_seqs), dtype=np.int64)
+    # batches of similar length waste less space on padding.
+    order = np.argsort([len(s) for s in lib_seqs], kind='stable')
+    start = 0
+    while start < len(order):
+        width = max(len(lib_seqs[order[start]]), 1)
+        stop = start + 1
+        while stop < len(order) and (stop - start + 1) * max(len(lib_seqs[order[stop]]), width) <= MAX_BATCH_CELLS:
+            stop += 1
+        batch = order[start:stop]
+        pairs, matches = align_batch(qry_codes, qry_chars, [lib_codes[i] for i in batch], [lib_chars[i] for i in batch],
+                                     scores, gapopen, gapextend, endweight, endopen, endextend)
+        n_pairs[batch] = pairs
+        n_matches[batch] = matches
+        start = stop
+
+    lengths = len(qry_seq) + np.array([len(s) for s in lib_seqs], dtype=np.int64) - n_pairs
+    gaps = lengths - n_pairs
+    return n_matches, gaps, lengths
+
+
+def compute_edges_builtin(qry_idx: np.ndarray,
+                          lib_idx: np.ndarray,
+                          sequence_store: SequenceStore,
+                          transformation: str,
+                          threshold: float,
+                          denominator: str = 'full',
+                          gapopen: float = 10,
+                          gapextend: float = 0.5,
+                          endweight: bool = False,
+                          endopen: float = 10,
+                          endextend: float = 0.5,
+                          matrix: str = 'EBLOSUM62',
+                          ) -> Tuple[int, EdgeBuffer]:
+    '''
+    Built-in replacement for `needle_utils.compute_edges`. Aligns all
+    queries against all library sequences, given by their indices in
+    sequence_store, and returns the number of alignments and the edges
+    within the threshold, as indices into sequence_store.
+    Pairs whose lengths are too different to reach the threshold are
+    not aligned, see `needle_utils.length_feasible`.
+    '''
+    edges = EdgeBuffer()
+    count = 0
+    lib_idx = np.asarray(lib_idx)
+    lib_lens = sequence_store.lengths[lib_idx]
+    for qry in np.asarray(qry_idx).tolist():
+        feasible = length_feasible(int(sequence_store.lengths[qry]), lib_lens, denominator, transformation, threshold)
+        # self-alignments are not needed.
+        targets = lib_idx[feasible & (lib_idx != qry)].tolist()
+        if len(targets) == 0:
+            continue
+        n_matches, gaps, lengths = align_one_to_many(sequence_store.get(qry), sequence_store.sequences(targets),
+                                                     gapopen, gapextend, endweight, endopen, endextend, matrix)
+        count += len(targets)
+        for lib, matches, gap, length in zip(targets, n_matches.tolist(), gaps.tolist(), lengths.tolist()):
+            identity = compute_identity(matches, length, gap, int(sequence_store.lengths[qry]), int(sequence_store.lengths[lib]), denominator)
+            metric = TRANSFORMATIONS[transformation](identity)
+            if metric > threshold:
+                continue
+            edges.append(qry, lib, metric)
+
+    return (count, edges)
+
+
+def align_pairs_builtin(sequence_store: SequenceStore,
+                        pairs: List[Tuple[str, str]],
+                        transformation: str,
+                        denominator: str = 'full',
+                        gapopen: float = 10,
+                        gapextend: float = 0.5,
+                        endweight: bool = False,
+                        endopen: float = 10,
+                        endextend: float = 0.5,
+                        matrix: str = 'EBLOSUM62',
+                        ) -> Dict[Tuple[str,str], float]:
+    '''
+    Built-in replacement for the pairwise needleall batches of the
+    mmseqs2needle mode. Pairs with the same query are aligned together.
+    The sequences of the identifiers in pairs are read from sequence_store.
+    Returns the transformed identity of each pair.
+    '''
+    by_query = {}
+    for qry, lib in pairs:
+        by_query.setdefault(qry, []).append(lib)
+
+    out_dict = {}
+    for qry, libs in by_query.items():
+        n_matches, gaps, lengths = align_one_to_many(sequence_store.sequence(qry), [sequence_store.sequence(lib) for lib in libs],
+                                                     gapopen, gapextend, endweight, endopen, endextend, matrix)
+        for lib, matches, gap, length in zip(libs, n_matches.tolist(), gaps.tolist(), lengths.tolist()):
+            identity = compute_identity(matches, length, gap, sequence_store.length(qry), sequence_store.length(lib), denominator)
+            out_dict[(qry, lib)] = TRANSFORMATIONS[transformation](identity)
+
+    return out_dict
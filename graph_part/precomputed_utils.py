@@ -2,46 +2,108 @@
 Parsing functions for precomputed similarities.
 '''
 import networkx as nx
-from .transformations import TRANSFORMATIONS
+import numpy as np
+import pandas as pd
+from .transformations import ARRAY_TRANSFORMATIONS, ARRAY_INVERSE_TRANSFORMATIONS
+from .checkpoint import is_checkpoint, load_checkpoint
+from .csr_graph import CSRGraph, insert_edges, metric_threshold
 from tqdm import tqdm
 
-def load_edge_list(edge_fp: str, 
-               full_graph: nx.classes.graph.Graph, 
+def load_edge_list(edge_fp: str,
+               full_graph: nx.classes.graph.Graph,
                tranformation: str,
                threshold: float,
-               metric_column: int):
+               metric_column: int,
+               chunk_size: int = 1000000):
     '''
     Load edges form a precomputed edge list saved as .csv
     Expects the names of the nodes in columns 0 and 1, the
     metric in metric_column.
+
+    The file is read in chunks of chunk_size lines. Each chunk is
+    transformed and filtered as a whole, edges that occur more than
+    once keep the smallest metric.
+
+    Binary checkpoints are detected automatically and loaded
+    without parsing, see `load_checkpoint_edges`.
     '''
+    if is_checkpoint(edge_fp):
+        return load_checkpoint_edges(edge_fp, full_graph, tranformation, threshold, chunk_size)
+
     with open(edge_fp) as inf:
-        #pdb.set_trace()
-        for line_nr, line in tqdm(enumerate(inf)):
-            spl = line.strip().split(',')
-            if len(spl) < 3:
-                raise ValueError("""
-                Edge list file does not contain at least three comma 
-                separated columns. The first two columns should contain
-                entity identifiers and the third should contain the
-                metric to partition by.
-                """)
-            
-            this_qry = spl[0]
-            this_lib = spl[1]
-            try:
-                metric = TRANSFORMATIONS[tranformation](float(spl[metric_column]))
-            except ValueError or TypeError:
-                raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (spl[1]))
-            
-            if this_qry == this_lib:
-                continue
-            if metric > threshold:
-                continue
-            if not full_graph.has_node(this_qry) or not full_graph.has_node(this_lib):
-                continue
-            if full_graph.has_edge(this_qry, this_lib):
-                if full_graph[this_qry][this_lib]['metric'] > metric:
-                    nx.set_edge_attributes(full_graph,{(this_qry,this_lib):metric}, 'metric')
-            else:
-                full_graph.add_edge(this_qry, this_lib, metric=metric)  
\ No newline at end of file
+        first_line = inf.readline()
+    if first_line and len(first_line.strip().split(',')) < max(3, metric_column+1):
+        raise ValueError("""
+        Edge list file does not contain at least three comma
+        separated columns. The first two columns should contain
+        entity identifiers and the third should contain the
+        metric to partition by.
+        """)
+
+    ## Map identifiers to integer ids. Entities that are not in the graph map to -1.
+    if isinstance(full_graph, CSRGraph):
+        nodes = full_graph.ids
+    else:
+        nodes = list(full_graph.nodes())
+    node_index = pd.Index(nodes)
+
+    ## Identifiers such as NA or null are kept as they are. Empty metrics
+    ## fail to convert below, as with float().
+    reader = pd.read_csv(edge_fp, header=None, usecols=[0, 1, metric_column],
+                         dtype={0: str, 1: str}, keep_default_na=False,
+                         chunksize=chunk_size, engine='c')
+    pbar = tqdm(unit=' lines')
+    for chunk in reader:
+        try:
+            values = chunk[metric_column].to_numpy(dtype=np.float64)
+        except (ValueError, TypeError):
+            values = pd.to_numeric(chunk[metric_column], errors='coerce').to_numpy(dtype=np.float64)
+        invalid = np.isnan(values)
+        if invalid.any():
+            raise TypeError("Failed to interpret the metric column value %r. Please ensure that the edge list file is correctly formatted and that the correct column is specified." % (chunk[metric_column].iloc[np.argmax(invalid)]))
+        metric = ARRAY_TRANSFORMATIONS[tranformation](values)
+
+        qry = node_index.get_indexer(chunk[0])
+        lib = node_index.get_indexer(chunk[1])
+        keep = (qry != lib) & (metric <= threshold) & (qry >= 0) & (lib >= 0)
+        insert_edges(full_graph, nodes, qry[keep], lib[keep], metric[keep])
+        pbar.update(len(chunk))
+    pbar.close()
+
+
+def load_checkpoint_edges(checkpoint_fp: str,
+                          full_graph: nx.classes.graph.Graph,
+                          tranformation: str,
+                          threshold: float,
+                          chunk_size: int = 1000000):
+    '''
+    Load edges from a binary checkpoint written with --checkpoint-format binary.
+    The metrics are stored transformed. If the checkpoint was made with
+    another transformation, they are converted to the current one.
+    '''
+    header, ids, qry_ckpt, lib_ckpt, metric_ckpt = load_checkpoint(checkpoint_fp)
+    print(f"Loading {header['n_edges']} edges from checkpoint (alignment mode: {header.get('alignment_mode')}, threshold: {header.get('threshold')}).")
+
+    same_transformation = str(header.get('transformation')) == str(tranformation)
+    if same_transformation and header.get('threshold_transformed') is not None and threshold > header['threshold_transformed']:
+        print(f"Warning: the checkpoint only contains edges up to {header['threshold_transformed']}, the threshold is {threshold}.")
+
+    if isinstance(full_graph, CSRGraph):
+        nodes = full_graph.ids
+    else:
+        nodes = list(full_graph.nodes())
+        # the metrics have single precision, partition_and_remove needs to know.
+        full_graph.graph['single_precision'] = True
+    threshold = metric_threshold(threshold)
+
+    ## checkpoint id -> graph id. Entities that are not in the graph map to -1.
+    remap = pd.Index(nodes).get_indexer(ids)
+
+    for start in tqdm(range(0, header['n_edges'], chunk_size)):
+        metric = np.asarray(metric_ckpt[start:start+chunk_size], dtype=np.float64)
+        if not same_transformation:
+            metric = ARRAY_TRANSFORMATIONS[tranformation](ARRAY_INVERSE_TRANSFORMATIONS[header.get('transformation')](metric))
+        qry = remap[qry_ckpt[start:start+chunk_size]]
+        lib = remap[lib_ckpt[start:start+chunk_size]]
+        keep = (qry != lib) & (metric <= threshold) & (qry >= 0) & (lib >= 0)
+        insert_edges(full_graph, nodes, qry[keep], lib[keep], metric[keep])
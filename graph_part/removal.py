@@ -0,0 +1,267 @@
+'''
+Incremental bookkeeping for the removal step.
+
+The removal step alternates between moving entities to the partition
+they have the most within-threshold neighbours in, and removing the
+entities with the most within-threshold neighbours in other partitions
+(the between-partition connectivity).
+
+Instead of rescanning the whole graph in each round, RemovalEngine keeps
+a matrix of per-partition neighbour counts for each entity. Moving or
+removing an entity only updates its neighbourhood, and only entities
+whose neighbourhood changed are visited again. The most problematic
+entities are retrieved from a max-heap.
+
+The results are the same as those of a full sweep over all entities in
+each round: an entity that is visited takes the state left by the
+entities before it, and its between-partition connectivity is counted
+against the partition it had before it was moved.
+'''
+import heapq
+import numpy as np
+from typing import List, Tuple
+
+
+class RemovalEngine():
+    '''
+    Parameters:
+    ------------
+        queries, libs, metrics: np.ndarray
+            The edges of the graph. queries and libs are integer node ids.
+        partitions: np.ndarray
+            The partition of each node.
+        priority: np.ndarray
+            Boolean priority flag of each node.
+        threshold: float
+            Edges with a metric below the threshold connect nodes.
+        ignore_priority: bool
+            If True, priority nodes are not considered for removal.
+        fixed: np.ndarray
+            Optional boolean flag of nodes that are neither moved nor removed.
+        neighbour_ranks: tuple of np.ndarray
+            Optional position of each edge among the neighbours of its query
+            and among those of its lib, in the order in which the graph lists
+            them. Ties in the moving step go to the partition that comes first
+            in this order. Defaults to the order of the node ids.
+    '''
+    def __init__(self,
+                 queries: np.ndarray,
+                 libs: np.ndarray,
+                 metrics: np.ndarray,
+                 partitions: np.ndarray,
+                 priority: np.ndarray,
+                 threshold: float,
+                 ignore_priority: bool = True,
+                 fixed: np.ndarray = None,
+                 neighbour_ranks: Tuple[np.ndarray, np.ndarray] = None) -> None:
+
+        n = len(partitions)
+        self.partitions = np.asarray(partitions, dtype=np.int64).copy()
+        self.alive = np.ones(n, dtype=bool)
+        self.movable = ~np.asarray(fixed, dtype=bool) if fixed is not None else np.ones(n, dtype=bool)
+        self.eligible = ~np.asarray(priority, dtype=bool) if ignore_priority else np.ones(n, dtype=bool)
+        self.eligible &= self.movable
+        n_partitions = int(self.partitions.max()) + 1 if n > 0 else 1
+
+        # adjacency in CSR layout, both directions, neighbours in the order of the graph.
+        src = np.concatenate((queries, libs))
+        dst = np.concatenate((libs, queries))
+        order = np.lexsort((dst if neighbour_ranks is None else np.concatenate(neighbour_ranks), src))
+        self.indices = dst[order]
+        self.metric = np.concatenate((metrics, metrics))[order]
+        self.close = self.metric < threshold
+        self.indptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.indptr[1:])
+        self.n_edges = len(queries)
+
+        # number of within-threshold neighbours of each node in each partition.
+        self.counts = np.zeros((n, n_partitions), dtype=np.int32)
+        np.add.at(self.counts, (src[order][self.close], self.partitions[self.indices[self.close]]), 1)
+        self.n_close = self.counts.sum(axis=1)
+
+        self.between_connectivity = np.zeros(n, dtype=np.int64)
+        self.min_between = np.full(n, np.inf)
+        self.bc_sum = 0
+        self.bc_count = 0
+        self._heap = []
+
+        # nodes to visit in the next round, and nodes whose values went stale after their visit.
+        self._dirty = np.ones(n, dtype=bool)
+        self._stale = np.zeros(n, dtype=bool)
+
+    @property
+    def n_alive(self) -> int:
+        return int(self.alive.sum())
+
+    def _close_neighbours(self, node: int) -> np.ndarray:
+        lo, hi = self.indptr[node], self.indptr[node+1]
+        neighbours = self.indices[lo:hi][self.close[lo:hi]]
+        return neighbours[self.alive[neighbours]]
+
+    def _most_neighbourly(self, node: int) -> int:
+        '''
+        Partition with the most neighbours of a node. Ties go to the partition
+        of the first neighbour in neighbour order, as Counter resolves them.
+        '''
+        row = self.counts[node]
+        best = row.max()
+        if best == 0:
+            return int(self.partitions[node])
+        tied = row == best
+        if np.count_nonzero(tied) == 1:
+            return int(row.argmax())
+        partitions = self.partitions[self._close_neighbours(node)]
+        return int(partitions[np.argmax(tied[partitions])])
+
+    def _evaluate(self, nodes: np.ndarray) -> None:
+        '''Take the between-partition connectivity of nodes against their current partition.'''
+        if len(nodes) == 0:
+            return
+        own = self.counts[nodes, self.partitions[nodes]]
+        new_bc = np.where(self.eligible[nodes], self.n_close[nodes] - own, 0)
+        old_bc = self.between_connectivity[nodes]
+        self.bc_sum += int(new_bc.sum() - old_bc.sum())
+        self.bc_count += int(np.count_nonzero(new_bc) - np.count_nonzero(old_bc))
+        self.between_connectivity[nodes] = new_bc
+
+        # smallest metric to a neighbour in another partition.
+        starts = self.indptr[nodes]
+        lengths = self.indptr[nodes+1] - starts
+        offsets = np.zeros(len(nodes), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        neighbours = self.indices[positions]
+        between = (self.close[positions] & self.alive[neighbours]
+                   & (self.partitions[neighbours] != np.repeat(self.partitions[nodes], lengths)))
+        values = np.where(between, self.metric[positions], np.inf)
+        min_between = np.full(len(nodes), np.inf)
+        has_edges = lengths > 0
+        if has_edges.any():
+            min_between[has_edges] = np.minimum.reduceat(values, offsets[has_edges])
+        self.min_between[nodes] = np.where(self.eligible[nodes], min_between, np.inf)
+
+        # nodes whose value did not change are still in the heap.
+        changed = (new_bc > 0) & (new_bc != old_bc)
+        for node, bc in zip(nodes[changed].tolist(), new_bc[changed].tolist()):
+            heapq.heappush(self._heap, (-bc, node))
+
+    def _evaluate_node(self, node: int) -> None:
+        '''`_evaluate` for a single node.'''
+        bc, min_between = 0, np.inf
+        if self.eligible[node]:
+            partition = self.partitions[node]
+            bc = int(self.n_close[node] - self.counts[node, partition])
+            lo, hi = self.indptr[node], self.indptr[node+1]
+            neighbours = self.indices[lo:hi]
+            between = self.close[lo:hi] & self.alive[neighbours] & (self.partitions[neighbours] != partition)
+            min_between = self.metric[lo:hi][between].min(initial=np.inf)
+        old_bc = int(self.between_connectivity[node])
+        self.bc_sum += bc - old_bc
+        self.bc_count += int(bc > 0) - int(old_bc > 0)
+        self.between_connectivity[node] = bc
+        self.min_between[node] = min_between
+        if bc > 0 and bc != old_bc:
+            heapq.heappush(self._heap, (-bc, node))
+
+    def move_nodes(self) -> int:
+        '''
+        Visit the nodes in order and move each to the partition with the most
+        neighbours, see `_most_neighbourly`. The between-partition connectivity
+        of a node is taken at its visit, against its partition before the move.
+        Only nodes whose neighbourhood changed since their last visit are visited.
+        Returns the number of moved nodes.
+        '''
+        candidates = np.flatnonzero(self._dirty & self.alive)
+        self._dirty[candidates] = False
+        # nodes that stay and have no neighbour moving before them are visited in the state they are in now.
+        self._evaluate(candidates)
+
+        rows = self.counts[candidates]
+        best = rows.max(axis=1, initial=0)
+        current = rows[np.arange(len(candidates)), self.partitions[candidates]]
+        tied = np.count_nonzero(rows == best[:, None], axis=1) > 1
+        queue = candidates[self.movable[candidates] & (best > 0) & ((current < best) | tied)].tolist()
+        queued = set(queue)
+
+        number_moved = 0
+        while queue:
+            node = heapq.heappop(queue)
+            queued.discard(node)
+            old = int(self.partitions[node])
+            new = self._most_neighbourly(node) if self.movable[node] else old
+            self._evaluate_node(node)
+            if new == old:
+                continue
+            self.partitions[node] = new
+            number_moved += 1
+
+            neighbours = self._close_neighbours(node)
+            self.counts[neighbours, old] -= 1
+            self.counts[neighbours, new] += 1
+            # its connectivity was taken against the old partition.
+            self._stale[node] = True
+
+            # neighbours later in the order see the move in this round, the others in the next.
+            for neighbour in neighbours.tolist():
+                if neighbour > node:
+                    if neighbour not in queued:
+                        heapq.heappush(queue, neighbour)
+                        queued.add(neighbour)
+                else:
+                    self._stale[neighbour] = True
+
+        return number_moved
+
+    def update(self) -> None:
+        '''
+        Visit the nodes that `move_nodes` did not, without moving them, and
+        mark the nodes that went stale in this round for the next one.
+        '''
+        nodes = np.flatnonzero(self._dirty & self.alive)
+        self._dirty[nodes] = False
+        self._evaluate(nodes)
+        self._dirty |= self._stale
+        self._stale[:] = False
+
+    def min_threshold(self) -> float:
+        '''Smallest metric between two partitions, capped at 1 as in the round report.'''
+        min_between = float(self.min_between.min(initial=np.inf))
+        return min_between if min_between < 1 else 1
+
+    def most_problematic(self, n: int, keep: bool = False) -> List[int]:
+        '''
+        Get the n nodes with the highest between-partition connectivity.
+        With keep, they stay in the heap, to be retrieved again.
+        '''
+        selected = []
+        seen = set()
+        while self._heap and len(selected) < n:
+            neg_bc, node = heapq.heappop(self._heap)
+            # skip outdated heap entries.
+            if node in seen or not self.alive[node] or self.between_connectivity[node] != -neg_bc:
+                continue
+            seen.add(node)
+            selected.append(node)
+        if keep:
+            for node in selected:
+                heapq.heappush(self._heap, (-int(self.between_connectivity[node]), node))
+        return selected
+
+    def remove(self, nodes: List[int]) -> None:
+        for node in nodes:
+            if not self.alive[node]:
+                continue
+            self.alive[node] = False
+            lo, hi = self.indptr[node], self.indptr[node+1]
+            self.n_edges -= int(np.count_nonzero(self.alive[self.indices[lo:hi]]))
+
+            neighbours = self._close_neighbours(node)
+            self.counts[neighbours, self.partitions[node]] -= 1
+            self.n_close[neighbours] -= 1
+            self._dirty[neighbours] = True
+
+            bc = int(self.between_connectivity[node])
+            self.bc_sum -= bc
+            self.bc_count -= int(bc > 0)
+            self.between_connectivity[node] = 0
+            self.min_between[node] = np.inf
@@ -0,0 +1,171 @@
+'''
+Compact store of the sequences of a FASTA file, read in a single pass.
+
+All residues are kept in one contiguous byte buffer. Sequence i is
+residues[offsets[i]:offsets[i+1]], and an identifier table maps each
+identifier to its index. Lengths are the differences of the offsets.
+This replaces the lists of strings and length dicts that each alignment
+backend used to parse from the file on its own.
+
+For process pools, the store can be copied into shared memory once. A
+shared store is pickled as the name of its memory block, so each worker
+attaches to the block once, instead of receiving the sequences and
+lengths with every task.
+
+Large files can be read by several processes, see `fasta_utils.record_ranges`.
+'''
+import contextlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, Iterator, List, TextIO, Tuple
+
+import numpy as np
+
+
+class SequenceStore():
+    '''
+    Sequences as a contiguous uint8 array `residues` with int64 `offsets`
+    of length n+1, identifiers `ids` and the identifier table `index`.
+    Identifiers are the part of the header before the first `sep`, without '>'.
+    '''
+    def __init__(self, ids: List[str], residues: np.ndarray, offsets: np.ndarray) -> None:
+        self.ids = ids
+        self.index: Dict[str, int] = {id: i for i, id in enumerate(ids)}
+        self.residues = residues
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+        self._shm = None
+
+    @classmethod
+    def from_fasta(cls, fasta_fp: str, sep: str = '|', n_procs: int = 1) -> 'SequenceStore':
+        '''
+        Read a FASTA file. Handles multi-line sequences and empty lines.
+        Lines before the first header are ignored.
+        Large files are split into ranges of whole records that n_procs processes read.
+        '''
+        from .fasta_utils import record_ranges
+
+        ranges = record_ranges(fasta_fp, n_procs)
+        if len(ranges) > 1:
+            with ProcessPoolExecutor(len(ranges)) as executor:
+                starts, ends = zip(*ranges)
+                parts = list(executor.map(_read_range, repeat(fasta_fp), starts, ends, repeat(sep)))
+        else:
+            parts = [_read_range(fasta_fp, start, end, sep) for start, end in ranges]
+
+        ids = [id for part in parts for id in part[0]]
+        # shift the offsets of each range by the residues of the ranges before it.
+        shifts = np.cumsum([0] + [len(part[1]) for part in parts])
+        offsets = np.concatenate([part[2] + shift for part, shift in zip(parts, shifts)] + [shifts[-1:]]).astype(np.int64)
+        residues = np.frombuffer(b''.join(part[1] for part in parts), dtype=np.uint8)
+        return cls(ids, residues, offsets)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, i: int) -> str:
+        '''Sequence number i.'''
+        return self.residues[self.offsets[i]:self.offsets[i+1]].tobytes().decode('latin-1')
+
+    def sequence(self, id: str) -> str:
+        '''Sequence of an identifier.'''
+        return self.get(self.index[id])
+
+    def length(self, id: str) -> int:
+        '''Length of the sequence of an identifier.'''
+        return int(self.lengths[self.index[id]])
+
+    def sequences(self, indices: Iterable[int] = None) -> List[str]:
+        '''Sequences at indices, or all of them.'''
+        if indices is None:
+            indices = range(len(self))
+        return [self.get(i) for i in indices]
+
+    def write_fasta(self, f: TextIO, indices: Iterable[int]) -> None:
+        '''Write the sequences at indices to an open file, one line each.'''
+        for i in indices:
+            f.write(f'>{self.ids[i]}\n{self.get(i)}\n')
+
+    @contextlib.contextmanager
+    def shared(self) -> Iterator['SequenceStore']:
+        '''
+        Copy the store into shared memory for the duration of the context.
+        The returned store can be passed to process pool workers.
+        '''
+        id_bytes = np.frombuffer('\n'.join(self.ids).encode(), dtype=np.uint8)
+        shm = shared_memory.SharedMemory(create=True, size=max(8 * len(self.offsets) + len(self.residues) + len(id_bytes), 1))
+        store = _from_buffer(shm, len(self), len(self.residues), len(id_bytes), self.ids, self.index)
+        try:
+            store.offsets[:] = self.offsets
+            store.residues[:] = self.residues
+            np.frombuffer(shm.buf, dtype=np.uint8, count=len(id_bytes), offset=8 * len(self.offsets) + len(self.residues))[:] = id_bytes
+            store.lengths = self.lengths
+            yield store
+        finally:
+            # the arrays need to be released before the memory can be closed.
+            store.residues = store.offsets = None
+            shm.close()
+            shm.unlink()
+
+    def __reduce__(self):
+        if self._shm is None:
+            return (SequenceStore, (self.ids, self.residues, self.offsets))
+        return (_attach, self._shm_args)
+
+
+def _read_range(fasta_fp: str, start: int, end: int, sep: str) -> Tuple[List[str], bytes, np.ndarray]:
+    '''
+    Read the records in a byte range of a FASTA file. Returns the identifiers,
+    the residues and the start offsets of the sequences within them.
+    '''
+    sep = sep.encode()
+    ids = []
+    residues = bytearray()
+    offsets = array('q')
+    pos = start
+    with open(fasta_fp, 'rb') as f:
+        f.seek(start)
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            if line.startswith(b'>'):
+                ids.append(line.strip().split(sep)[0].decode().lstrip('>'))
+                offsets.append(len(residues))
+            elif len(ids) > 0:
+                residues += line.strip()
+    return ids, bytes(residues), np.frombuffer(offsets, dtype=np.int64)
+
+
+def _from_buffer(shm: shared_memory.SharedMemory, n: int, n_residues: int, n_id_bytes: int,
+                 ids: List[str] = None, index: Dict[str, int] = None) -> SequenceStore:
+    '''Make a store whose arrays are views of a shared memory block.'''
+    offsets = np.frombuffer(shm.buf, dtype=np.int64, count=n+1)
+    residues = np.frombuffer(shm.buf, dtype=np.uint8, count=n_residues, offset=8 * (n+1))
+    if ids is None:
+        id_bytes = bytes(shm.buf[8 * (n+1) + n_residues:8 * (n+1) + n_residues + n_id_bytes])
+        ids = id_bytes.decode().split('\n') if n > 0 else []
+    store = SequenceStore.__new__(SequenceStore)
+    store.ids = ids
+    store.index = {id: i for i, id in enumerate(ids)} if index is None else index
+    store.residues = residues
+    store.offsets = offsets
+    store.lengths = None
+    store._shm = shm
+    store._shm_args = (shm.name, n, n_residues, n_id_bytes)
+    return store
+
+
+# stores that this process attached to, so that each worker attaches once.
+_ATTACHED: Dict[str, SequenceStore] = {}
+
+
+def _attach(name: str, n: int, n_residues: int, n_id_bytes: int) -> SequenceStore:
+    '''Attach to a shared store in a worker process.'''
+    if name not in _ATTACHED:
+        store = _from_buffer(shared_memory.SharedMemory(name=name), n, n_residues, n_id_bytes)
+        store.lengths = np.diff(store.offsets)
+        _ATTACHED[name] = store
+    return _ATTACHED[name]
@@ -9,7 +9,9 @@ import numpy as np
 import pandas as pd
 from collections import Counter
 from itertools import combinations
-from typing import List, Tuple
+from typing import List, Tuple, Union
+from .csr_graph import CSRGraph
+from .node_table import NodeTable
 
 
 def check_train_val_test_args(args):
@@ -31,20 +33,20 @@ def check_train_val_test_args(args):
     
     
 
-def compute_partition_similarity_matrix(full_graph: nx.classes.graph.Graph, part_graph: nx.classes.graph.Graph, n_partitions: int, threshold: float) -> np.ndarray:
+def compute_partition_similarity_matrix(full_graph: Union[nx.classes.graph.Graph, CSRGraph], node_table: NodeTable, n_partitions: int, threshold: float) -> np.ndarray:
     '''Compute a similarity matrix of the partitions. Metric = number of connections between.'''
     partition_connections = np.zeros((n_partitions, n_partitions))
+    partitions = node_table.partition
+    index = node_table.index
     #iterate over all sequences
     for n,d in full_graph.nodes(data=True):
         # get the partition of the sequence 
-        self_cluster = part_graph.nodes[n]['cluster']
-        #get the neighbors of the sequence
-        neighbours = nx.neighbors(full_graph,n) 
+        self_cluster = partitions[index[n]]
         #count the number of neighbors of each partition
-        neighbour_clusters = Counter((part_graph.nodes[nb]['cluster'] for nb in nx.neighbors(full_graph,n) if full_graph[n][nb]['metric'] < threshold))
+        neighbour_clusters = Counter((partitions[index[nb]] for nb in nx.neighbors(full_graph,n) if full_graph[n][nb]['metric'] < threshold))
 
         for cl, count in neighbour_clusters.items():
-            partition_connections[int(self_cluster), int(cl)] += count #Partition id ['cluster'] is float.
+            partition_connections[self_cluster, cl] += count
 
     return partition_connections
 
@@ -80,8 +82,8 @@ def find_best_partition_combinations(partition_connections: np.ndarray, n_train:
     return train_partitions, test_partitions, val_partitions
 
 
-def train_val_test_split(part_graph: nx.classes.graph.Graph, 
-                     full_graph: nx.classes.graph.Graph, 
+def train_val_test_split(node_table: NodeTable, 
+                     full_graph: Union[nx.classes.graph.Graph, CSRGraph], 
                      threshold: float, 
                      test_ratio: float,
                      val_ratio: float, 
@@ -95,36 +97,16 @@ def train_val_test_split(part_graph: nx.classes.graph.Graph,
 
     # For each partition, measure the overlap to other partitions.
     # partition_connections is essentially a similarity matrix of all the partitions.
-    partition_connections = compute_partition_similarity_matrix(full_graph, part_graph, n_partitions, threshold)
+    partition_connections = compute_partition_similarity_matrix(full_graph, node_table, n_partitions, threshold)
 
     # Given the similarity matrix, find the combinations with maximum overlap.
     # By doing this now, we reduce the number of move/removal operations later.
     train_partitions, test_partitions, val_partitions = find_best_partition_combinations(partition_connections, n_train, n_test)
-    # Given the new assignments, update the graph.
-    # part_graph has the following format: {'C0IW58': {'cluster': 0.0, 'C-size': 124, 'label-counts': array([92, 32])}
-
-    # Compute the new statistics to add to the nodes.
-    df = pd.DataFrame(((d) for n,d in full_graph.nodes(data=True)))
-    df['cluster'] = [part_graph.nodes[n]['cluster'] for n in full_graph.nodes()]
-    df['AC'] = [n for n in full_graph.nodes()]
-    df = df.groupby(['cluster','label-val'])['AC'].count().reset_index().pivot_table(values='AC',columns=['label-val'],index=['cluster'])
-
-    train_statistics = df.loc[[float(x) for x in train_partitions]].sum(axis=0)
-    train_attributes = {'cluster': 0.0, 'C-size': sum(train_statistics), 'label-counts': train_statistics.to_numpy()}
-    test_statistics = df.loc[[float(x) for x in test_partitions]].sum(axis=0)
-    test_attributes = {'cluster': 1.0, 'C-size': sum(test_statistics), 'label-counts': test_statistics.to_numpy()}
-    val_statistics = df.loc[[float(x) for x in val_partitions]].sum(axis=0)
-    val_attributes = {'cluster': 2.0, 'C-size': sum(val_statistics), 'label-counts': val_statistics.to_numpy()}
-
-
-    # Now, update part_graph
-    for n, d in part_graph.nodes(data=True):
-        if int(d['cluster']) in train_partitions:
-            nx.set_node_attributes(part_graph, {n:train_attributes})
-        elif int(d['cluster']) in test_partitions:
-            nx.set_node_attributes(part_graph, {n:test_attributes})
-        else:
-            nx.set_node_attributes(part_graph, {n:val_attributes})
+    # Given the new assignments, update the table. train is 0, test 1 and val 2.
+    split = np.full(n_partitions, 2, dtype=np.int64)
+    split[list(train_partitions)] = 0
+    split[list(test_partitions)] = 1
+    node_table.partition[:] = split[node_table.partition]
 
 
 
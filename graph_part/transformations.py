@@ -21,3 +21,37 @@ INVERSE_TRANSFORMATIONS = {
     'None': lambda x: x,
     None: lambda x: x
 }
+
+
+## Transformations under which a higher identity gives a smaller metric.
+## For these, an upper bound of the identity is a lower bound of the metric.
+DECREASING_TRANSFORMATIONS = ['one-minus', 'inverse']
+
+
+def _inverse_array(x: np.ndarray) -> np.ndarray:
+    out = np.full(x.shape, np.inf)
+    np.divide(1, x, out=out, where=x > 0)
+    return out
+
+
+## Same as TRANSFORMATIONS, but applied to numpy arrays at once.
+ARRAY_TRANSFORMATIONS = {
+    'one-minus': lambda x: 1-x, 
+    'inverse': _inverse_array, 
+    'square': lambda x: x**2,
+    'log': lambda x: np.log(x),
+    'none': lambda x: x,
+    'None': lambda x: x,
+    None: lambda x: x
+}
+
+
+ARRAY_INVERSE_TRANSFORMATIONS = {
+    'one-minus': lambda x: 1-x, 
+    'inverse': _inverse_array, 
+    'square': lambda x: np.sqrt(x),
+    'log': lambda x: np.exp(x),
+    'none': lambda x: x,
+    'None': lambda x: x,
+    None: lambda x: x
+}
@@ -24,8 +24,7 @@ setup(
     url="https://github.com/graph-part/graph-part",
     author="F. Teufel and M.H. Gislason",
     packages=['graph_part'],
-    python_requires=">=3.6, <4",
+    python_requires=">=3.8, <4",
     install_requires=requirements,
-    scripts=['graph_part/mmseqs_fake_prefilter.sh'],
     entry_points = {"console_scripts":['graphpart=graph_part:run_graph_part']},
 )